@@ -40,15 +40,22 @@ def create_config(options):
 
 def create_server(options):
     settings = create_config(options)
-    settings.target_optimization(options.targets)
+    with options.targets:
+        settings.target_optimization(options.targets, options.exclude)
+    if options.exclude:
+        options.exclude.close()
     server = DScanServer((settings.host, settings.port),
                          AgentHandler, options=settings)
 
     server_thread = threading.Thread(target=server.serve_forever)
     # Exit the server thread when the main thread terminates
     server_thread.daemon = True
+    inbox_thread = threading.Thread(target=server.watch_inbox, daemon=True)
+    drain_thread = threading.Thread(target=server.watch_drain, daemon=True)
     try:
         server_thread.start()
+        inbox_thread.start()
+        drain_thread.start()
         logging.info(f"Server loop running in thread:{server_thread.name}")
         out = ContextDisplay(server.ctx)
         out.show()
@@ -7,8 +7,9 @@ client side responsible for the managing clients and scan execution flow.
 """
 import os
 import hmac
-import struct
 import random
+import select
+import struct
 import threading
 import time
 from socket import socket
@@ -18,17 +19,26 @@ from socket import timeout
 import ssl
 from dscan import log
 from dscan.models.structures import Structure, Operations
-from dscan.models.structures import Auth
+from dscan.models.structures import Auth, Cancel, ExitStatus
+from dscan.models.structures import Features, Hello
 from dscan.models.structures import Ready
 from dscan.models.structures import Status
+from dscan.models.structures import TaskReport, PartialReport
+from dscan.models.structures import PROTOCOL_VERSION, SUPPORTED_FEATURES
 from dscan.models.scanner import ScanProcess
-from string import ascii_uppercase
+from dscan.models.spool import Spool
 
 
 class Agent:
     """
     Agent client implementation.
     """
+    # seconds to wait after the first failed connection, doubled after each.
+    BACKOFF = 1
+    # seconds between the checks for the end of the scan while watching
+    # for a cancel.
+    POLL = 0.5
+
     def __init__(self, config):
         """
         :param config: `dscan.models.scanner.Config`
@@ -37,15 +47,31 @@ class Agent:
         self.connected = False
         self.config = config
         self.con_retries = 0
-        srv_hostname = config.srv_hostname
-        ssl_context = ssl.create_default_context()
-        ssl_context.check_hostname = False
-        ssl_context.load_verify_locations(self.config.sslcert)
-        self.socket = ssl_context.wrap_socket(socket(AF_INET, SOCK_STREAM),
-                                              server_side=False,
-                                              server_hostname=srv_hostname)
+        self.features = Features.NONE
+        # the server dropped the connection on the last `Hello`, the next
+        # connection goes without it, if the server serves that connection
+        # it only knows the original messages, see `do_hello`.
+        self.hello_dropped = False
+        self.plain = False
+        self.legacy = False
+        # options registered by the server, valid for the connection.
+        self.options = {}
+        # reports of the tasks with an id not yet received by the server.
+        self.spool = Spool(os.path.join(self.config.outdir, "spool"))
+        self.ssl_context = ssl.create_default_context()
+        self.ssl_context.check_hostname = False
+        self.ssl_context.load_verify_locations(self.config.sslcert)
+        self.socket = None
         self._terminate = threading.Event()
-        self.scan = ScanProcess(self.config.outdir)
+        self.scan = ScanProcess(self.config.outdir, self.config.task_timeout)
+
+    def create_socket(self):
+        """
+        :return: a new `ssl.SSLSocket`, a closed socket can't connect again.
+        """
+        return self.ssl_context.wrap_socket(
+            socket(AF_INET, SOCK_STREAM), server_side=False,
+            server_hostname=self.config.srv_hostname)
 
     def is_connected(self):
         """
@@ -55,7 +81,8 @@ class Agent:
             has been triggered, else False.
         :rtype: `bool`
         """
-        return self.con_retries < 3 and not self._terminate.is_set()
+        return self.con_retries < self.config.retries and \
+            not self._terminate.is_set()
 
     def start(self):
         """
@@ -66,11 +93,12 @@ class Agent:
         :rtype: `bool`
         """
         self.con_retries = 0
-        # while the connection retry is under 3 tries
+        # while the connection retry is under the configured tries
         # everytime the connection is interrupted the client
         # tries to connect authenticates and requests a target!
         while self.is_connected():
             try:
+                self.socket = self.create_socket()
                 self.socket.connect((self.config.host, self.config.port))
                 self.connected = True
                 if not self.do_auth():
@@ -79,6 +107,8 @@ class Agent:
                     return
                 # reset the counter if connection was successful.
                 self.con_retries = 0
+                self.do_hello()
+                self.do_resume()
                 # if authentication was successful request a target to scan.
                 self.do_ready()
             except (timeout, ConnectionError, ValueError) as e:
@@ -88,8 +118,25 @@ class Agent:
                           f"to establish connection")
                 self.connected = False
                 self.socket.close()
+                self.backoff()
             finally:
-                self.socket.close()
+                if self.socket is not None:
+                    self.socket.close()
+
+    def backoff(self):
+        """
+        Waits before connecting again, the wait doubles after each failed
+        attempt up to the configured max, with some jitter so the agents
+        don't reconnect all at once after a server outage.
+        """
+        if not self.is_connected():
+            return
+        delay = min(self.BACKOFF * 2 ** (self.con_retries - 1),
+                    self.config.max_backoff)
+        delay *= random.uniform(0.5, 1.0)
+        if delay > 0:
+            log.info(f"Connecting again in {delay:.1f} seconds")
+            self._terminate.wait(delay)
 
     def shutdown(self):
         """
@@ -120,25 +167,59 @@ class Agent:
         if status_result:
             return status_result
 
+    def do_hello(self):
+        """
+        Negotiates the protocol features with the server, servers that
+        don't know the `Hello` close the connection, the agent connects
+        again without it and falls back to the original messages.
+        The `Hello` is tried again on the following connections, unless the
+        server served the one without it, a server restarting may drop it
+        too.
+
+        :raises ConnectionError: if the server does not reply to the `Hello`.
+        """
+        self.options = {}
+        self.features = Features.NONE
+        self.plain = self.legacy or self.hello_dropped
+        self.hello_dropped = False
+        if self.plain:
+            return
+        self.socket.sendall(Hello(PROTOCOL_VERSION, SUPPORTED_FEATURES).pack())
+        reply = Structure.create(self.socket)
+        if not reply or reply.op_code != Operations.HELLO:
+            self.hello_dropped = True
+            raise ConnectionError("Server does not support Hello")
+        if reply.version >= PROTOCOL_VERSION:
+            self.features = Features(reply.features)
+        log.info(f"Negotiated protocol features {self.features!r}")
+
     def do_ready(self):
         """
         This is recursive method and is responsible for, notifying the server
         is ready to execute a new scan, launch the scan and save the report.
         Until the server returns no target to scan.
         """
-        alias = "".join(random.choice(ascii_uppercase) for _ in range(6))
+        alias = self.config.agent_id
         while self.connected:
             log.info("Requesting target...")
             self.socket.sendall(Ready(os.getuid(), alias).pack())
             cmd = Structure.create(self.socket)
+            while cmd and cmd.op_code in (Operations.OPTIONS,
+                                          Operations.CANCEL):
+                if cmd.op_code == Operations.OPTIONS:
+                    self.options[cmd.oid] = cmd.options
+                cmd = Structure.create(self.socket)
             if not cmd:
                 # unable to get message
                 log.info("Unable to receive command from server")
                 return
+            if self.plain and not self.legacy:
+                log.info("Server only supports the original messages")
+                self.legacy = True
 
             if cmd.op_code == Operations.STATUS and cmd.status == Status.FINISHED:
                 log.info("received a Finished status, Terminating!")
-                self.con_retries = 3
+                self.con_retries = self.config.retries
                 return
 
             if cmd.op_code == Operations.STATUS and cmd.status == Status.UNFINISHED:
@@ -147,18 +228,165 @@ class Agent:
                 log.info("retrying.. Target request!")
                 continue
 
+            options = cmd.options
+            if cmd.op_code in (Operations.COMMAND_EXT,
+                               Operations.TASK_COMMAND):
+                target = cmd.targets
+                if cmd.oid:
+                    options = self.options.get(cmd.oid)
+            else:
+                target = cmd.target.decode("utf-8")
+
+            if options is None:
+                log.error(f"Unknown options id {cmd.oid}")
+                self.send_status(Status.FAILED.value)
+                continue
+
+            if not target:
+                log.info("received an empty target, Terminating!")
+                self.con_retries = self.config.retries
+                return
+
+            tid = 0
+            if cmd.op_code == Operations.TASK_COMMAND:
+                tid = cmd.tid
             log.info(f"Launching scan on {cmd}")
-            report = self.scan.run(cmd.target.decode("utf-8"),
-                                   cmd.options.decode("utf-8"),
-                                   self.send_status)
+            report, cancelled = self.run_task(target,
+                                              options.decode("utf-8"), tid)
             if report:
-                self.socket.sendall(report.pack())
-                if self.__send_report(report):
-                    log.info("Report Transfer was successful")
+                if tid:
+                    # kept until received, in case the server is down.
+                    self.spool.add(tid, report)
+                self.send_report(tid, report)
+            elif not (tid and self.send_partial(tid)):
+                if cancelled:
+                    # the server waits for the state of the cancelled task.
+                    self.socket.sendall(ExitStatus(Status.FAILED).pack())
                 else:
-                    log.error("Report Transfer was unsuccessful")
-            else:
-                self.send_status(Status.FAILED.value)
+                    self.send_status(Status.FAILED.value)
+
+    def run_task(self, target, options, tid):
+        """
+        Runs the scan of a task, the messages of the server are read in a
+        thread while the scan runs, so the server can cancel it.
+
+        :param target: `str` target or list of targets.
+        :param options: `str` scan options.
+        :param tid: `int` id of the task, tasks without an id can't be
+            cancelled.
+        :return: tuple with the report object, None if the scan failed, and
+            `True` if the task was cancelled.
+        """
+        if not tid or Features.CANCEL not in self.features:
+            return self.scan.run(target, options, self.send_status, tid), \
+                False
+        done = threading.Event()
+        cancelled = threading.Event()
+        watcher = threading.Thread(target=self.watch,
+                                   args=(tid, done, cancelled), daemon=True)
+
+        def started(status):
+            self.send_status(status)
+            # the socket is left to the watcher once the scan started.
+            if status == Status.SUCCESS and watcher.ident is None:
+                watcher.start()
+        try:
+            report = self.scan.run(target, options, started, tid)
+        finally:
+            done.set()
+            if watcher.ident is not None:
+                watcher.join()
+        return report, cancelled.is_set()
+
+    def watch(self, tid, done, cancelled):
+        """
+        Reads the messages of the server until the scan is done, a `Cancel`
+        of the task stops the scan.
+
+        :param tid: `int` id of the running task.
+        :param done: `threading.Event` set when the scan is done.
+        :param cancelled: `threading.Event` set when the task is cancelled.
+        """
+        try:
+            while not done.is_set():
+                if not self.socket.pending():
+                    readable, _, _ = select.select([self.socket], [], [],
+                                                   self.POLL)
+                    if not readable:
+                        continue
+                msg = Structure.create(self.socket)
+                if not msg:
+                    log.info("Disconnected while scanning")
+                    return
+                if msg.op_code == Operations.CANCEL and msg.tid == tid:
+                    log.info(f"Task {tid:#x} was cancelled by the server")
+                    cancelled.set()
+                    self.scan.cancel()
+                    return
+        except (OSError, ValueError) as ex:
+            log.error(f"Unable to watch the connection {ex}")
+
+    def do_resume(self):
+        """
+        Uploads the spooled reports, left unsent by a lost connection or a
+        server outage, the server completes the tasks by their id whatever
+        the connection.
+        """
+        if not self.spool or Features.TASK_IDS not in self.features:
+            return
+        log.info(f"Uploading {len(self.spool)} spooled reports")
+        for tid, report in list(self.spool):
+            self.send_report(tid, report)
+
+    def send_report(self, tid, report):
+        """
+        :param tid: `int` id of the task, 0 if it has none.
+        :param report: report message.
+        :type report: `dscan.models.structures.Report`
+        """
+        if tid:
+            # the server completes the task by its id.
+            self.socket.sendall(TaskReport(tid, report.filesize,
+                                           report.filename,
+                                           report.filehash).pack())
+        else:
+            self.socket.sendall(report.pack())
+        if self.__send_report(report):
+            log.info("Report Transfer was successful")
+            if tid:
+                self.spool.remove(tid)
+        else:
+            # a spooled report is sent again on the next connection, until
+            # the server rejected it too many times.
+            log.error("Report Transfer was unsuccessful")
+            if tid:
+                self.spool.rejected(tid)
+
+    def send_partial(self, tid):
+        """
+        Uploads the partial report of an interrupted task, the server keeps
+        the hosts finished and queues the rest of the task again.
+
+        :param tid: `int` id of the task.
+        :return: `True` if the partial report was sent.
+        :rtype: `bool`
+        """
+        if Features.PARTIAL_REPORTS not in self.features:
+            return False
+        report = self.scan.partial_report()
+        if not report:
+            return False
+        self.socket.sendall(PartialReport(tid, report.filesize,
+                                          report.filename,
+                                          report.filehash).pack())
+        # the server takes a partial report once, no retries.
+        if self.__send_report(report, retry=3):
+            log.info("Partial report transfer was successful")
+            # the normal output is kept to resume the hosts left.
+            self.scan.salvaged()
+        else:
+            log.error("Partial report was not salvaged")
+        return True
 
     def send_status(self, status):
         """
@@ -182,6 +410,10 @@ class Agent:
             return False
 
         status, = struct.unpack("<B", op_bytes)
+        if status == Operations.CANCEL:
+            # a cancel sent while the task was finishing.
+            Cancel(sock=self.socket)
+            return self.__check_status()
         if status == Status.SUCCESS.value:
             log.info("Operation Successful ...")
             return True
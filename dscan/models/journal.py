@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+"""
+journal.py
+write-ahead journal of the scan context
+"""
+import os
+from enum import Enum
+from dscan import log
+from dscan.models.snapshot import atomic_write
+
+
+class Op(Enum):
+    """
+    Transitions saved in the journal:
+    - Issued: a task was sent to an agent.
+    - Running: the agent started the task.
+    - Completed: the report of the task was received.
+    - Interrupted: the task went back to the pending tasks.
+    - Stage: a stage started, with its scan options.
+    - Retarget: a stage that did not start yet got a new targets file.
+    """
+    ISSUED = "I"
+    RUNNING = "R"
+    COMPLETED = "C"
+    INTERRUPTED = "X"
+    STAGE = "S"
+    RETARGET = "T"
+
+
+class Journal:
+    """
+    Append-only log of the `Context` transitions since its last snapshot,
+    one tab separated record per line, flushed as they are written so a
+    crash of the server loses at most the record being written.
+    The snapshot replaces the resume file and starts a new empty journal.
+    """
+
+    def __init__(self, path, snapshot_path, size=100000):
+        """
+        :param path: path of the journal file.
+        :param snapshot_path: path of the resume file with the snapshot.
+        :param size: number of records before a new snapshot is due.
+        """
+        self.path = path
+        self.snapshot_path = snapshot_path
+        self.size = size
+        self.nrecords = 0
+        self._fd = None
+
+    def exists(self):
+        """
+        :return: `True` if there is a journal with records to replay.
+        """
+        return os.path.isfile(self.path) and os.stat(self.path).st_size > 0
+
+    def open(self):
+        if not self._fd:
+            self._fd = open(self.path, 'at')
+
+    def append(self, op, stage, index=None, value=""):
+        """
+        :param op: `Op` of the transition.
+        :param stage: `str` name of the stage.
+        :param index: `int` position of the task in the stage work queue.
+        :param value: `str` target of the task, or the options or targets
+            path of a stage.
+        """
+        self.open()
+        index = "" if index is None else index
+        self._fd.write(f"{op.value}\t{stage}\t{index}\t{value}\n")
+        self._fd.flush()
+        self.nrecords += 1
+
+    @property
+    def isfull(self):
+        """
+        :return: `True` if a new snapshot is due.
+        """
+        return self.nrecords >= self.size
+
+    def replay(self):
+        """
+        Reads the journal, a record cut by a crash ends the replay.
+
+        :yield: tuples with the `Op`, stage name, `int` index or None, and
+            the value of each record.
+        """
+        if not self.exists():
+            return
+        with open(self.path, 'rt') as jfile:
+            for line in jfile:
+                fields = line.rstrip("\n").split("\t", 3)
+                if not line.endswith("\n") or len(fields) != 4:
+                    log.warning(f"Journal {self.path} ends with a partial "
+                                f"record")
+                    return
+                op, stage, index, value = fields
+                try:
+                    record = Op(op), stage, int(index) if index else None, \
+                        value
+                except ValueError:
+                    log.error(f"Invalid journal record: {line.strip()}")
+                    continue
+                self.nrecords += 1
+                yield record
+
+    def compact(self, save):
+        """
+        Saves the snapshot in the resume file and empties the journal, the
+        resume file is replaced only after the snapshot is on disk.
+
+        :param save: function that writes the snapshot of the `Context` to
+            a binary file object.
+        """
+        log.info(f"Saving a snapshot of the context {self.snapshot_path}")
+        atomic_write(self.snapshot_path, save)
+        self.close()
+        self._fd = open(self.path, 'wt')
+        self.nrecords = 0
+
+    def remove(self):
+        """
+        Deletes the journal, once the scan is finished.
+        """
+        self.close()
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+
+    def close(self):
+        if self._fd:
+            self._fd.close()
+            self._fd = None
@@ -3,12 +3,28 @@ parsers.py
 parsers models, input ip address list collapse, or
 scanner results to parse.
 """
+import array
+import bisect
 import fnmatch
+import heapq
 import ipaddress
+import itertools
+import json
 import os
 import argparse
+import re
+import socket
+import tempfile
+import time
+import xml.etree.ElementTree as ElementTree
+from concurrent.futures import ThreadPoolExecutor
 from libnmap.parser import NmapParser, NmapParserException
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 from dscan import log
 
 
@@ -28,6 +44,8 @@ def parse_args():
     parser_server.add_argument('--config', required=True)
     parser_server.add_argument('-b', default='0.0.0.0')
     parser_server.add_argument('-p', type=int, default=2040)
+    parser_server.add_argument('--exclude', type=argparse.FileType('rt'),
+                               help="file of targets never to scan")
     parser_server.add_argument('targets', type=argparse.FileType('rt'))
     parser_agent = subparsers.add_parser('agent')
     parser_agent.add_argument('--config', required=True)
@@ -45,6 +63,122 @@ def parse_args():
     return parser
 
 
+def parse_ports(spec):
+    """
+    Expands a nmap port specification like `22,80,1000-1010` in a list of
+    port numbers, keeping the order in which they were specified.
+
+    :param spec: `str` nmap port specification.
+    :return: `list` of `int` port numbers.
+    :rtype: `list`
+    """
+    ports = []
+    seen = set()
+    for item in spec.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        if '-' in item:
+            first, last = item.split('-', 1)
+            values = range(int(first), int(last) + 1)
+        else:
+            values = (int(item), )
+        for port in values:
+            if port not in seen:
+                seen.add(port)
+                ports.append(port)
+    return ports
+
+
+def format_ports(ports, ordered=False):
+    """
+    Collapses a list of port numbers in a compact nmap port specification.
+
+    :param ports: iterable of `int` port numbers.
+    :param ordered: if `True` the ports keep their order, only the runs of
+        consecutive ports are collapsed, else they are sorted.
+    :return: `str` nmap port specification like `22,80,1000-1010`.
+    :rtype: `str`
+    """
+    if ordered:
+        ports = dict.fromkeys(ports)
+    else:
+        ports = sorted(set(ports))
+    ranges = []
+    for port in ports:
+        if ranges and ranges[-1][1] + 1 == port:
+            ranges[-1][1] = port
+        else:
+            ranges.append([port, port])
+    return ",".join(f"{first}-{last}" if first != last else f"{first}"
+                    for first, last in ranges)
+
+
+def target_addresses(target):
+    """
+    Expands a target line from a work file, in cidr or nmap octet range
+    format like 192.168.10.1-4 or 10.0-3.1,5.1-254, in the addresses it
+    covers.
+
+    :param target: `str` target line.
+    :yield: `str` ip address.
+    """
+    for item in target.split():
+        if "/" in item:
+            for address in ipaddress.ip_network(item, strict=False):
+                yield str(address)
+        elif "-" in item or "," in item:
+            octets = [parse_ports(octet) for octet in item.split(".")]
+            for address in itertools.product(*octets):
+                yield ".".join(map(str, address))
+        else:
+            yield item
+
+
+def salvage_report(data):
+    """
+    Closes the xml output of an interrupted scan after its last finished
+    host.
+
+    :param data: `bytes` partial xml output of nmap.
+    :return: tuple with the `bytes` of a valid report and the `set` of the
+        `str` addresses of the finished hosts, the report is None if no host
+        finished.
+    :raises ValueError: if the output is not valid xml.
+    """
+    end = data.rfind(b"</host>")
+    if end < 0:
+        return None, set()
+    report = data[:end + len(b"</host>")] + b"\n</nmaprun>\n"
+    try:
+        root = ElementTree.fromstring(report)
+    except ElementTree.ParseError as ex:
+        raise ValueError(f"Invalid partial report {ex}") from ex
+    addresses = {address.get("addr") for host in root.iter("host")
+                 for address in host.iter("address")
+                 if address.get("addrtype") in ("ipv4", "ipv6")}
+    return report, addresses
+
+
+def remaining_targets(target, done):
+    """
+    :param target: `str` target of a task.
+    :param done: `set` of the `str` addresses already scanned.
+    :return: `str` networks of the addresses of the target not scanned yet
+        separated by spaces, empty if there are none.
+    :raises ValueError: if the target has hostnames.
+    """
+    done = {ipaddress.ip_address(address) for address in done}
+    left = [address for address in
+            map(ipaddress.ip_address, target_addresses(target))
+            if address not in done]
+    networks = []
+    for version in (4, 6):
+        networks.extend(ipaddress.collapse_addresses(
+            address for address in left if address.version == version))
+    return " ".join(map(str, networks))
+
+
 class ReportsParser:
     """
     XML Nmap results parser.
@@ -54,7 +188,7 @@ class ReportsParser:
         """
         :param reports_path: path where the reports are stored
         :param pattern: pattern `fnmatch` to find valid files to extract
-        the results from.
+        the results from, or the name of a single report.
         """
         self.path = reports_path
         self.pattern = pattern
@@ -67,72 +201,839 @@ class ReportsParser:
         hosts_up = []
         for host in self.__walk():
             if host.is_up():
-                hosts_up.append(host.ipv4)
+                hosts_up.append(host.address)
         return hosts_up
 
+    def hosts_status(self):
+        """
+        A host is considered alive if it replied to the host discovery, or
+        any of the scanned ports replied, hosts only set up by `-Pn` without
+        a single port reply are not.
+
+        The reports are parsed one host at a time, libnmap does not expose
+        the reason of the host status.
+
+        :yield: tuple with the host address and `True` if the host is alive.
+        :rtype: `tuple`
+        """
+        for report in self.__reports():
+            try:
+                for _, element in ElementTree.iterparse(report):
+                    if element.tag != "host":
+                        continue
+                    status = element.find("status")
+                    address = next((
+                        address.get("addr")
+                        for address in element.iter("address")
+                        if address.get("addrtype") in ("ipv4", "ipv6")),
+                        None)
+                    if status is not None and address:
+                        alive = status.get("state") == "up"
+                        if alive and status.get("reason") == "user-set":
+                            alive = any(state.get("state") in
+                                        ("open", "closed")
+                                        for state in element.iter("state"))
+                        yield address, alive
+                    element.clear()
+            except (OSError, ElementTree.ParseError) as ex:
+                log.error(f"Error parsing {report} - {ex}")
+
+    def open_ports(self):
+        """
+        :yield: tuple with the host address and port number of every open
+            port found in the reports.
+        :rtype: `tuple`
+        """
+        for host in self.__walk():
+            for port, _ in host.get_open_ports():
+                yield host.address, port
+
     def __walk(self):
         """
         information.
         :yield: A list with the filtered values
         :rtype: `list`
         """
+        for report in self.__reports():
+            try:
+                nmap_report = NmapParser.parse_fromfile(report)
+                yield from nmap_report.hosts
+            except NmapParserException as ex:
+                log.error(f"Error parsing {report} - {ex}")
+
+    def __reports(self):
+        """
+        :yield: path of the reports matching the pattern.
+        :rtype: `str`
+        """
+        if not any(char in self.pattern for char in '*?['):
+            # a single report, no need to list the whole directory.
+            yield os.path.join(self.path, self.pattern)
+            return
         for report in os.scandir(self.path):
             if fnmatch.fnmatch(report.name, self.pattern):
-                try:
-                    nmap_report = NmapParser.parse_fromfile(report.path)
-                    yield from nmap_report.hosts
-                except NmapParserException as ex:
-                    log.error(f"Error parsing {report} - {ex}")
+                yield report.path
+
+
+class IntervalSet:
+    """
+    Set of closed intervals of integer addresses, kept sorted and merged
+        so the addresses covered can be found with a binary search, or in
+        bulk for sorted blocks of addresses.
+    """
+
+    def __init__(self):
+        self.starts = []
+        self.ends = []
+        self.pending = []
+
+    def add(self, first, last):
+        """
+        :param first: `int` first address of the interval.
+        :param last: `int` last address of the interval.
+        """
+        self.pending.append((first, last))
+
+    def _merge(self):
+        if not self.pending:
+            return
+        intervals = sorted(self.pending + list(zip(self.starts, self.ends)))
+        self.pending = []
+        self.starts, self.ends = [], []
+        for first, last in intervals:
+            if self.ends and first <= self.ends[-1] + 1:
+                self.ends[-1] = max(self.ends[-1], last)
+            else:
+                self.starts.append(first)
+                self.ends.append(last)
+
+    def __bool__(self):
+        return bool(self.pending or self.starts)
+
+    def __len__(self):
+        self._merge()
+        return len(self.starts)
+
+    def __iter__(self):
+        self._merge()
+        return zip(self.starts, self.ends)
+
+    def __contains__(self, address):
+        self._merge()
+        index = bisect.bisect_right(self.starts, address) - 1
+        return index >= 0 and address <= self.ends[index]
+
+    def difference(self, first, last):
+        """
+        :param first: `int` first address of the interval.
+        :param last: `int` last address of the interval.
+        :yield: tuples with the first and last address of each gap of the
+            interval not covered.
+        """
+        self._merge()
+        index = bisect.bisect_left(self.ends, first)
+        while index < len(self.starts) and self.starts[index] <= last:
+            if self.starts[index] > first:
+                yield first, self.starts[index] - 1
+            first = self.ends[index] + 1
+            if first > last:
+                return
+            index += 1
+        yield first, last
+
+    def uncovered(self, block):
+        """
+        :param block: sorted `numpy.ndarray` or `list` of `int` addresses.
+        :return: the addresses of the block not covered by any interval.
+        """
+        self._merge()
+        if not self.starts or not len(block):
+            return block
+        if numpy is not None and isinstance(block, numpy.ndarray):
+            starts = numpy.array(self.starts, dtype=block.dtype)
+            ends = numpy.array(self.ends, dtype=block.dtype)
+            index = numpy.searchsorted(starts, block, side='right') - 1
+            covered = (index >= 0) & (block <= ends[numpy.maximum(index, 0)])
+            return block[~covered]
+        result = []
+        index = bisect.bisect_left(self.ends, block[0])
+        count = len(self.ends)
+        for address in block:
+            while index < count and self.ends[index] < address:
+                index += 1
+            if index == count or address < self.starts[index]:
+                result.append(address)
+        return result
+
+
+class ExternalSort:
+    """
+    Sorts and deduplicates a stream of integer addresses with bounded
+        memory, the addresses are buffered in a packed array and every
+        `chunk_size` addresses the buffer is sorted and spilled to a
+        temporary file, the sorted chunks are merged lazily when iterated.
+        When NumPy is available the ipv4 addresses are sorted and
+        deduplicated in bulk.
+    """
+    BLOCK = 65536
+
+    def __init__(self, itemsize, chunk_size=1000000, tmpdir=None):
+        """
+        :param itemsize: size in bytes of each address, 4 for ipv4 and 16
+            for ipv6.
+        :param chunk_size: max number of addresses kept in memory.
+        :param tmpdir: directory of the spilled chunks.
+        """
+        self.itemsize = itemsize
+        self.chunk_size = chunk_size
+        self.tmpdir = tmpdir
+        self.chunks = []
+        self.buffer = self._buffer()
+
+    def _buffer(self):
+        # ipv6 addresses don't fit in a machine word.
+        if self.itemsize > 8:
+            return []
+        return array.array('L' if self.itemsize > 4 else 'I')
+
+    @property
+    def vectorized(self):
+        """
+        :return: `True` if the addresses are handled as NumPy arrays.
+        """
+        return numpy is not None and self.itemsize <= 8
+
+    def __len__(self):
+        return len(self.buffer) + sum(size for _, size in self.chunks)
+
+    def append(self, address):
+        """
+        :param address: `int` address to sort.
+        """
+        self.buffer.append(address)
+        if len(self.buffer) >= self.chunk_size:
+            self._spill()
+
+    def _sorted(self):
+        """
+        :return: the buffered addresses sorted and deduplicated.
+        """
+        if self.vectorized:
+            return numpy.unique(numpy.frombuffer(
+                self.buffer, dtype=self.buffer.typecode))
+        return sorted(set(self.buffer))
+
+    def _spill(self):
+        chunk = tempfile.TemporaryFile(dir=self.tmpdir)
+        addresses = self._sorted()
+        if self.vectorized:
+            chunk.write(addresses.astype(f">u{self.itemsize}").tobytes())
+        else:
+            chunk.writelines(address.to_bytes(self.itemsize, 'big')
+                             for address in addresses)
+        chunk.seek(0)
+        self.chunks.append((chunk, len(addresses)))
+        self.buffer = self._buffer()
+
+    def _read(self, chunk):
+        """
+        :param chunk: temporary file with sorted addresses.
+        :yield: `int` addresses of the chunk.
+        """
+        size = self.itemsize
+        while True:
+            data = chunk.read(size * self.BLOCK)
+            if not data:
+                break
+            if self.vectorized:
+                yield from numpy.frombuffer(data, f">u{size}").tolist()
+            else:
+                for offset in range(0, len(data), size):
+                    yield int.from_bytes(data[offset:offset + size], 'big')
+
+    def blocks(self):
+        """
+        :yield: blocks of sorted and unique addresses, as `numpy.ndarray`
+            when vectorized or as `list`, every block starts after the
+            end of the previous one.
+        """
+        if not self.chunks:
+            if len(self.buffer):
+                yield self._sorted()
+            return
+        block, last = [], None
+        tail = self._sorted()
+        if self.vectorized:
+            tail = tail.tolist()
+        merged = heapq.merge(*(self._read(chunk) for chunk, _ in self.chunks),
+                             tail)
+        for address in merged:
+            if address == last:
+                continue
+            block.append(address)
+            last = address
+            if len(block) >= self.BLOCK:
+                yield self._block(block)
+                block = []
+        if block:
+            yield self._block(block)
+
+    def _block(self, block):
+        if self.vectorized:
+            return numpy.array(block, dtype=self.buffer.typecode)
+        return block
+
+    def __iter__(self):
+        for block in self.blocks():
+            yield from (block.tolist() if self.vectorized else block)
+
+    def close(self):
+        for chunk, _ in self.chunks:
+            chunk.close()
+        self.chunks = []
+        self.buffer = self._buffer()
+
+
+class Resolver:
+    """
+    Resolves hostnames with a bounded pool of workers, the addresses are
+        kept in a cache file for `ttl` seconds so the following runs don't
+        resolve them again.
+    """
+    HOSTNAME = re.compile(r'^(?=.{1,253}\.?$)(?!-)[A-Za-z0-9_-]{1,63}'
+                          r'(\.(?!-)[A-Za-z0-9_-]{1,63})*\.?$')
+
+    def __init__(self, cache_path=None, ttl=86400, workers=16):
+        """
+        :param cache_path: path of the cache file, None disables the cache.
+        :param ttl: seconds a resolution is kept in the cache.
+        :param workers: max number of concurrent resolutions.
+        """
+        self.cache_path = cache_path
+        self.ttl = ttl
+        self.workers = workers
+
+    @classmethod
+    def ishostname(cls, target):
+        """
+        :param target: `str` target.
+        :return: `True` if the target is a valid hostname.
+        """
+        return bool(cls.HOSTNAME.match(target)) and \
+            not target.replace(".", "").isdigit()
+
+    def _load(self):
+        if not self.cache_path or not os.path.isfile(self.cache_path):
+            return {}
+        try:
+            with open(self.cache_path, 'rt') as cfile:
+                return json.load(cfile)
+        except (OSError, ValueError) as ex:
+            log.error(f"Error loading the resolution cache - {ex}")
+            return {}
+
+    def _save(self, cache):
+        if not self.cache_path:
+            return
+        tmp_path = f"{self.cache_path}.tmp"
+        with open(tmp_path, 'wt') as cfile:
+            json.dump(cache, cfile)
+        os.replace(tmp_path, self.cache_path)
+
+    @staticmethod
+    def lookup(name):
+        """
+        :param name: `str` hostname.
+        :return: sorted `list` of `str` addresses of the hostname, empty if
+            it can't be resolved.
+        """
+        try:
+            infos = socket.getaddrinfo(name, None, proto=socket.IPPROTO_TCP)
+        except (socket.gaierror, UnicodeError) as ex:
+            log.error(f"Unable to resolve {name} - {ex}")
+            return []
+        return sorted({info[4][0] for info in infos})
+
+    def resolve(self, names):
+        """
+        :param names: iterable of `str` hostnames.
+        :return: `dict` with the `list` of addresses of each hostname.
+        """
+        names = set(names)
+        if not names:
+            return {}
+        now = time.time()
+        cache = {name: entry for name, entry in self._load().items()
+                 if entry[0] > now}
+        resolved = {name: cache[name][1] for name in names if name in cache}
+        missing = sorted(names - resolved.keys())
+        if missing:
+            log.info(f"Resolving {len(missing)} hostnames, "
+                     f"{len(resolved)} cached")
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                for name, addresses in zip(missing,
+                                           executor.map(self.lookup,
+                                                        missing)):
+                    resolved[name] = addresses
+                    if addresses:
+                        cache[name] = (now + self.ttl, addresses)
+            self._save(cache)
+        return resolved
 
 
 class TargetOptimization:
     """
     This class takes lists of hosts or networks, and attempts to optimize
-        them by either split big cidr like /8 /16 in /24 or in rage format
-        192.168.10.1-4.
+        them in rage format 192.168.10.1-4, big cidr like /8 /16 are saved
+        in a single line and split in /24 by the stage work queue.
+        Optionally sparse hosts can be packed in lists of targets, to reduce
+        the number of tasks.
+        The targets are read lazily and the single hosts are sorted with an
+        `ExternalSort`, so the memory used is bounded by `chunk_size`, the
+        ranges are found on blocks of integer addresses.
     """
 
-    def __init__(self, fpath, cidr="/24"):
+    # ipv6 networks bigger than this are not scanned, the work queue splits
+    # them in /120 networks, a /104 is 65536 tasks.
+    MIN_PREFIX6 = 104
+
+    def __init__(self, fpath, cidr="/24", pack=0, max_length=0,
+                 chunk_size=1000000, resolver=None, hosts_path=None,
+                 pack6=None, compact=False):
+        """
+        :param fpath: path of the work file.
+        :param cidr: networks bigger than cidr are split by the work queue.
+        :param pack: number of hosts to pack in each task, non contiguous
+            hosts are saved as a list of targets separated by spaces, 0
+            disables the packing.
+        :param max_length: max length of a packed task, 0 for no limit.
+        :param chunk_size: max number of single hosts sorted in memory,
+            bigger inputs are sorted in chunks spilled to disk.
+        :param resolver: `Resolver` of the hostname targets, None to reject
+            hostnames.
+        :param hosts_path: path of the file where the addresses of the
+            hostnames are saved.
+        :param pack6: number of ipv6 hosts to pack in each task, the ipv6
+            space is sparse, by default the same as `pack`.
+        :param compact: group the sparse ipv4 hosts in nmap octet range
+            expressions, like 10.0-3.1,5.1-254.
+        """
         self.cidr = cidr
         self.fpath = fpath
+        self.pack = pack
+        self.max_length = max_length
+        self.chunk_size = chunk_size
+        self.resolver = resolver
+        self.hosts_path = hosts_path
+        self.pack6 = pack if pack6 is None else pack6
+        self.compact = compact
+        self.excluded = {4: IntervalSet(), 6: IntervalSet()}
+
+    def exclude(self, targets):
+        """
+        Adds targets that must never be scanned, they are subtracted from
+        the targets saved.
+
+        :param targets: iterable of hosts, networks or ranges in the
+            format 192.168.10.1-4, like a `list` or an open file, the lines
+            of a work file are accepted too.
+        :type: targets: iterable of `str`
+        """
+        for line in targets:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            for target in line.split():
+                self._exclude(target)
+
+    def _exclude(self, target):
+        """
+        :param target: `str` host, network or nmap octet range to exclude.
+        """
+        try:
+            if "," in target or "-" in target.rpartition(".")[0]:
+                for address in target_addresses(target):
+                    net = ipaddress.ip_address(address)
+                    self.excluded[net.version].add(int(net), int(net))
+                return
+            if "/" in target:
+                net = ipaddress.ip_network(target, strict=False)
+                first = int(net.network_address)
+                last = int(net.broadcast_address)
+            elif "-" in target:
+                base, end = target.rsplit("-", 1)
+                net = ipaddress.ip_network(f"{base}/24", strict=False)
+                first = int(ipaddress.ip_address(base))
+                last = int(net.network_address) + int(end)
+                if not first <= last <= int(net.broadcast_address):
+                    raise ValueError(target)
+            else:
+                net = ipaddress.ip_address(target)
+                first = last = int(net)
+            self.excluded[net.version].add(first, last)
+        except (TypeError, ValueError):
+            log.error(f"Error parsing excluded target: {target}")
 
-    def save(self, targets):
+    def save(self, targets, append=False):
         """
         Takes a list of targets to optimize and saves it in the workspace path.
+        Duplicated hosts, and hosts inside the listed networks are dropped.
 
-        :param targets: `list` of targets (`str` and top optimize.
-        :type: targets: `list` of `str`
+        :param targets: iterable of targets to optimize, like a `list` or
+            an open file.
+        :type: targets: iterable of `str`
+        :param append: if `True` the resolved hostnames are appended to
+            `hosts_path` instead of replacing it.
         """
         assert targets, "Empty target list"
-        ips = []
-
-        with open(self.fpath, 'wt') as qfile:
-            for target in targets:
-                try:
-                    if "/" in target:
-                        net = ipaddress.ip_network(target.strip())
-                        if net.prefixlen < 24:
-                            subs = map(lambda n: f"{n.with_prefixlen}\n",
-                                       net.subnets(new_prefix=24))
-                            qfile.writelines(subs)
+        tmpdir = os.path.dirname(self.fpath) or None
+        ips = {4: ExternalSort(4, self.chunk_size, tmpdir),
+               6: ExternalSort(16, self.chunk_size, tmpdir)}
+        covered = {4: IntervalSet(), 6: IntervalSet()}
+        names = set()
+
+        try:
+            with open(self.fpath, 'wt') as qfile:
+                for target in targets:
+                    try:
+                        if "/" in target:
+                            net = ipaddress.ip_network(target.strip())
+                            if net.version == 6 and \
+                                    net.prefixlen < self.MIN_PREFIX6:
+                                log.error(f"IPv6 network too big to scan: "
+                                          f"{target.strip()}, the smallest "
+                                          f"prefix is /{self.MIN_PREFIX6}")
+                                continue
+                            covered[net.version].add(
+                                int(net.network_address),
+                                int(net.broadcast_address))
+                            # big networks are split by the stage work
+                            # queue when the tasks are pulled.
+                            for line in self._subtract(net):
+                                qfile.write(f"{line}\n")
+                        elif self.resolver and \
+                                Resolver.ishostname(target.strip()):
+                            names.add(target.strip().rstrip(".").lower())
                         else:
-                            qfile.write(f"{net.with_prefixlen}\n")
-                    else:
-                        ips.append(ipaddress.ip_address(target.strip()))
-                except (TypeError, ValueError):
-                    log.error(f"Error optimizing target: {target}")
-
-            # sorting the ip addresses.
-            ips.sort(key=ipaddress.get_mixed_type_key)
-            # find consecutive ip address ranges.
-            if ips:
-                for first, last in ipaddress._find_address_range(ips):
-                    ip_range = list(ipaddress.summarize_address_range(first,
-                                                                      last))
-                    # if the number of ranges is more than one network in cidr
-                    # format then the glob format x.x.x.x-y is more efficient,
-                    # since nmap supports this format.
-                    if len(ip_range) > 1:
-                        qfile.write(f"{first}-{last.exploded.split('.')[3]}\n")
-                    else:
-                        qfile.write(f"{ip_range.pop().with_prefixlen}\n")
\ No newline at end of file
+                            version, address = self._address(target.strip())
+                            ips[version].append(address)
+                    except (TypeError, ValueError):
+                        log.error(f"Error optimizing target: {target}")
+
+                # hosts behind several names are folded in a single task.
+                for version, address in self._resolve(names, append):
+                    ips[version].append(address)
+
+                # find consecutive ip address ranges, ipv4 sorts first.
+                for version, excluded in self.excluded.items():
+                    for first, last in excluded:
+                        covered[version].add(first, last)
+                ranges = (target for version, addresses in ips.items()
+                          for target in self._ranges(addresses.blocks(),
+                                                     version,
+                                                     covered[version]))
+                if self.pack > 0 or self.pack6 > 0:
+                    ranges = self._pack(ranges)
+                for target, _, _ in ranges:
+                    qfile.write(f"{target}\n")
+        finally:
+            for addresses in ips.values():
+                addresses.close()
+
+    def _resolve(self, names, append=False):
+        """
+        Resolves the hostnames, and saves the names of each address in
+        `hosts_path`.
+
+        :param names: `set` of `str` hostnames.
+        :param append: `True` to append to `hosts_path`.
+        :yield: tuples with the ip version and the `int` address.
+        """
+        if not names:
+            return
+        hosts = {}
+        for name, addresses in self.resolver.resolve(names).items():
+            for address in addresses:
+                hosts.setdefault(address, []).append(name)
+        if self.hosts_path:
+            mode = 'at' if append else 'wt'
+            with open(self.hosts_path, mode) as hfile:
+                for address, hostnames in sorted(hosts.items()):
+                    hfile.write(f"{address} {' '.join(sorted(hostnames))}\n")
+        for address in hosts:
+            try:
+                yield self._address(address)
+            except ValueError:
+                log.error(f"Error optimizing target: {address}")
+
+    def _subtract(self, net):
+        """
+        :param net: `ipaddress.ip_network` to subtract the excluded targets
+            from.
+        :yield: `str` targets of the network not excluded.
+        """
+        excluded = self.excluded[net.version]
+        first, last = int(net.network_address), int(net.broadcast_address)
+        if not excluded:
+            yield net.with_prefixlen
+            return
+        for start, end in excluded.difference(first, last):
+            if (start, end) == (first, last):
+                yield net.with_prefixlen
+            else:
+                yield from self._chunks(start, end, net.max_prefixlen)
+
+    @staticmethod
+    def _chunks(first, last, bits=32):
+        """
+        :param first: `int` first address.
+        :param last: `int` last address.
+        :param bits: number of bits of the addresses.
+        :yield: `str` targets of the range.
+        """
+        factory = ipaddress.IPv4Address if bits == 32 \
+            else ipaddress.IPv6Address
+        for start, end in TargetOptimization._pieces(first, last, bits):
+            yield TargetOptimization._range(factory, bits, start, end)[0]
+
+    @staticmethod
+    def _pieces(first, last, bits=32):
+        """
+        Splits a range of addresses in pieces that nmap can take as a single
+        target, the partial /24 at both ends are kept in range format and
+        the rest in networks.
+
+        :param first: `int` first address.
+        :param last: `int` last address.
+        :param bits: number of bits of the addresses.
+        :yield: tuples with the first and last address of each piece.
+        """
+        size = last - first + 1
+        if size & (size - 1) == 0 and first % size == 0 or \
+                bits == 32 and first >> 8 == last >> 8:
+            yield first, last
+            return
+        factory = ipaddress.IPv4Address if bits == 32 \
+            else ipaddress.IPv6Address
+        if bits == 32 and (first & 0xff or last - first < 0xff):
+            head = min(last, first | 0xff)
+            yield first, head
+            first = head + 1
+        if first > last:
+            return
+        # the last partial /24.
+        tail = last & ~0xff if bits == 32 and (last + 1) & 0xff else None
+        end = tail - 1 if tail is not None else last
+        if first <= end:
+            for net in ipaddress.summarize_address_range(factory(first),
+                                                         factory(end)):
+                yield int(net.network_address), int(net.broadcast_address)
+        if tail is not None:
+            yield tail, last
+
+    @staticmethod
+    def _address(target):
+        """
+        :param target: `str` ip address.
+        :return: tuple with the ip version and the `int` address.
+        :raises ValueError: if the target is not an ip address.
+        """
+        try:
+            return 4, int.from_bytes(
+                socket.inet_pton(socket.AF_INET, target), 'big')
+        except OSError:
+            ip = ipaddress.ip_address(target)
+            return ip.version, int(ip)
+
+    @staticmethod
+    def _runs(block):
+        """
+        :param block: sorted and unique addresses.
+        :return: `list` of tuples with the first and last address of each
+            run of consecutive addresses.
+        """
+        if numpy is not None and isinstance(block, numpy.ndarray):
+            breaks = numpy.flatnonzero(numpy.diff(block) != 1)
+            firsts = block[numpy.concatenate(([0], breaks + 1))]
+            lasts = block[numpy.concatenate((breaks, [len(block) - 1]))]
+            return list(zip(firsts.tolist(), lasts.tolist()))
+        runs = []
+        for address in block:
+            if runs and address == runs[-1][1] + 1:
+                runs[-1][1] = address
+            else:
+                runs.append([address, address])
+        return runs
+
+    def _ranges(self, blocks, version=4, covered=None):
+        """
+        :param blocks: iterable of blocks of sorted and unique `int`
+            addresses, each block starting after the previous one.
+        :param version: ip version of the addresses.
+        :param covered: `IntervalSet` of the addresses to drop.
+        :yield: tuple with the target, number of hosts and ip version.
+        """
+        factory = ipaddress.IPv4Address if version == 4 \
+            else ipaddress.IPv6Address
+        bits = 32 if version == 4 else 128
+        pieces = (piece for first, last in self._merge_runs(blocks, covered)
+                  for piece in self._pieces(first, last, bits))
+        if self.compact and version == 4:
+            yield from self._compact(pieces)
+            return
+        for first, last in pieces:
+            yield self._range(factory, bits, first, last)
+
+    @staticmethod
+    def _merge_runs(blocks, covered=None):
+        """
+        :param blocks: iterable of blocks of sorted and unique `int`
+            addresses, each block starting after the previous one.
+        :param covered: `IntervalSet` of the addresses to drop.
+        :yield: tuples with the first and last address of each run of
+            consecutive addresses.
+        """
+        first = last = None
+        for block in blocks:
+            if covered:
+                block = covered.uncovered(block)
+            if not len(block):
+                continue
+            for start, end in TargetOptimization._runs(block):
+                # a run may continue from the previous block.
+                if last is not None and start == last + 1:
+                    last = end
+                    continue
+                if last is not None:
+                    yield first, last
+                first, last = start, end
+        if last is not None:
+            yield first, last
+
+    def _compact(self, pieces):
+        """
+        Groups the pieces smaller than a /24 in nmap octet range
+        expressions like 10.0-3.1,5.1-254, that cover exactly the same
+        addresses, with up to max(`pack`, 256) hosts each.
+
+        :param pieces: iterable of tuples with the first and last ipv4
+            address of each piece.
+        :yield: tuple with the target, number of hosts and ip version.
+        """
+        window, items = None, {}
+        for first, last in pieces:
+            if last - first >= 0xff:
+                # networks of a /24 or bigger.
+                yield self._range(ipaddress.IPv4Address, 32, first, last)
+                continue
+            if first >> 24 != window:
+                yield from self._factor(window, items)
+                window, items = first >> 24, {}
+            items.setdefault(first >> 8, []).append((first & 0xff,
+                                                     last & 0xff))
+        yield from self._factor(window, items)
+
+    def _factor(self, octet, items):
+        """
+        Factors the hosts of a /8, the /24 with the same hosts are grouped
+        by the third octet, and then the groups with the same third octets
+        are grouped by the second octet.
+
+        :param octet: `int` first octet.
+        :param items: `dict` with the last octet intervals of each /24.
+        :yield: tuple with the target, number of hosts and ip version.
+        """
+        limit = max(self.pack, 256)
+        groups = {}
+        for prefix, spec in sorted(items.items()):
+            groups.setdefault((prefix >> 8 & 0xff, tuple(spec)),
+                              []).append(prefix & 0xff)
+        level = {}
+        for (second, spec), thirds in groups.items():
+            hosts = sum(hi - lo + 1 for lo, hi in spec)
+            for chunk in self._split(thirds, hosts, limit):
+                level.setdefault((chunk, spec), []).append(second)
+        expressions = []
+        for (thirds, spec), seconds in level.items():
+            hosts = len(thirds) * sum(hi - lo + 1 for lo, hi in spec)
+            for chunk in self._split(seconds, hosts, limit):
+                expressions.append((chunk, thirds, spec, hosts * len(chunk)))
+        for seconds, thirds, spec, size in sorted(expressions):
+            if len(seconds) == len(thirds) == len(spec) == 1:
+                first = octet << 24 | seconds[0] << 16 | thirds[0] << 8
+                yield self._range(ipaddress.IPv4Address, 32,
+                                  first | spec[0][0], first | spec[0][1])
+                continue
+            target = ".".join([str(octet), self._octets(seconds),
+                               self._octets(thirds),
+                               ",".join(f"{lo}-{hi}" if lo != hi else
+                                        f"{lo}" for lo, hi in spec)])
+            yield target, size, 4
+
+    @staticmethod
+    def _split(values, hosts, limit):
+        """
+        :return: `list` of tuples of values, with up to limit hosts each.
+        """
+        size = max(1, limit // hosts)
+        return [tuple(values[i:i + size]) for i in range(0, len(values),
+                                                         size)]
+
+    @staticmethod
+    def _octets(values):
+        """
+        :param values: sorted `int` octet values.
+        :return: `str` octet values in nmap format, like 0-3,7.
+        """
+        return format_ports(values)
+
+    @staticmethod
+    def _range(factory, bits, first, last):
+        """
+        :return: tuple with the target, number of hosts and ip version of
+            the range first-last.
+        """
+        size = last - first + 1
+        version = 4 if bits == 32 else 6
+        if version == 4:
+            start = socket.inet_ntoa(first.to_bytes(4, 'big'))
+        else:
+            start = str(factory(first))
+        # a range is a single network when the size is a power of two
+        # and the first address is aligned to it.
+        if size & (size - 1) == 0 and first % size == 0:
+            prefix = bits - size.bit_length() + 1
+            return f"{start}/{prefix}", size, version
+        if version == 4:
+            # if the number of ranges is more than one network in cidr
+            # format then the glob format x.x.x.x-y is more efficient,
+            # since nmap supports this format.
+            return f"{start}-{last & 0xff}", size, version
+        networks = ipaddress.summarize_address_range(factory(first),
+                                                     factory(last))
+        return " ".join(net.with_prefixlen for net in networks), size, version
+
+    def _pack(self, ranges):
+        """
+        Groups the ranges in tasks of up to `pack` hosts, or `pack6` for ipv6,
+        ranges bigger than that are left alone, and ipv4 and ipv6 are never
+        mixed.
+
+        :param ranges: iterable of tuples target, number of hosts and ip
+            version.
+        :yield: tuple with the packed targets, number of hosts and ip
+            version.
+        """
+        group, nhosts, gversion = [], 0, None
+        for target, size, version in ranges:
+            limit = self.pack if version == 4 else self.pack6
+            length = sum(map(len, group)) + len(group) + len(target)
+            if group and (nhosts + size > limit or version != gversion
+                          or 0 < self.max_length < length):
+                yield " ".join(group), nhosts, gversion
+                group, nhosts = [], 0
+            group.append(target)
+            nhosts += size
+            gversion = version
+        if group:
+            yield " ".join(group), nhosts, gversion
@@ -6,14 +6,33 @@ scanner.py
 scanner runtime models
 """
 
+import array
+import bisect
+import copy
 import hashlib
+import ipaddress
+import mmap
 import os
 import pickle
+import re
+import socket
+import struct
+import subprocess
 import threading
+import time
+import xml.etree.ElementTree as ElementTree
 import itertools
+from collections import Counter
 from enum import Enum
 from dscan import log
-from dscan.models.parsers import ReportsParser, TargetOptimization
+from dscan.models.parsers import ReportsParser, Resolver, TargetOptimization
+from dscan.models.parsers import parse_ports, format_ports
+from dscan.models.parsers import target_addresses
+from dscan.models.parsers import remaining_targets, salvage_report
+from dscan.models.journal import Journal, Op
+from dscan.models.snapshot import Kind, SnapshotError, SnapshotReader
+from dscan.models.snapshot import SnapshotWriter
+from dscan.models.snapshot import atomic_write
 from dscan.models.structures import Status, Report
 from dscan.out import Display
 from libnmap.process import NmapProcess
@@ -55,6 +74,13 @@ class Config:
             self.ciphers = config.get(*self.SSL_CERTS[0:4:3])
         else:
             self.host = options.s
+            self.agent_id = config.get('agent', 'id', fallback=None) or \
+                self.workspace_id()
+            self.retries = config.getint('agent', 'retries', fallback=30)
+            self.max_backoff = config.getint('agent', 'max-backoff',
+                                             fallback=300)
+            self.task_timeout = config.getint('agent', 'task-timeout',
+                                              fallback=0)
         # set cert properties
 
         self.sslcert = self.get_work_path(config.get(*self.SSL_CERTS[0:2:1]))
@@ -71,6 +97,16 @@ class Config:
             log.error(f"failed to open cert file {ex}")
             raise ex
 
+    def workspace_id(self):
+        """
+        :return: `str` id of the agent derived from the host and its reports
+            directory, the same every time the agent starts.
+        """
+        hostname = socket.gethostname()[:64]
+        digest = hashlib.sha1(f"{hostname}:{os.path.abspath(self.outdir)}"
+                              .encode("utf-8")).hexdigest()
+        return f"{hostname}-{digest[:12]}"
+
     def get_work_path(self, path):
         return os.path.join(self.wspace, path)
 
@@ -108,6 +144,44 @@ class ServerConfig:
         self.resume_path = os.path.join(
             options.name, config.get(*self.SERVER[0:5:4]))
         self.host = options.b
+        self.port_ranking = config.getboolean(self.SERVER[0], 'port-ranking',
+                                              fallback=False)
+        self.dead_threshold = config.getint(self.SERVER[0],
+                                            'dead-host-threshold', fallback=0)
+        self.live_pack = config.getint(self.SERVER[0], 'live-pack',
+                                       fallback=0)
+        self.ipv6_pack = config.getint(self.SERVER[0], 'ipv6-pack',
+                                       fallback=16)
+        # packed targets fit in the `Command` of the legacy agents.
+        self.pack_length = config.getint(self.SERVER[0], 'pack-length',
+                                         fallback=255)
+        self.octet_ranges = config.getboolean(self.SERVER[0], 'octet-ranges',
+                                              fallback=False)
+        self.sort_chunk = config.getint(self.SERVER[0], 'sort-chunk-size',
+                                        fallback=1000000)
+        self.resolver = Resolver(
+            os.path.join(self.rundir, 'resolve.cache'),
+            config.getint(self.SERVER[0], 'resolve-ttl', fallback=86400),
+            config.getint(self.SERVER[0], 'resolve-workers', fallback=16))
+        self.hosts_path = os.path.join(self.rundir, 'hostnames.map')
+        self.inbox_path = os.path.join(
+            options.name, config.get(self.SERVER[0], 'inbox',
+                                     fallback='inbox.txt'))
+        self.inbox_interval = config.getint(self.SERVER[0], 'inbox-interval',
+                                            fallback=5)
+        self.drain_path = os.path.join(
+            options.name, config.get(self.SERVER[0], 'drain',
+                                     fallback='drain'))
+        self.drain_timeout = config.getint(self.SERVER[0], 'drain-timeout',
+                                           fallback=3600)
+        self.excluded = []
+        self.journal_size = config.getint(self.SERVER[0], 'journal-size',
+                                          fallback=100000)
+        self.lease_grace = config.getint(self.SERVER[0], 'lease-grace',
+                                         fallback=3600)
+        self.journal_path = None
+        if self.journal_size > 0:
+            self.journal_path = os.path.join(self.rundir, 'current.journal')
         os.makedirs(self.rundir, exist_ok=True)
         # init scan stages !
         self.__create_stages(dict(config.items('nmap-scan')))
@@ -119,24 +193,74 @@ class ServerConfig:
             if name == "discovery":
                 self.stage_list.append(DiscoveryStage(self.queue_path,
                                                       options, self.outdir,
-                                                      self.ltargets_path))
+                                                      self.ltargets_path,
+                                                      self.live_pack,
+                                                      self.ipv6_pack,
+                                                      self.pack_length))
             else:
                 self.stage_list.append(Stage(name, self.ltargets_path,
                                              options, self.outdir))
 
-    def target_optimization(self, targets):
+    def target_optimization(self, targets, exclude=None):
         """
         Takes a list of ip Addresses and groups all sequential ips in
         cidr notation.
 
-        :param targets: `list` of `str`
-        :type: `list` of `str`
+        :param targets: iterable of `str`, like the open targets file.
+        :param exclude: optional iterable of `str` targets never to scan.
+        :type: iterable of `str`
         """
         assert targets, "Empty target list"
-        if not os.path.isfile(self.resume_path):
-            queue_optimization = TargetOptimization(self.queue_path)
+        if exclude:
+            # kept for the targets added to the running scan.
+            self.excluded = list(exclude)
+        journal = self.journal_path and os.path.isfile(self.journal_path)
+        if not os.path.isfile(self.resume_path) and not journal:
+            queue_optimization = self.__optimization(self.queue_path)
+            queue_optimization.exclude(self.excluded)
             queue_optimization.save(targets)
 
+    def __optimization(self, path):
+        return TargetOptimization(
+            path, chunk_size=self.sort_chunk, resolver=self.resolver,
+            hosts_path=self.hosts_path, pack6=self.ipv6_pack,
+            max_length=self.pack_length, compact=self.octet_ranges)
+
+    def ingest(self, ctx):
+        """
+        Adds the targets of the inbox file to the running scan, the file is
+        claimed by renaming it, and its targets are optimized without the
+        excluded targets and the targets already in the stages.
+
+        :param ctx: running `Context`.
+        :return: `list` of `str` targets added.
+        """
+        claimed = f"{self.inbox_path}.ingest"
+        if not os.path.isfile(claimed):
+            if not os.path.isfile(self.inbox_path) or \
+                    os.stat(self.inbox_path).st_size == 0:
+                return []
+            os.replace(self.inbox_path, claimed)
+        work_path = os.path.join(self.rundir, 'inbox.work')
+        optimization = self.__optimization(work_path)
+        optimization.exclude(self.excluded)
+        for path in ctx.targets_paths():
+            if os.path.isfile(path):
+                with open(path, 'rt') as tfile:
+                    optimization.exclude(tfile)
+        with open(claimed, 'rt') as cfile:
+            optimization.save(cfile, append=True)
+        with open(work_path, 'rt') as wfile:
+            lines = [line.strip() for line in wfile if line.strip()]
+        if lines:
+            stages = ctx.add_targets(lines)
+            if stages:
+                log.info(f"Added {len(lines)} targets to {', '.join(stages)}")
+            else:
+                log.warning(f"No stages left to scan {len(lines)} targets")
+        os.remove(claimed)
+        return lines
+
     def save_context(self, ctx):
         """
         Serializes the context to resume later.
@@ -144,9 +268,172 @@ class ServerConfig:
         :param ctx: instance of `Context`
         :type ctx: `Context`
         """
+        if ctx.journal:
+            ctx.checkpoint()
+            return
         log.info(f"Saving the current context {self.resume_path}")
-        with open(self.resume_path, 'wb') as rfile:
-            pickle.dump(ctx, rfile)
+        atomic_write(self.resume_path, ctx.save)
+
+
+class LineIndex:
+    """
+    Offsets of the lines of a file, built once and saved next to it in
+    `<path>.idx`, the saved index is memory mapped when loaded, and rebuilt
+    if the file was changed.
+    Each line has a record with its offset and the number of tasks before
+    it, lines have a single task unless weighted otherwise.
+    """
+    EXT = ".idx"
+    MAGIC = b"DSIDX\x00\x00\x01"
+    # magic, file size, file mtime, weight key, number of lines and tasks.
+    HEADER = struct.Struct("<8sQQQQQ")
+    RECORD = struct.Struct("<QQ")
+
+    def __init__(self, path, weight=None, key=0):
+        """
+        :param path: path of the indexed file.
+        :param weight: optional function that returns the number of tasks
+            of a line.
+        :param key: `int` that identifies the weight function, an index
+            built with a different key is rebuilt.
+        """
+        self.path = path
+        self.index_path = f"{path}{self.EXT}"
+        self.weight = weight
+        self.key = key
+        self.nlines = 0
+        self.ntasks = 0
+        self.records = None
+        self._index = None
+        self._data = None
+
+    def _stat(self):
+        stat = os.stat(self.path)
+        return stat.st_size, stat.st_mtime_ns
+
+    def load(self):
+        """
+        Memory maps the saved index, if its up to date.
+
+        :return: `True` if the index was loaded.
+        """
+        try:
+            with open(self.index_path, 'rb') as ifile:
+                header = ifile.read(self.HEADER.size)
+                if len(header) != self.HEADER.size:
+                    return False
+                magic, size, mtime, key, nlines, ntasks = \
+                    self.HEADER.unpack(header)
+                if magic != self.MAGIC or key != self.key or \
+                        (size, mtime) != self._stat():
+                    return False
+                index = mmap.mmap(ifile.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return False
+        if len(index) != self.HEADER.size + nlines * self.RECORD.size:
+            index.close()
+            return False
+        self.close()
+        self._index = index
+        self.records = memoryview(index)[self.HEADER.size:].cast('Q')
+        self.nlines, self.ntasks = nlines, ntasks
+        return True
+
+    def build(self):
+        """
+        Reads the file once to build the index, and saves it.
+        """
+        records = array.array('Q')
+        offset = tasks = 0
+        size, mtime = self._stat()
+        with open(self.path, 'rb') as dfile:
+            for line in dfile:
+                records.append(offset)
+                records.append(tasks)
+                offset += len(line)
+                if self.weight:
+                    tasks += self.weight(line.decode("ascii").strip())
+                else:
+                    tasks += 1
+        self.close()
+        self.records = records
+        self.nlines, self.ntasks = len(records) // 2, tasks
+        try:
+            with open(self.index_path, 'wb') as ifile:
+                ifile.write(self.HEADER.pack(self.MAGIC, size, mtime,
+                                             self.key, self.nlines, tasks))
+                records.tofile(ifile)
+        except OSError as ex:
+            log.warning(f"Unable to save the index {self.index_path}: {ex}")
+
+    def offset(self, n):
+        """
+        :param n: line number starting at 0.
+        :return: `int` offset of the line.
+        """
+        return self.records[n * 2]
+
+    def first_task(self, n):
+        """
+        :param n: line number starting at 0.
+        :return: `int` number of tasks before the line.
+        """
+        return self.records[n * 2 + 1]
+
+    def find(self, task):
+        """
+        :param task: task number starting at 0.
+        :return: `int` number of the line with the task.
+        """
+        return bisect.bisect_right(_Column(self, 1), task) - 1
+
+    def line(self, n):
+        """
+        Reads a line without moving the position of any open file object,
+        the indexed file is memory mapped so it can be shared by several
+        readers.
+
+        :param n: line number starting at 0.
+        :return: `str` the line or None if out of range.
+        """
+        if not 0 <= n < self.nlines:
+            return None
+        if self._data is None:
+            with open(self.path, 'rb') as dfile:
+                self._data = mmap.mmap(dfile.fileno(), 0,
+                                       access=mmap.ACCESS_READ)
+        start = self.offset(n)
+        end = self.offset(n + 1) if n + 1 < self.nlines else len(self._data)
+        return self._data[start:end].decode("ascii").strip()
+
+    def __len__(self):
+        return self.nlines
+
+    def close(self):
+        if isinstance(self.records, memoryview):
+            self.records.release()
+        self.records = None
+        for mapped in (self._index, self._data):
+            if mapped is not None:
+                mapped.close()
+        self._index = self._data = None
+
+
+class _Column:
+    """
+    Read only sequence of one of the columns of a `LineIndex`, used to
+    binary search the records.
+    """
+
+    def __init__(self, index, column):
+        self.index = index
+        self.column = column
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, n):
+        return self.index.records[n * 2 + self.column]
 
 
 class File:
@@ -162,6 +449,7 @@ class File:
         """
         self._path = path
         self._fd = None
+        self._index = None
         self.nlines = 0
         self.lineno = 0
         self.loc = 0
@@ -214,24 +502,71 @@ class File:
 
     def _line_count(self):
         """
-        Counts the number of lines in the file.
+        Counts the number of lines in the file, with the index of its lines
+        saved next to it, the index is built only the first time.
         """
         if self.isempty():
             return 0
+        self._load_index()
+        self.nlines = self._index.ntasks
 
-        lines = 0
-        buf_size = 1024 * 1024
-        read_f = self.read  # loop optimization
-        buf = read_f(buf_size)
+    def _line_index(self):
+        """
+        :return: `LineIndex` of the file.
+        """
+        return LineIndex(self._path)
 
-        while buf:
-            lines += buf.count('\n')
-            if not buf.endswith('\n'):
-                lines += 1
-            buf = read_f(buf_size)
+    def _load_index(self):
+        self._index = self._line_index()
+        if not self._index.load():
+            self._index.build()
 
-        self.nlines = lines
-        self._fd.seek(0)
+    @property
+    def index(self):
+        """
+        :return: `LineIndex` of the file, loaded on demand.
+        """
+        if self._index is None:
+            self._load_index()
+        return self._index
+
+    def line(self, n):
+        """
+        Random access to a line, the file position is not changed.
+
+        :param n: line number starting at 0.
+        :return: `str` the line or None if out of range.
+        """
+        return self.index.line(n)
+
+    def append(self, lines):
+        """
+        Appends lines at the end of the file, an open file keeps its
+        position and reads them after the lines it had.
+
+        :param lines: iterable of `str` lines without the line break.
+        """
+        with open(self._path, 'a') as afile:
+            for line in lines:
+                afile.write(f"{line}\n")
+        self.refresh()
+
+    def refresh(self):
+        """
+        Updates the number of lines of a file changed by someone else,
+        files that were not opened yet are counted when opened.
+        """
+        if self._fd or self._index is not None:
+            if self._index is not None:
+                self._index.close()
+            self._load_index()
+            self.nlines = self._index.ntasks
+
+    def close(self):
+        if self._fd:
+            self._fd.close()
+        if self._index is not None:
+            self._index.close()
 
     def __getattr__(self, name):
         if hasattr(self._fd, name):
@@ -239,6 +574,29 @@ class File:
         else:
             raise AttributeError(f"invalid key {name}")
 
+    def as_record(self):
+        """
+        :return: `dict` with the state of the file, saved in the snapshots.
+        """
+        log.info(f"saving file: {self._path} loc:{self.loc} state")
+        state = self.__dict__.copy()
+        del state['_fd']
+        del state['_index']
+        return state
+
+    @classmethod
+    def from_record(cls, record):
+        """
+        Restores a file saved with `as_record`, the attributes missing in
+        older snapshots keep their defaults.
+
+        :param record: `dict` with the state of the file.
+        :return: instance of the file class.
+        """
+        fobj = cls(record['_path'])
+        fobj.__setstate__({**fobj.__dict__, **record})
+        return fobj
+
     def __getstate__(self):
         # Copy the object's state from self.__dict__ which contains
         # all our instance attributes. Always use the dict.copy()
@@ -247,11 +605,14 @@ class File:
         state = self.__dict__.copy()
         # Remove the unpickable entries.
         del state['_fd']
+        state['_index'] = None
         return state
 
     def __setstate__(self, state):
         # Restore instance attributes (i.e., _path and nlines ...).
         self.__dict__.update(state)
+        # files pickled by older versions have no line index.
+        self._index = None
         fd = None
         # if the loc is 0 then we have an uninitialized stage
         # that depends on unfinished stage, will be opened when the first
@@ -274,6 +635,100 @@ class File:
                f"{self.lineno}, mode:{self.mode})"
 
 
+class WorkQueue(File):
+    """
+    Work queue of a stage, a `File` of targets where the networks bigger
+    than the split prefix are kept in a single line, and split in tasks
+    when pulled, the task n of a network is computed from its address.
+    """
+
+    def __init__(self, path, prefix=24, prefix6=120):
+        """
+        :param path: string of path to the file to open.
+        :param prefix: networks with a smaller prefix are split in networks
+            of this prefix.
+        :param prefix6: the same for ipv6 networks.
+        """
+        super().__init__(path)
+        self.prefix = prefix
+        self.prefix6 = prefix6
+        # network being split, and the number of its tasks already pulled.
+        self.network = None
+        self.subno = 0
+        # number of tasks pulled.
+        self.position = 0
+
+    def tasks(self, line):
+        """
+        :param line: `str` line of the work file.
+        :return: number of tasks of the line.
+        :rtype: `int`
+        """
+        if not line:
+            return 0
+        _, sep, prefix = line.partition("/")
+        if not sep or not prefix.strip().isdigit():
+            return 1
+        prefix, split = int(prefix), self.split_prefix(line)
+        if prefix >= split:
+            return 1
+        return 1 << (split - prefix)
+
+    def split_prefix(self, network):
+        """
+        :param network: `str` network.
+        :return: `int` prefix of the networks it's split in.
+        """
+        return self.prefix6 if ":" in network else self.prefix
+
+    def subnet(self, network, n):
+        """
+        :param network: `str` network to split.
+        :param n: index of the task.
+        :return: `str` the nth network of the split.
+        """
+        net = ipaddress.ip_network(network)
+        prefix = self.split_prefix(network)
+        size = 1 << (net.max_prefixlen - prefix)
+        first = int(net.network_address) + n * size
+        return ipaddress.ip_network((first, prefix)).with_prefixlen
+
+    def readline(self):
+        if self.network is not None:
+            if self.subno < self.tasks(self.network):
+                self.subno += 1
+                self.position += 1
+                return self.subnet(self.network, self.subno - 1)
+            self.network, self.subno = None, 0
+        line = super().readline()
+        if line:
+            self.position += 1
+        if line and self.tasks(line) > 1:
+            self.network, self.subno = line, 1
+            return self.subnet(line, 0)
+        return line
+
+    def _line_index(self):
+        return LineIndex(self._path, self.tasks,
+                         self.prefix | self.prefix6 << 8)
+
+    def task(self, n):
+        """
+        Random access to a task, the position of the queue is not changed.
+
+        :param n: task number starting at 0.
+        :return: `str` target of the task or None if out of range.
+        """
+        index = self.index
+        if not 0 <= n < index.ntasks:
+            return None
+        lineno = index.find(n)
+        line = index.line(lineno)
+        if self.tasks(line) > 1:
+            return self.subnet(line, n - index.first_task(lineno))
+        return line
+
+
 class STATUS(Enum):
     """
     Each Scan task has the following states:
@@ -306,24 +761,61 @@ class Task:
     - Completed: Set only after the report has been received successfully.
     """
 
-    def __init__(self, stage_name, options, target):
+    def __init__(self, stage_name, options, target, index=None):
         """
         :param stage_name: stage name
         :param options: scan options.
         :param target: target ip address.
+        :param index: position of the target in the stage work queue.
         :type stage_name: `str`
         :type options: `str`
         :type target: `str`
+        :type index: `int`
         """
         self.stage_name = stage_name
         self.options = options
         self.target = target
+        self.index = index
         self.status = STATUS.SCHEDULED
+        self.report = None
+        # number of times the task was interrupted.
+        self.attempts = 0
+        # the target is what was left of the target at index when the task
+        # was interrupted.
+        self.remainder = False
 
     def update(self, status):
         assert isinstance(status, STATUS)
         self.status = status
 
+    def __setstate__(self, state):
+        # tasks pickled by older versions have no position nor attempts.
+        self.__dict__.update({"index": None, "report": None, "attempts": 0,
+                              "remainder": False, **state})
+
+    def as_record(self):
+        """
+        :return: `dict` with the task, saved in the snapshots.
+        """
+        return {"stage_name": self.stage_name, "options": self.options,
+                "target": self.target, "index": self.index,
+                "status": self.status.name, "report": self.report,
+                "attempts": self.attempts, "remainder": self.remainder}
+
+    @classmethod
+    def from_record(cls, record):
+        """
+        :param record: `dict` saved with `as_record`.
+        :return: instance of `Task`
+        """
+        task = cls(record["stage_name"], record["options"], record["target"],
+                   record.get("index"))
+        task.status = STATUS[record.get("status", STATUS.INTERRUPTED.name)]
+        task.report = record.get("report")
+        task.attempts = record.get("attempts", 0)
+        task.remainder = record.get("remainder", False)
+        return task
+
     def as_tuple(self):
         """
         returns a tuple with the target and scan options.
@@ -339,33 +831,600 @@ class Task:
                f"{self.options}"
 
 
+class TaskTable:
+    """
+    Columnar queue of tasks, a task is a row of typed arrays with its
+    stage, the position of its target in the stage work queue, its status
+    and number of attempts, the stage names and options are interned.
+    Rows are identified by an increasing task id, the rows already taken
+    are dropped in bulk.
+    The target is read back from the work queue, only the tasks without a
+    position and the remainders of interrupted tasks keep their target.
+    """
+    # rows taken before they are dropped.
+    DISCARD = 4096
+
+    def __init__(self):
+        self.stages = array.array('H')
+        self.positions = array.array('Q')
+        self.statuses = array.array('B')
+        self.attempts = array.array('H')
+        self.options = array.array('H')
+        # interned stage names and options, value -> id, and id -> value.
+        self.names = {}
+        self.option_sets = {}
+        self.values = {}
+        # targets of the tasks without a position, task id -> target.
+        self.targets = {}
+        # targets left of interrupted tasks, task id -> target.
+        self.remainders = {}
+        # id of the first row kept, and of the next task to take.
+        self.first = 0
+        self.head = 0
+
+    def _intern(self, values, value):
+        vid = values.get(value)
+        if vid is None:
+            vid = values[value] = len(values)
+            self.values[id(values), vid] = value
+        return vid
+
+    def add(self, task):
+        """
+        :param task: `Task` to add at the end.
+        :return: `int` id of the task.
+        """
+        tid = self.first + len(self.stages)
+        self.stages.append(self._intern(self.names, task.stage_name))
+        self.options.append(self._intern(self.option_sets, task.options))
+        self.statuses.append(task.status.value)
+        self.attempts.append(min(task.attempts, 0xffff))
+        if task.index is None:
+            self.positions.append(0)
+            self.targets[tid] = task.target
+        else:
+            self.positions.append(task.index)
+            if task.remainder:
+                self.remainders[tid] = task.target
+        return tid
+
+    def task(self, tid, lookup):
+        """
+        :param tid: `int` id of the task.
+        :param lookup: function that returns the target of a stage name and
+            position.
+        :return: instance of `Task`
+        """
+        row = tid - self.first
+        name = self.values[id(self.names), self.stages[row]]
+        options = self.values[id(self.option_sets), self.options[row]]
+        if tid in self.targets:
+            task = Task(name, options, self.targets[tid])
+        elif tid in self.remainders:
+            task = Task(name, options, self.remainders[tid],
+                        self.positions[row])
+            task.remainder = True
+        else:
+            position = self.positions[row]
+            task = Task(name, options, lookup(name, position), position)
+        task.status = STATUS(self.statuses[row])
+        task.attempts = self.attempts[row]
+        return task
+
+    def popleft(self, lookup):
+        """
+        :param lookup: see `task`.
+        :return: the first `Task`.
+        """
+        if not len(self):
+            raise IndexError("pop from an empty task table")
+        task = self.task(self.head, lookup)
+        self.head += 1
+        if self.head - self.first >= self.DISCARD:
+            self._discard()
+        return task
+
+    def _discard(self):
+        count = self.head - self.first
+        for column in (self.stages, self.positions, self.statuses,
+                       self.attempts, self.options):
+            del column[:count]
+        for tid in range(self.first, self.head):
+            self.targets.pop(tid, None)
+            self.remainders.pop(tid, None)
+        self.first = self.head
+
+    def tasks(self, lookup):
+        """
+        :param lookup: see `task`.
+        :yield: the `Task`s not taken yet.
+        """
+        for tid in range(self.head, self.first + len(self.stages)):
+            yield self.task(tid, lookup)
+
+    def __len__(self):
+        return self.first + len(self.stages) - self.head
+
+
+class PendingTasks:
+    """
+    Tasks waiting to be sent again, in the order they were added, kept in a
+    `TaskTable`.
+    The tasks of a resumed snapshot are left in its file and read in pages
+    when needed, before the tasks added after.
+    """
+    PAGE = 1024
+
+    def __init__(self, reader=None, remaining=0, lookup=None):
+        """
+        :param reader: `SnapshotReader` positioned on the first task record.
+        :param remaining: number of task records left in the snapshot.
+        :param lookup: function that returns the target of a stage name and
+            position, see `TaskTable.task`.
+        """
+        self.reader = reader
+        self.offset = reader.tell() if reader else 0
+        self.remaining = remaining
+        self.lookup = lookup
+        # page of the snapshot tasks, and the tasks added after.
+        self.loaded = TaskTable()
+        self.table = TaskTable()
+        if reader and not remaining:
+            self._close()
+
+    def _close(self):
+        if self.reader:
+            self.reader.close()
+            self.reader = None
+
+    def _records(self, count):
+        """
+        :param count: number of task records to read from the snapshot.
+        :yield: `Task` saved in the snapshot.
+        """
+        self.reader.seek(self.offset)
+        for _ in range(count):
+            record = self.reader.read()
+            if record is None:
+                break
+            kind, payload = record
+            if kind == Kind.TASK:
+                yield Task.from_record(payload)
+
+    def _page(self):
+        count = min(self.remaining, self.PAGE)
+        self.loaded = TaskTable()
+        for task in self._records(count):
+            self.loaded.add(task)
+        self.offset = self.reader.tell()
+        self.remaining -= count
+        if not self.remaining:
+            self._close()
+
+    def _target(self, name, position):
+        return self.lookup(name, position) if self.lookup else None
+
+    def append(self, task):
+        self.table.add(task)
+
+    def pop(self, index=0):
+        """
+        :param index: only the first task can be taken, kept for `list`
+            compatibility.
+        :return: the first `Task`.
+        """
+        assert index == 0, "Only the first pending task can be taken"
+        if not self.loaded and self.remaining:
+            self._page()
+        if self.loaded:
+            return self.loaded.popleft(self._target)
+        return self.table.popleft(self._target)
+
+    def __iter__(self):
+        yield from self.loaded.tasks(self._target)
+        if self.remaining:
+            yield from self._records(self.remaining)
+        yield from self.table.tasks(self._target)
+
+    def __len__(self):
+        return len(self.loaded) + self.remaining + len(self.table)
+
+
+class PortStatistics:
+    """
+    Running statistics of the open ports found in the completed reports,
+    kept globally and per network.
+    Used to reorder the ports of the stages that have not started yet, so
+    the ports with higher yield are probed first.
+    """
+
+    def __init__(self, prefix=24, prefix6=64):
+        """
+        :param prefix: prefix length used to group ipv4 hosts in networks.
+        :param prefix6: prefix length used to group ipv6 hosts in networks.
+        """
+        self.prefix = prefix
+        self.prefix6 = prefix6
+        self.hits = Counter()
+        self.networks = {}
+
+    def as_record(self):
+        """
+        :return: `dict` with the statistics, saved in the snapshots.
+        """
+        return {"prefix": self.prefix, "prefix6": self.prefix6,
+                "hits": list(self.hits.items()),
+                "networks": {net: list(hits.items())
+                             for net, hits in self.networks.items()}}
+
+    @classmethod
+    def from_record(cls, record):
+        """
+        :param record: `dict` saved with `as_record`.
+        :return: instance of `PortStatistics`
+        """
+        stats = cls(record.get("prefix", 24), record.get("prefix6", 64))
+        stats.hits = Counter(dict(record.get("hits", [])))
+        stats.networks = {net: Counter(dict(hits)) for net, hits in
+                          record.get("networks", {}).items()}
+        return stats
+
+    def network(self, address):
+        """
+        :param address: `str` ip address.
+        :return: `str` network the address belongs to.
+        """
+        ip = ipaddress.ip_address(address)
+        prefix = self.prefix if ip.version == 4 else self.prefix6
+        return ipaddress.ip_network(f"{ip}/{prefix}",
+                                    strict=False).with_prefixlen
+
+    def update(self, results):
+        """
+        :param results: iterable of tuples with address and open port.
+        """
+        for address, port in results:
+            self.hits[port] += 1
+            net = self.network(address)
+            self.networks.setdefault(net, Counter())[port] += 1
+
+    def breadth(self, port):
+        """
+        :return: `int` number of networks with the port open.
+        """
+        return sum(1 for hits in self.networks.values() if port in hits)
+
+    def ranking(self, ports):
+        """
+        Sorts the ports by yield, the number of networks where the port was
+        found open prevails over the total number of hits, so a single
+        network full of identical hosts does not dominate the ranking.
+        Ports with no hits keep their original order.
+
+        :param ports: `list` of `int` ports.
+        :return: `list` of `int` ports sorted by yield.
+        """
+        breadth = {port: self.breadth(port) for port in ports
+                   if port in self.hits}
+        return [port for _, port in sorted(
+            enumerate(ports), key=lambda item: (-breadth.get(item[1], 0),
+                                                -self.hits[item[1]],
+                                                item[0]))]
+
+    def rebalance(self, stages):
+        """
+        Redistributes the ports of the given stages, the ones with higher
+        yield are moved to the first stages, each stage keeps its number of
+        ports.
+
+        :param stages: `list` of `Stage` that have not started yet.
+        """
+        pstages = [stage for stage in stages if stage.ports]
+        if not pstages or not self.hits:
+            return
+        sizes = [len(stage.ports) for stage in pstages]
+        ports = list(dict.fromkeys(port for stage in pstages
+                                   for port in stage.ports))
+        if len(ports) != sum(sizes):
+            log.info("Stages share ports, skipping the port rebalance")
+            return
+        ranked = self.ranking(ports)
+        options = []
+        start = 0
+        for stage, size in zip(pstages, sizes):
+            options.append(stage.port_options(ranked[start:start + size]))
+            start += size
+        if None in options:
+            log.info("Ranked port lists are too long, skipping the port "
+                     "rebalance")
+            return
+        for stage, stage_options in zip(pstages, options):
+            if stage_options != stage.options:
+                log.info(f"Stage {stage.name} options set to "
+                         f"{stage_options}")
+                stage.options = stage_options
+
+
+class LiveSet:
+    """
+    Refines the list of live targets between port stages.
+    Each finished port stage reports which hosts seem dead, after being
+    seen dead by `threshold` stages in a row, a host is removed from the
+    live targets of the stages that did not start yet.
+    """
+
+    def __init__(self, ltargets_path, threshold, pack=0, pack6=None,
+                 max_length=0):
+        """
+        :param ltargets_path: path of the live targets produced by the
+            discovery.
+        :param threshold: number of stages in a row a host must be seen dead
+            to be dropped.
+        :param pack: number of hosts packed in each task, see
+            `TargetOptimization`.
+        :param pack6: number of ipv6 hosts packed in each task.
+        :param max_length: max length of a packed task, 0 for no limit.
+        """
+        self.ltargets_path = ltargets_path
+        self.threshold = threshold
+        self.pack = pack
+        self.pack6 = pack6
+        self.max_length = max_length
+        self.misses = Counter()
+        self.dead = set()
+
+    def as_record(self):
+        """
+        :return: `dict` with the live set, saved in the snapshots.
+        """
+        return {"ltargets_path": self.ltargets_path,
+                "threshold": self.threshold, "pack": self.pack,
+                "pack6": self.pack6, "max_length": self.max_length,
+                "misses": dict(self.misses),
+                "dead": sorted(self.dead)}
+
+    @classmethod
+    def from_record(cls, record):
+        """
+        :param record: `dict` saved with `as_record`.
+        :return: instance of `LiveSet`
+        """
+        live_set = cls(record["ltargets_path"], record["threshold"],
+                       record.get("pack", 0), record.get("pack6"),
+                       record.get("max_length", 0))
+        live_set.misses = Counter(record.get("misses", {}))
+        live_set.dead = set(record.get("dead", []))
+        return live_set
+
+    def refine(self, stage):
+        """
+        Collects the hosts status from the stage reports and publishes a
+        refined live targets file if new dead hosts were found.
+
+        :param stage: finished `Stage`.
+        :return: path of the refined live targets, or None if there is no
+            change.
+        :rtype: `str`
+        """
+        ndead = len(self.dead)
+        results = ReportsParser(stage.reports_path, f"{stage.name}-*.xml")
+        for address, alive in results.hosts_status():
+            if alive:
+                self.misses.pop(address, None)
+                continue
+            self.misses[address] += 1
+            if self.misses[address] >= self.threshold:
+                self.dead.add(address)
+
+        if len(self.dead) == ndead:
+            return None
+
+        base, ext = os.path.splitext(self.ltargets_path)
+        path = f"{base}-{stage.name}{ext}"
+        log.info(f"Stage {stage.name} dropped {len(self.dead) - ndead} dead "
+                 f"hosts, publishing {path}")
+        with open(stage.targets_path, 'rt') as targets:
+            # the addresses are streamed to the external sort.
+            hosts = (address for line in targets
+                     for address in target_addresses(line)
+                     if address not in self.dead)
+            TargetOptimization(path, pack=self.pack, pack6=self.pack6,
+                               max_length=self.max_length).save(hosts)
+        return path
+
+
+class Bitmap:
+    """
+    Set of positions of a work queue, stored with one bit each.
+    """
+    __slots__ = ('bits', 'count')
+
+    def __init__(self):
+        self.bits = bytearray()
+        self.count = 0
+
+    def add(self, n):
+        """
+        :param n: `int` position to add.
+        :return: `True` if the position was not in the set.
+        """
+        byte, bit = divmod(n, 8)
+        if byte >= len(self.bits):
+            self.bits.extend(bytes(byte - len(self.bits) + 1))
+        if self.bits[byte] & (1 << bit):
+            return False
+        self.bits[byte] |= 1 << bit
+        self.count += 1
+        return True
+
+    def __contains__(self, n):
+        byte, bit = divmod(n, 8)
+        return byte < len(self.bits) and bool(self.bits[byte] & (1 << bit))
+
+    def __len__(self):
+        return self.count
+
+    @classmethod
+    def frombytes(cls, bits, count):
+        """
+        :param bits: `bytes` of the bitmap.
+        :param count: `int` number of positions set.
+        :return: instance of `Bitmap`
+        """
+        bitmap = cls()
+        bitmap.bits = bytearray(bits)
+        bitmap.count = count
+        return bitmap
+
+    def __getstate__(self):
+        return bytes(self.bits), self.count
+
+    def __setstate__(self, state):
+        bits, self.count = state
+        self.bits = bytearray(bits)
+
+
 class Stage:
+    PORTS = re.compile(r'(?<!\S)(-p\s*)(\S+)')
+    # longest scan options, to fit in the legacy `Command`.
+    MAX_OPTIONS = 255
+    IPV6 = re.compile(r'(?<!\S)-6(?!\S)')
 
     def __init__(self, stage_name, targets_path, options, outdir):
         assert targets_path, "Invalid targets file Name"
         assert stage_name, "Invalid stage Name"
         self.targets_path = targets_path
         self.name = stage_name
-        self.targets = File(self.targets_path)
+        self.targets = WorkQueue(self.targets_path)
         self.options = options
         self.reports_path = outdir
         self.ftargets = 0
+        # positions of the work queue already completed.
+        self.completion = Bitmap()
 
     def next_task(self):
         """
-        Get next target from the file.
+        Get next target from the file, targets completed before are skipped.
 
         :return: Task.
         :rtype: `Task`
         """
         target = self.targets.readline()
+        while target and self.targets.position - 1 in self.completion:
+            target = self.targets.readline()
         if target:
-            return Task(self.name, self.options, target)
+            return Task(self.name, self.task_options(target), target,
+                        self.targets.position - 1)
         else:
             return None
 
-    def inc_finished(self):
+    def task_options(self, target):
+        """
+        :param target: `str` target of the task.
+        :return: `str` the scan options of the target, ipv6 targets are
+            scanned with `-6`.
+        """
+        if ":" in target and not self.IPV6.search(self.options):
+            return f"{self.options} -6"
+        return self.options
+
+    def complete(self, index):
+        """
+        Marks the target in the index position of the work queue as
+        completed, a target completed more than once is counted once.
+
+        :param index: `int` position of the target, or None if unknown.
+        :return: `True` if it was not completed before.
+        """
+        if index is not None and not self.completion.add(index):
+            return False
         self.ftargets += 1
+        return True
+
+    def iscompleted(self, index):
+        """
+        :param index: `int` position of the target in the work queue, or
+            None if unknown.
+        :return: `True` if the target was completed.
+        """
+        return index is not None and index in self.completion
+
+    def as_record(self):
+        """
+        :return: `dict` with the state of the stage saved in the snapshots,
+            the completion bitmap is saved in its own record.
+        """
+        state = {key: value for key, value in self.__dict__.items()
+                 if key not in ('targets', 'completion')}
+        state['class'] = type(self).__name__
+        state['targets'] = self.targets.as_record()
+        state['completed'] = len(self.completion)
+        return state
+
+    @classmethod
+    def from_record(cls, record):
+        """
+        :param record: `dict` saved with `as_record`.
+        :return: instance of the `Stage` class saved, with an empty
+            completion bitmap.
+        """
+        classes = {stage.__name__: stage
+                   for stage in (cls, *cls.__subclasses__())}
+        record = dict(record)
+        stage = object.__new__(classes[record.pop('class', cls.__name__)])
+        record['targets'] = WorkQueue.from_record(record['targets'])
+        record.pop('completed', None)
+        # the attributes missing in older snapshots keep their defaults.
+        stage.__setstate__(record)
+        stage.completion = Bitmap()
+        return stage
+
+    def __setstate__(self, state):
+        # stages pickled by older versions read a target per line of a
+        # plain `File`, and have no completion bitmap.
+        self.__dict__.update(state)
+        if not isinstance(self.targets, WorkQueue):
+            record = self.targets.as_record()
+            self.targets.close()
+            record.setdefault('position', record['lineno'])
+            self.targets = WorkQueue.from_record(record)
+        self.__dict__.setdefault('completion', Bitmap())
+
+    def retarget(self, targets_path):
+        """
+        Replaces the targets file of a stage that did not start yet.
+
+        :param targets_path: path to the new targets file.
+        """
+        self.targets_path = targets_path
+        self.targets = WorkQueue(self.targets_path)
+        self.completion = Bitmap()
+
+    @property
+    def ports(self):
+        """
+        :return: `list` of `int` ports set in the scan options with `-p`.
+        :rtype: `list`
+        """
+        match = self.PORTS.search(self.options)
+        if not match:
+            return []
+        return parse_ports(match.group(2))
+
+    def port_options(self, ports):
+        """
+        :param ports: `list` of `int` ports, in the order to scan them.
+        :return: `str` scan options with the ports in order, or sorted if
+            they are too long, None if the options would be longer than
+            `MAX_OPTIONS` and than they were.
+        """
+        limit = max(self.MAX_OPTIONS, len(self.options))
+        for spec in (format_ports(ports, ordered=True), format_ports(ports)):
+            options = self.PORTS.sub(lambda m: f"{m.group(1)}{spec}",
+                                     self.options, count=1)
+            if len(options) <= limit:
+                return options
+        return None
 
     def process_results(self):
         """
@@ -396,7 +1455,7 @@ class Stage:
         :return: float of of the % completion.
         :rtype: `float`
         """
-        if self.ftargets > 0:
+        if self.ftargets > 0 and self.targets.nlines > 0:
             return float(self.ftargets) / float(self.targets.nlines) * 100
         else:
             return float(0)
@@ -418,9 +1477,17 @@ class Stage:
 
 class DiscoveryStage(Stage):
 
-    def __init__(self, targets_path, options, outdir, ltargets_path):
+    def __init__(self, targets_path, options, outdir, ltargets_path, pack=0,
+                 pack6=None, max_length=0):
         super().__init__("discovery", targets_path, options, outdir)
         self.ltargets_path = ltargets_path
+        self.pack = pack
+        self.pack6 = pack6
+        self.max_length = max_length
+
+    def __setstate__(self, state):
+        super().__setstate__({"pack": 0, "pack6": None, "max_length": 0,
+                              **state})
 
     def process_results(self):
         """
@@ -428,7 +1495,9 @@ class DiscoveryStage(Stage):
         create a list of live targets.
         """
         results_parser = ReportsParser(self.reports_path, 'discovery-*.xml')
-        live_queue = TargetOptimization(self.ltargets_path)
+        live_queue = TargetOptimization(self.ltargets_path, pack=self.pack,
+                                        pack6=self.pack6,
+                                        max_length=self.max_length)
         live_queue.save(results_parser.hosts_up())
 
 
@@ -439,6 +1508,10 @@ class Context:
     Acts as a proxy between the active stages and the `stage` implementation.
     """
 
+    # low bits of a task id with the position of the target, the upper bits
+    # have the number of the stage.
+    TASK_ID_BITS = 56
+
     def __init__(self, options):
         self.stage_list = list(options.stage_list)
         self.nstages = len(self.stage_list)
@@ -446,10 +1519,28 @@ class Context:
         self.active_stages = {}
         self.reports_path = options.outdir
         self.active = {}
-        self.pending = []
-        self._lock = threading.Lock()
-
-    def pop(self, agent):
+        self.pending = PendingTasks(lookup=self._target)
+        self.port_stats = None
+        if options.port_ranking:
+            self.port_stats = PortStatistics()
+        self.live_set = None
+        if options.dead_threshold > 0:
+            self.live_set = LiveSet(options.ltargets_path,
+                                    options.dead_threshold, options.live_pack,
+                                    options.ipv6_pack, options.pack_length)
+        self.journal = None
+        # agents with a stable id that disconnected, agent -> lease deadline.
+        self.leases = {}
+        # interrupted tasks of agents with a stable id, agent -> `Task`, the
+        # agent can resume them from their partial output.
+        self.held = {}
+        # agents whose running task was cancelled, see `cancel`.
+        self.cancels = set()
+        # no new tasks are issued while draining, see `drain`.
+        self.draining = False
+        self._lock = threading.RLock()
+
+    def pop(self, agent, fits=None):
         """
         Gets the next `Task` from the current Active Stage, if their are no
         pending `Tasks` to be executed.
@@ -462,10 +1553,15 @@ class Context:
             str with ipaddress and port in ip:port format, this allows the
             server to manage multiple agents in one host.
             to run multiple clients at once.
+        :param fits: function that takes the target and options of a task
+            and returns False if the agent can not run it, those tasks are
+            left pending for the other agents.
         :return: A target to scan! `task`
         :rtype: `tuple`
         """
         with self._lock:
+            self.leases.pop(agent, None)
+            self._expire_leases()
             task = None
             if agent in self.active:
                 # This exists to make shore we don't lose targets.
@@ -477,39 +1573,83 @@ class Context:
                 task.update(STATUS.SCHEDULED)
                 return task.as_tuple()[2:]
 
-            if len(self.pending) > 0:
+            if self.draining:
+                log.info(f"Draining, no task for {agent}")
+                return None
+
+            # the agent that was interrupted takes its task back first.
+            task = self.held.pop(agent, None)
+            if task and not self._isavailable(task):
+                task = None
+            skipped = []
+            for _ in range(len(self.pending)):
+                if task:
+                    break
                 task = self.pending.pop(0)
-            else:
+                if task.target is None:
+                    log.error(f"Target {task.index} of {task.stage_name} "
+                              f"not found")
+                    task = None
+                elif not self._isavailable(task):
+                    # completed or taken back by another agent meanwhile.
+                    task = None
+                elif fits and not fits(*task.as_tuple()[2:]):
+                    skipped.append(task)
+                    task = None
+            for pending in skipped:
+                self.pending.append(pending)
+            if not task:
                 cstage = self.__cstage()
                 if cstage:
                     task = cstage.next_task()
                     if not task:
-                        # the only stage that needs to be finished
-                        # to proceed is
-                        # discovery as the other stages need the
-                        # list of live hosts
-                        if cstage.name != "discovery" or cstage.isfinished:
+                        # discovery needs to be finished to proceed, as the
+                        # other stages need the list of live hosts, and so
+                        # do the port stages that refine it.
+                        refines = self.live_set and cstage.ports
+                        if cstage.name != "discovery" and not refines or \
+                                cstage.isfinished:
                             if cstage.isfinished:
                                 cstage.process_results()
+                                if refines:
+                                    self._refine_live_set(cstage)
                                 cstage.close()
                             cstage = self.__cstage(True)
                             if cstage:
                                 task = cstage.next_task()
+                if task and fits and not fits(*task.as_tuple()[2:]):
+                    # the next pop moves on to the following task.
+                    log.info(f"Task {task.index} of {task.stage_name} does "
+                             f"not fit agent {agent}, left pending")
+                    self.pending.append(task)
+                    task = None
 
             # if we have a valid task save it in the active collection
             if task:
+                self._log(Op.ISSUED, task.stage_name, task.index, task.target)
                 self.active.update({agent: task})
                 # the consumers only need scan related information...
                 return task.as_tuple()[2:]
 
-    def completed(self, agent):
+    def completed(self, agent, tid=0):
         """
         Marks a agent task as complete.
 
         :param agent: ip:port of agent
         :type agent: `str`
+        :param tid: `int` id of the task reported, 0 for agents without
+            task ids.
         """
-        self._update_task_status(agent, STATUS.COMPLETED)
+        if tid:
+            _, report = self._complete_task(agent, tid)
+        else:
+            task, _ = self.__find_task_stage(agent)
+            self._update_task_status(agent, STATUS.COMPLETED)
+            report = task.report if task else None
+        if report and self.port_stats:
+            self._update_port_stats(report)
+        if self.journal and self.journal.isfull:
+            self.checkpoint()
 
     def downloading(self, agent):
         """
@@ -521,14 +1661,139 @@ class Context:
         """
         self._update_task_status(agent, STATUS.DOWNLOADING)
 
-    def interrupted(self, agent):
+    def interrupted(self, agent, hold=False):
         """
         Marks a task as interrupted, when agent disconnects for example.
 
         :param agent: ip:port of agent
         :type agent: `str`
+        :param hold: `True` for agents with a stable id, the task is kept
+            for the agent to resume it from its partial output the next time
+            it asks for one, other agents take it once the agent gives it up,
+            see `detached`.
+        """
+        with self._lock:
+            task = self.active.get(agent)
+            hold = hold and task is not None and task.index is not None
+            self._update_task_status(agent, STATUS.INTERRUPTED,
+                                     requeue=not hold)
+            if hold:
+                self.held[agent] = task
+
+    def _release(self, agent):
+        """
+        The task held for an agent goes to the pending tasks.
+        """
+        task = self.held.pop(agent, None)
+        if task:
+            log.info(f"Agent {agent} gave up {task.target}")
+            self.pending.append(task)
+
+    def _isavailable(self, task):
+        """
+        :param task: `Task` from the pending or held tasks.
+        :return: `True` if the task was not completed and is not running on
+            another agent.
+        """
+        tstage = self.active_stages.get(task.stage_name)
+        if tstage and tstage.iscompleted(task.index):
+            return False
+        return task.index is None or not any(
+            running.stage_name == task.stage_name and
+            running.index == task.index for running in self.active.values())
+
+    def detached(self, agent, grace):
+        """
+        An agent with a stable id disconnected, its running or held task is
+        kept for the grace period so the agent can reconnect and report or
+        resume it, then the task goes to the pending tasks.
+
+        :param agent: id of the agent.
+        :type agent: `str`
+        :param grace: `int` seconds to wait for the agent, 0 gives the task
+            up right away.
         """
-        self._update_task_status(agent, STATUS.INTERRUPTED)
+        with self._lock:
+            if grace <= 0 or (agent not in self.active and
+                              agent not in self.held):
+                self.interrupted(agent)
+                self._release(agent)
+                return
+            log.info(f"Agent {agent} disconnected, keeping its task for "
+                     f"{grace} seconds")
+            self.leases[agent] = time.monotonic() + grace
+
+    def _expire_leases(self):
+        """
+        Interrupts the tasks of the agents that did not reconnect in time.
+        """
+        now = time.monotonic()
+        for agent, deadline in list(self.leases.items()):
+            if deadline <= now:
+                log.info(f"Agent {agent} did not reconnect")
+                self.leases.pop(agent)
+                self.interrupted(agent)
+                self._release(agent)
+
+    def cancel(self, agent):
+        """
+        Requests the cancellation of the task running on an agent, the
+        connection of the agent stops the scan if the agent negotiated
+        `Features.CANCEL`, and the task is interrupted once the agent
+        reports its state.
+
+        :param agent: ip:port or id of agent
+        :type agent: `str`
+        :return: `True` if the agent has a task to cancel.
+        """
+        with self._lock:
+            if agent not in self.active:
+                return False
+            log.info(f"Cancelling the task running on {agent}")
+            self.cancels.add(agent)
+            return True
+
+    def cancel_all(self):
+        """
+        Requests the cancellation of all the running tasks, see `cancel`.
+
+        :return: `list` of the agents cancelled.
+        """
+        with self._lock:
+            return [agent for agent in list(self.active)
+                    if self.cancel(agent)]
+
+    def drain(self):
+        """
+        Stops issuing tasks, the running tasks are still reported, an agent
+        that reconnects gets its running task back.
+
+        :return: `int` number of tasks running.
+        """
+        with self._lock:
+            self.draining = True
+            return len(self.active)
+
+    @property
+    def isdrained(self):
+        """
+        :return: `True` once all the tasks running when draining started
+            were reported or interrupted.
+        """
+        with self._lock:
+            return self.draining and not self.active
+
+    def iscancelled(self, agent):
+        """
+        :param agent: ip:port or id of agent
+        :type agent: `str`
+        :return: `True` once if the task of the agent was cancelled.
+        """
+        with self._lock:
+            if agent in self.cancels:
+                self.cancels.discard(agent)
+                return True
+            return False
 
     def running(self, agent):
         """
@@ -540,50 +1805,335 @@ class Context:
         """
         self._update_task_status(agent, STATUS.RUNNING)
 
-    def get_report(self, agent, file_name):
+    def task_id(self, agent):
+        """
+        :param agent: ip:port of agent
+        :type agent: `str`
+        :return: `int` id of the task running on the agent, made of the
+            stage number and the position of the target in its work queue,
+            0 for tasks without a position.
+        """
+        with self._lock:
+            task = self.active.get(agent)
+            if not task or task.index is None or \
+                    task.stage_name not in self.active_stages:
+                return 0
+            number = list(self.active_stages).index(task.stage_name) + 1
+            return number << self.TASK_ID_BITS | task.index
+
+    def iscompleted(self, tid):
+        """
+        :param tid: `int` id of a task.
+        :return: `True` if the task was completed.
+        """
+        with self._lock:
+            tstage, index = self._task_stage(tid)
+            return tstage is not None and tstage.iscompleted(index)
+
+    def get_report(self, agent, file_name, tid=0):
         """
         :param agent: str with ipaddress and port in ip:port format
         :type agent: `str`
         :param file_name: name of the file sent by the agent.
         :type file_name: `str`
-        :return: file descriptor to save the scan report.
-        """
+        :param tid: `int` id of the task reported, the report is named after
+            the task, 0 for agents without task ids.
+        :return: file descriptor to save the scan report, None if the task
+            was already completed.
+        """
+        if tid:
+            with self._lock:
+                tstage, index = self._task_stage(tid)
+                if not tstage or tstage.iscompleted(index):
+                    log.info(f"Discarding the report of task {tid:#x}")
+                    return None
+            file_name = self._report_name(tstage, index)
+            try:
+                return open(os.path.join(self.reports_path, file_name), "wb")
+            except OSError as ex:
+                log.error(f"Unable to open report for {file_name}")
+                log.error(f"{ex}")
+                return None
         try:
-            _, tstage = self.__find_task_stage(agent)
+            task, tstage = self.__find_task_stage(agent)
             file_name = f"{tstage.name}-{file_name}"
             report_file = open(os.path.join(self.reports_path, file_name),
                                "wb")
+            if tstage.ports:
+                task.report = file_name
             return report_file
         except Exception as ex:
             log.error(f"Unable to open report for {file_name}")
             log.error(f"{ex}")
             return None
 
-    def _update_task_status(self, agent, status):
+    def get_partial_report(self, agent, tid):
+        """
+        :param agent: str with ipaddress and port in ip:port format
+        :type agent: `str`
+        :param tid: `int` id of the interrupted task.
+        :return: file descriptor to save the partial report of the task,
+            None if the task was already completed.
+        """
+        with self._lock:
+            tstage, index = self._task_stage(tid)
+            if not tstage or tstage.iscompleted(index):
+                log.info(f"Discarding the partial report of task {tid:#x}")
+                return None
+        file_name = f"{tstage.name}-{index}.part"
+        try:
+            return open(os.path.join(self.reports_path, file_name), "wb")
+        except OSError as ex:
+            log.error(f"Unable to open partial report for {file_name}")
+            log.error(f"{ex}")
+            return None
+
+    def salvage(self, agent, tid, hold=False):
+        """
+        Keeps the hosts finished by an interrupted task, from the partial
+        report received with `get_partial_report`, the hosts left are queued
+        as a smaller task with the same id.
+
+        :param agent: str with ipaddress and port in ip:port format
+        :type agent: `str`
+        :param tid: `int` id of the interrupted task.
+        :param hold: `True` for agents with a stable id, the hosts left are
+            kept for the agent to resume them, as in `interrupted`.
+        :return: `True` if the partial report had finished hosts.
+        """
+        with self._lock:
+            tstage, index = self._task_stage(tid)
+            holders = [holder for holder in self.active
+                       if self.task_id(holder) == tid]
+            if not tstage or not holders or tstage.iscompleted(index):
+                return False
+            if agent in holders:
+                holders.insert(0, holders.pop(holders.index(agent)))
+            task = self.active[holders[0]]
+            part_path = os.path.join(self.reports_path,
+                                     f"{tstage.name}-{index}.part")
+            try:
+                with open(part_path, "rb") as pfile:
+                    report, done = salvage_report(pfile.read())
+                if not report:
+                    log.info(f"Task {tid:#x} did not finish any host")
+                    return False
+                remainder = remaining_targets(task.target, done)
+                # the partial reports of a task, next to its final report.
+                n = itertools.count(1)
+                report_name = f"{tstage.name}-{index}.{next(n)}.xml"
+                while os.path.isfile(os.path.join(self.reports_path,
+                                                  report_name)):
+                    report_name = f"{tstage.name}-{index}.{next(n)}.xml"
+                with open(os.path.join(self.reports_path, report_name),
+                          "wb") as rfile:
+                    rfile.write(report)
+            except (OSError, ValueError) as ex:
+                log.error(f"Unable to salvage the partial report of task "
+                          f"{tid:#x}")
+                log.error(f"{ex}")
+                return False
+            finally:
+                if os.path.isfile(part_path):
+                    os.remove(part_path)
+            for holder in holders:
+                self.active.pop(holder).update(STATUS.INTERRUPTED)
+                self.leases.pop(holder, None)
+                self.cancels.discard(holder)
+            if remainder:
+                log.info(f"Task {tid:#x} finished {len(done)} hosts, "
+                         f"queueing {remainder}")
+                self._log(Op.INTERRUPTED, tstage.name, index)
+                rest = Task(tstage.name, task.options, remainder, index)
+                rest.remainder = True
+                rest.attempts = task.attempts + 1
+                if hold and holders[0] == agent:
+                    self.held[agent] = rest
+                else:
+                    self.pending.append(rest)
+            else:
+                # the last host finished before the interruption.
+                tstage.complete(index)
+                self._log(Op.COMPLETED, tstage.name, index)
+        if self.port_stats and tstage.ports:
+            self._update_port_stats(report_name)
+        if self.journal and self.journal.isfull:
+            self.checkpoint()
+        return True
+
+    def _update_port_stats(self, report):
+        """
+        Feeds the open ports of a completed report to the port statistics.
+
+        :param report: name of the report file in the reports directory.
+        :type report: `str`
+        """
+        try:
+            results = list(ReportsParser(self.reports_path,
+                                         report).open_ports())
+        except OSError as ex:
+            log.error(f"Unable to collect port statistics from {report}")
+            log.error(f"{ex}")
+            return
+        with self._lock:
+            self.port_stats.update(results)
+
+    def _refine_live_set(self, stage):
+        """
+        Called once a port stage is finished, the stages that did not start
+        yet will consume the refined list of live targets.
+
+        :param stage: finished `Stage`.
+        """
+        with self._lock:
+            try:
+                path = self.live_set.refine(stage)
+            except (OSError, ValueError) as ex:
+                log.error(f"Unable to refine the live targets of {stage.name}")
+                log.error(f"{ex}")
+                return
+            if path:
+                for next_stage in self.stage_list:
+                    next_stage.retarget(path)
+                    self._log(Op.RETARGET, next_stage.name, value=path)
+
+    def targets_paths(self):
+        """
+        :return: `set` of the paths of the targets files of all the stages.
+        """
+        with self._lock:
+            stages = [*self.active_stages.values(), *self.stage_list]
+            return {stage.targets_path for stage in stages}
+
+    def add_targets(self, lines):
+        """
+        Appends new targets to a running scan, they are added to the
+        discovery stage until it finishes, and after to the stages that
+        still have targets to pull.
+
+        :param lines: `list` of `str` optimized targets.
+        :return: `list` of the names of the stages that got the targets.
+        """
+        with self._lock:
+            stages = list(self.stage_list)
+            if self.cstage_name:
+                stages.insert(0, self.active_stages[self.cstage_name])
+            if stages and stages[0].name == "discovery":
+                # the next stages get the live hosts found by discovery.
+                stages = stages[:1]
+            appended = set()
+            for stage in stages:
+                if stage.targets_path in appended:
+                    stage.targets.refresh()
+                else:
+                    stage.targets.append(lines)
+                    appended.add(stage.targets_path)
+            return [stage.name for stage in stages]
+
+    def _target(self, stage_name, position):
+        """
+        :param stage_name: name of an active stage.
+        :param position: `int` position of the target in its work queue.
+        :return: `str` target of the task, or None if not found.
+        """
+        stage = self.active_stages.get(stage_name)
+        if stage:
+            return stage.targets.task(position)
+        return None
+
+    def _update_task_status(self, agent, status, requeue=True):
         """
         Internal method updates  a task of a given stage status, its also
         responsible for managing the interrupted tasks.
 
         :param agent: str with ipaddress and port in ip:port format
         :param status: `STATUS` value to change.
+        :param requeue: `False` to keep an interrupted task out of the
+            pending tasks.
         """
         with self._lock:
             task, tstage = self.__find_task_stage(agent)
+            if status in (STATUS.COMPLETED, STATUS.INTERRUPTED):
+                self.leases.pop(agent, None)
+                self.cancels.discard(agent)
             if task and tstage:
                 task.update(status)
+                if status == STATUS.RUNNING:
+                    self._log(Op.RUNNING, tstage.name, task.index)
                 if status == STATUS.COMPLETED:
-                    tstage.inc_finished()
+                    if not tstage.complete(task.index):
+                        log.info(f"{task.target} of {tstage.name} was "
+                                 f"already completed")
+                    self._log(Op.COMPLETED, tstage.name, task.index)
                     # clean the completed task
                     del self.active[agent]
                 if status == status.INTERRUPTED:
                     log.info(f"Scan of {task.target} running on {agent} was "
                              f"interrupted")
-                    self.pending.append(task)
+                    self._log(Op.INTERRUPTED, tstage.name, task.index)
+                    task.attempts += 1
+                    if requeue:
+                        self.pending.append(task)
                     del self.active[agent]
             else:
                 log.debug(f"Agent {agent} is trying to update {status} on "
                           f"non existing task")
 
+    def _task_stage(self, tid):
+        """
+        :param tid: `int` id of a task.
+        :return: tuple with the active `Stage` and the position of the target
+            of the task, the stage is None for unknown ids.
+        """
+        number = (tid >> self.TASK_ID_BITS) - 1
+        stages = list(self.active_stages.values())
+        if 0 <= number < len(stages):
+            return stages[number], tid & ((1 << self.TASK_ID_BITS) - 1)
+        return None, None
+
+    @staticmethod
+    def _report_name(stage, index):
+        """
+        :return: `str` name of the report of the task in the index position
+            of the stage, the same for every upload of the task.
+        """
+        return f"{stage.name}-{index}.xml"
+
+    def _complete_task(self, agent, tid):
+        """
+        Completes a task by its id, it can be reported by an agent other
+        than the one it was issued to, after a reconnect, and the task
+        completed before by a duplicate execution or a retried upload is not
+        counted again.
+
+        :param agent: str with ipaddress and port in ip:port format
+        :param tid: `int` id of the task.
+        :return: tuple with the `Stage` of the task, None if it was completed
+            before, and the name of its report if it needs to update the
+            port statistics.
+        """
+        with self._lock:
+            tstage, index = self._task_stage(tid)
+            # the agents holding the task, a reconnected agent or a duplicate.
+            holders = [holder for holder in self.active
+                       if self.task_id(holder) == tid]
+            for holder in holders:
+                self.active.pop(holder).update(STATUS.COMPLETED)
+                self.leases.pop(holder, None)
+                self.cancels.discard(holder)
+            if not tstage:
+                log.error(f"Agent {agent} reported the unknown task "
+                          f"{tid:#x}")
+                return None, None
+            if not tstage.complete(index):
+                log.info(f"Task {tid:#x} of {tstage.name} was already "
+                         f"completed")
+                return None, None
+            self._log(Op.COMPLETED, tstage.name, index)
+            if tstage.ports:
+                return tstage, self._report_name(tstage, index)
+            return tstage, None
+
     def __cstage(self, force_next=False):
         """
         :param force_next: if True wil force the stage to advance one step
@@ -594,9 +2144,12 @@ class Context:
         """
         try:
             if not self.cstage_name or force_next:
+                if self.port_stats:
+                    self.port_stats.rebalance(self.stage_list)
                 stage = self.stage_list.pop(0)
                 self.active_stages[stage.name] = stage
                 self.cstage_name = stage.name
+                self._log(Op.STAGE, stage.name, value=stage.options)
 
             return self.active_stages[self.cstage_name]
         except IndexError:
@@ -626,14 +2179,168 @@ class Context:
         rpath = options.resume_path
         if os.path.isfile(rpath) and os.stat(rpath).st_size > 0:
             log.info("Found resume file, loading...!")
-            with open(options.resume_path, 'rb') as rfile:
-                # i had to make this to make this testable with mocks!
-                # load with file didn't work, some how!
-                data = rfile.read()
-                ctx = pickle.loads(data)
-                return ctx
+            rfile = open(options.resume_path, 'rb')
+            if SnapshotReader.issnapshot(rfile):
+                ctx = cls.load(rfile)
+            else:
+                # resume files saved before the snapshots.
+                with rfile:
+                    ctx = pickle.loads(rfile.read())
         else:
-            return cls(options)
+            ctx = cls(options)
+        if options.journal_path:
+            journal = Journal(options.journal_path, rpath,
+                              options.journal_size)
+            ctx.journal = journal
+            if journal.exists():
+                ctx.replay(journal)
+                # starts over from a snapshot of the recovered state.
+                ctx.checkpoint()
+        return ctx
+
+    def _log(self, op, stage, index=None, value=""):
+        """
+        Saves a transition in the journal, if there is one.
+        """
+        if self.journal:
+            self.journal.append(op, stage, index, value)
+
+    def replay(self, journal):
+        """
+        Applies the transitions saved in the journal after the last
+        snapshot, the tasks that were running are scanned again.
+
+        :param journal: `Journal` to replay.
+        """
+        log.info(f"Replaying the journal {journal.path}")
+        ncompleted = 0
+        for op, name, index, value in journal.replay():
+            if op == Op.STAGE:
+                stages = [stage for stage in self.stage_list
+                          if stage.name == name]
+                if stages:
+                    self.stage_list.remove(stages[0])
+                    self.active_stages[name] = stages[0]
+                    self.cstage_name = name
+                if name in self.active_stages:
+                    self.active_stages[name].options = value
+            elif op == Op.RETARGET:
+                for stage in self.stage_list:
+                    if stage.name == name:
+                        stage.retarget(value)
+            elif op == Op.COMPLETED and index is not None:
+                stage = self.active_stages.get(name)
+                if stage and stage.complete(index):
+                    ncompleted += 1
+        for stage in self.active_stages.values():
+            # counts the targets of the stages activated by the journal.
+            if stage.targets.exists():
+                stage.targets.open()
+        log.info(f"Replayed {journal.nrecords} records, {ncompleted} "
+                 f"completed tasks")
+
+    def checkpoint(self):
+        """
+        Saves a snapshot of the context in the resume file, and starts a new
+        journal.
+        """
+        with self._lock:
+            self.journal.compact(self.save)
+
+    def save(self, fileobj):
+        """
+        Writes a snapshot of the context, the running tasks are saved as
+        interrupted and the context keeps running untouched.
+
+        :param fileobj: binary file object open for writing.
+        """
+        with self._lock:
+            log.info("saving context state")
+            running = []
+            for task in self.active.values():
+                task = copy.copy(task)
+                task.update(STATUS.INTERRUPTED)
+                running.append(task)
+            # the tasks held for their agents are pending once restored.
+            running.extend(self.held.values())
+            writer = SnapshotWriter(fileobj)
+            writer.write(Kind.CONTEXT, {
+                "nstages": self.nstages, "cstage_name": self.cstage_name,
+                "reports_path": self.reports_path,
+                "ntasks": len(self.pending) + len(running)})
+            for stage in [*self.active_stages.values(), *self.stage_list]:
+                record = stage.as_record()
+                record['active'] = stage.name in self.active_stages
+                writer.write(Kind.STAGE, record)
+                writer.write(Kind.COMPLETION, stage.completion.bits)
+            if self.port_stats:
+                writer.write(Kind.PORT_STATS, self.port_stats.as_record())
+            if self.live_set:
+                writer.write(Kind.LIVE_SET, self.live_set.as_record())
+            for task in itertools.chain(self.pending, running):
+                writer.write(Kind.TASK, task.as_record())
+
+    @classmethod
+    def load(cls, fileobj):
+        """
+        Reads a snapshot written by `save`, the pending tasks are read from
+        the file when needed, it's closed once they are all read.
+
+        :param fileobj: binary file object open for reading.
+        :return: instance of `Context`
+        :raises SnapshotError: if the file is not a valid snapshot.
+        """
+        reader = SnapshotReader(fileobj)
+        record = reader.read()
+        if not record or record[0] != Kind.CONTEXT:
+            reader.close()
+            raise SnapshotError("Snapshot without context")
+        log.info(f"Restoring context state, snapshot version "
+                 f"{reader.version}")
+        _, state = record
+        ctx = object.__new__(cls)
+        ctx.nstages = state["nstages"]
+        ctx.cstage_name = state.get("cstage_name")
+        ctx.reports_path = state["reports_path"]
+        ctx.stage_list = []
+        ctx.active_stages = {}
+        ctx.active = {}
+        ctx.port_stats = None
+        ctx.live_set = None
+        ctx.journal = None
+        ctx.leases = {}
+        ctx.held = {}
+        ctx.cancels = set()
+        ctx.draining = False
+        ctx._lock = threading.RLock()
+        stage, completed = None, 0
+        while True:
+            offset = reader.tell()
+            record = reader.read()
+            if record is None:
+                break
+            kind, payload = record
+            if kind == Kind.STAGE:
+                stage = Stage.from_record(payload)
+                completed = payload.get("completed", 0)
+                if payload.get("active"):
+                    ctx.active_stages[stage.name] = stage
+                else:
+                    ctx.stage_list.append(stage)
+            elif kind == Kind.COMPLETION and stage:
+                stage.completion = Bitmap.frombytes(payload, completed)
+            elif kind == Kind.PORT_STATS:
+                ctx.port_stats = PortStatistics.from_record(payload)
+            elif kind == Kind.LIVE_SET:
+                ctx.live_set = LiveSet.from_record(payload)
+            elif kind == Kind.TASK:
+                reader.seek(offset)
+                ctx.pending = PendingTasks(reader, state.get("ntasks", 0),
+                                           ctx._target)
+                return ctx
+        ctx.pending = PendingTasks(lookup=ctx._target)
+        reader.close()
+        return ctx
 
     def tasks_status(self):
         """
@@ -671,29 +2378,20 @@ class Context:
         return [(self.nstages, len(self.pending), "{:.2f}%"
                  .format((stage_comp / float(self.nstages * 100) * 100)))]
 
-    def __getstate__(self):
-        with self._lock:
-            log.info("saving context state")
-            state = self.__dict__.copy()
-            for task in state['active'].values():
-                task.update(STATUS.INTERRUPTED)
-                state['pending'].append(task)
-
-            # close file descriptors on all active stages
-            for active_stage in state['active_stages'].values():
-                active_stage.close()
-
-            state['active'] = {}
-            # Remove the unpickable entries.
-            del state['_lock']
-            return state
-
     def __setstate__(self, state):
-        # restore the previous state, needed due to the existence of non
-        # serializable objects
-        self.__dict__.update(state)
+        # restores the pickled resume files saved before the snapshots.
+        self.__dict__.update({"port_stats": None, "live_set": None, **state})
         log.info("Restoring context state")
-        self._lock = threading.Lock()
+        pending = PendingTasks(lookup=self._target)
+        for task in state['pending']:
+            pending.append(task)
+        self.pending = pending
+        self.journal = None
+        self.leases = {}
+        self.held = {}
+        self.cancels = set()
+        self.draining = False
+        self._lock = threading.RLock()
 
 
 class ScanProcess:
@@ -707,15 +2405,29 @@ class ScanProcess:
     TASK_HEADERS = [
         "Target", "Nª completed Scans", "Status"
     ]
+    NMAP = "nmap"
+    # last line of the normal output of a finished scan.
+    NMAP_DONE = "# Nmap done"
+    HOST = re.compile(r"<host[\s>]")
 
-    def __init__(self, output):
+    def __init__(self, output, timeout=0):
         """
         wrapper around `libnmap` scan execution
         :param output: str path to save the reports
+        :param timeout: `int` seconds before a scan is stopped, 0 to let
+            it run until it finishes.
         """
         self.output = output
+        self.timeout = timeout
         # current target aka ctarget is a tuple (target, options).
         self.ctarget = None
+        # id of the current task, 0 if it has none.
+        self.tid = 0
+        # running nmap process, the `subprocess.Popen` of a resumed scan,
+        # and if it was stopped before it finished.
+        self.nmap_proc = None
+        self.resume_proc = None
+        self.stopped = False
         # number of successful scans finished
         self.number_scans = 0
         self.display = Display()
@@ -734,10 +2446,20 @@ class ScanProcess:
 
         :param extension: xml, nmap.
         :return: path str path and filename, the filename will be prefixed,
-            by a number if the base+extension already exists in the outdir.
+            by a number if the base+extension already exists in the outdir,
+            the files of a task with an id are named after the id only, the
+            hosts left of an interrupted task are queued with the same id
+            and other targets, and resumed from the same files.
         :rtype: `str`
         """
-        fname = self.ctarget[0].replace('/', '-')
+        if self.tid:
+            return os.path.join(self.output,
+                                f"task-{self.tid:x}.{extension}")
+        targets = self.ctarget[0].split()
+        fname = targets[0].replace('/', '-').replace(':', '_')
+        if len(targets) > 1:
+            # packed list of targets, named after the first one.
+            fname = f"{fname}+{len(targets) - 1}"
         path = os.path.join(self.output, f"{fname}"
                                          f".{extension}")
         exists = os.path.isfile(path)
@@ -749,47 +2471,83 @@ class ScanProcess:
             exists = os.path.isfile(path)
         return path
 
-    def run(self, target, options, callback):
+    def run(self, target, options, callback, tid=0):
         """
         Executes the scan on a given target.
 
         :param target:
         :param options:
         :param callback: callback function to report status to the server.
+        :param tid: `int` id of the task, the partial output of a task with
+            an id is kept when the scan is interrupted, and the scan resumed
+            from it the next time the task is run, the failure is not
+            reported so the caller can upload it instead.
         :return: report object
         :rtype: `dscan.models.structures.Report`
         """
         self.ctarget = (target, options)
+        self.tid = tid
+        self.stopped = False
+        nmap_log = self.report_name('nmap')
+        timer = None
+        if self.timeout:
+            # the timeout covers the resumed scan too.
+            timer = threading.Timer(self.timeout, self.cancel)
+            timer.daemon = True
+            timer.start()
+        if tid and self.isresumable(nmap_log):
+            callback(Status.SUCCESS)
+            report = self.resume(nmap_log)
+            if report or self.stopped:
+                if timer:
+                    timer.cancel()
+                return report
+            log.info(f"Unable to resume {target}, scanning it again")
+
+            def started(status, send=callback):
+                # the start of the scan was already reported.
+                if status != Status.SUCCESS:
+                    send(status)
+            callback = started
         nmap_proc = None
         try:
-            options = " ".join([options, f"-oN {self.report_name('nmap')}"])
-            nmap_proc = NmapProcess(targets=target, options=options,
+            options = " ".join([options, f"-oN {nmap_log}"])
+            targets = target.split()
+            if len(targets) > 1 or "," in target:
+                # lists of targets are passed in a file, libnmap would remove
+                # the spaces between them, and split the octet lists.
+                targets_file = self.report_name('targets')
+                with open(targets_file, "wt") as tfile:
+                    tfile.write("\n".join(targets))
+                options = " ".join([options, f"-iL {targets_file}"])
+                targets = []
+            nmap_proc = NmapProcess(targets=targets, options=options,
                                     safe_mode=False,
                                     event_callback=self.show_status)
+            self.nmap_proc = nmap_proc
 
             log.info("Nmap scan started Sending success status")
             callback(Status.SUCCESS)
             rc = nmap_proc.run()
-            if rc == 0:
+            if rc == 0 and not self.stopped:
                 # after finished encode and hash the contents for transfer.
-                self.__inc()
-                data = nmap_proc.stdout.encode("utf-8")
-                report_file = self.report_name("xml")
-                with open(self.report_name("xml"), "wb") as rfile:
-                    rfile.write(data)
-                    rfile.flush()
-                digest = hashlib.sha512(data).hexdigest()
-                report = Report(len(data), os.path.basename(report_file),
-                                digest)
-                self.print(target, 100)
-                return report
+                return self.save_report(nmap_proc.stdout)
             else:
-                callback(Status.FAILED)
                 log.error(f"Nmap Scan failed {nmap_proc.stderr}")
+                if tid:
+                    # the xml of the hosts finished, to resume the scan or
+                    # upload them.
+                    with open(self.report_name('part'), "wt") as pfile:
+                        pfile.write(nmap_proc.stdout)
+                else:
+                    callback(Status.FAILED)
         except Exception as ex:
             log.error(f"something went wrong {ex}")
             callback(Status.FAILED)
         finally:
+            self.nmap_proc = None
+            if timer:
+                timer.cancel()
             if nmap_proc:
                 nmap_proc.stop()
                 # orthodox fix NmapProcess is leaving subprocess streams open.
@@ -798,6 +2556,170 @@ class ScanProcess:
                     subproc.stdout.close()
                     subproc.stderr.close()
 
+    def cancel(self):
+        """
+        Stops the running scan, called from another thread, its partial
+        output is kept as for any interrupted scan.
+        """
+        self.stopped = True
+        resume_proc = self.resume_proc
+        if resume_proc:
+            resume_proc.terminate()
+        nmap_proc = self.nmap_proc
+        if nmap_proc:
+            try:
+                nmap_proc.stop()
+            except AttributeError:
+                # nmap did not start yet.
+                pass
+
+    def save_report(self, output):
+        """
+        :param output: `str` xml output of the scan.
+        :return: report object
+        :rtype: `dscan.models.structures.Report`
+        """
+        self.__inc()
+        data = output.encode("utf-8")
+        report_file = self.report_name("xml")
+        with open(report_file, "wb") as rfile:
+            rfile.write(data)
+            rfile.flush()
+        digest = hashlib.sha512(data).hexdigest()
+        report = Report(len(data), os.path.basename(report_file), digest)
+        self.print(self.ctarget[0], 100)
+        return report
+
+    def partial_report(self):
+        """
+        :return: report object of the partial output of the last task
+            interrupted, None if it was not kept.
+        :rtype: `dscan.models.structures.Report`
+        """
+        part_path = self.report_name('part')
+        try:
+            with open(part_path, "rb") as pfile:
+                data = pfile.read()
+        except OSError:
+            return None
+        digest = hashlib.sha512(data).hexdigest()
+        return Report(len(data), os.path.basename(part_path), digest)
+
+    def salvaged(self):
+        """
+        The server kept the hosts of the partial output of the last task,
+        only the xml header is left in the partial output, with the normal
+        output nmap resumes the scan of the hosts left, and only those are
+        reported.
+        """
+        part_path = self.report_name('part')
+        try:
+            with open(part_path, "rt") as pfile:
+                partial = pfile.read()
+            match = self.HOST.search(partial)
+            if match:
+                with open(part_path, "wt") as pfile:
+                    pfile.write(partial[:match.start()])
+        except OSError as ex:
+            log.error(f"Unable to update the partial output {ex}")
+
+    def isresumable(self, nmap_log):
+        """
+        :param nmap_log: path of the normal output of the task.
+        :return: `True` if the task was interrupted and its partial output
+            was kept.
+        """
+        if not os.path.isfile(self.report_name('part')):
+            return False
+        try:
+            with open(nmap_log, "rt") as lfile:
+                return not any(line.startswith(self.NMAP_DONE)
+                               for line in lfile)
+        except OSError:
+            return False
+
+    def resume(self, nmap_log):
+        """
+        Resumes an interrupted scan with `nmap --resume`, nmap reads the
+        command line and the hosts already finished from the normal output,
+        the xml of the hosts scanned before is merged with the rest.
+
+        :param nmap_log: path of the normal output of the task.
+        :return: report object, None if the scan could not be resumed or
+            was stopped, the hosts finished are kept in the partial output.
+        :rtype: `dscan.models.structures.Report`
+        """
+        part_path = self.report_name('part')
+        log.info(f"Resuming the scan of {self.ctarget[0]} from {nmap_log}")
+        try:
+            with open(part_path, "rt") as pfile:
+                partial = pfile.read()
+            proc = subprocess.Popen([self.NMAP, "--resume", nmap_log],
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE, text=True)
+        except OSError as ex:
+            log.error(f"Unable to resume the scan {ex}")
+            return None
+        self.resume_proc = proc
+        try:
+            if self.stopped:
+                # cancelled before the process started.
+                proc.terminate()
+            stdout, stderr = proc.communicate()
+        finally:
+            self.resume_proc = None
+        if proc.returncode != 0 or self.stopped:
+            log.error(f"Nmap resume failed {stderr}")
+            with open(part_path, "wt") as pfile:
+                pfile.write(self.join_hosts(partial, stdout))
+            return None
+        output = self.merge(partial, stdout)
+        if not output:
+            log.error("Unable to merge the xml output of the resumed scan")
+            return None
+        os.remove(part_path)
+        return self.save_report(output)
+
+    @classmethod
+    def merge(cls, partial, resumed):
+        """
+        :param partial: `str` xml output cut by the interruption.
+        :param resumed: `str` xml output of the resumed scan.
+        :return: `str` xml output with the hosts of both, or None if it's
+            not valid.
+        """
+        end = partial.rfind("</host>")
+        if end < 0:
+            output = resumed
+        else:
+            match = cls.HOST.search(resumed)
+            start = match.start() if match else resumed.find("<runstats")
+            if start < 0:
+                return None
+            output = f"{partial[:end + len('</host>')]}\n{resumed[start:]}"
+        try:
+            ElementTree.fromstring(output.encode("utf-8"))
+        except ElementTree.ParseError:
+            return None
+        return output
+
+    @classmethod
+    def join_hosts(cls, partial, resumed):
+        """
+        :param partial: `str` xml output cut by the interruption.
+        :param resumed: `str` xml output of the resumed scan, cut as well.
+        :return: `str` the partial output with the hosts finished by the
+            resumed scan appended.
+        """
+        start = cls.HOST.search(resumed)
+        end = resumed.rfind("</host>")
+        if not start or end < start.start():
+            return partial
+        cut = partial.rfind("</host>")
+        if cut >= 0:
+            partial = partial[:cut + len('</host>')]
+        return f"{partial}\n{resumed[start.start():end + len('</host>')]}\n"
+
     def print(self, target, progress):
         try:
             self.display.print_table(self.TASK_HEADERS,
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+"""
+snapshot.py
+versioned resume file of the scan context
+"""
+import json
+import os
+import struct
+from enum import IntEnum
+
+MAGIC = b"DSCTX"
+VERSION = 1
+
+
+class Kind(IntEnum):
+    """
+    Records of a snapshot, in the order they are written:
+    - Context: the context attributes and the number of tasks saved.
+    - Stage: a stage and its work queue, active stages first.
+    - Completion: the completion bitmap of the previous stage.
+    - Port stats: the `PortStatistics`, if enabled.
+    - Live set: the `LiveSet`, if enabled.
+    - Task: one record per pending task, read on demand.
+    """
+    CONTEXT = 1
+    STAGE = 2
+    COMPLETION = 3
+    PORT_STATS = 4
+    LIVE_SET = 5
+    TASK = 6
+
+
+class SnapshotError(ValueError):
+    """
+    Raised for files that are not a snapshot, or were cut short.
+    """
+
+
+class SnapshotWriter:
+    """
+    Writes the snapshot header and its records, each record has its kind
+    and size followed by a json payload, or raw bytes for bitmaps.
+    """
+    HEADER = struct.Struct("<5sH")
+    RECORD = struct.Struct("<BI")
+
+    def __init__(self, fileobj):
+        """
+        :param fileobj: binary file object open for writing.
+        """
+        self.fileobj = fileobj
+        self.fileobj.write(self.HEADER.pack(MAGIC, VERSION))
+
+    def write(self, kind, payload):
+        """
+        :param kind: `Kind` of the record.
+        :param payload: `dict` of json types, or `bytes`.
+        """
+        if not isinstance(payload, (bytes, bytearray)):
+            payload = json.dumps(payload, separators=(",", ":")).encode()
+        self.fileobj.write(self.RECORD.pack(kind, len(payload)))
+        self.fileobj.write(payload)
+
+
+class SnapshotReader:
+    """
+    Reads the records of a snapshot one at a time, so the pending tasks
+    can be left in the file until needed.
+    """
+    HEADER = SnapshotWriter.HEADER
+    RECORD = SnapshotWriter.RECORD
+
+    def __init__(self, fileobj):
+        """
+        :param fileobj: binary file object open for reading, at the start.
+        :raises SnapshotError: if the header is invalid.
+        """
+        self.fileobj = fileobj
+        header = fileobj.read(self.HEADER.size)
+        if len(header) != self.HEADER.size:
+            raise SnapshotError("Snapshot header is incomplete")
+        magic, self.version = self.HEADER.unpack(header)
+        if magic != MAGIC:
+            raise SnapshotError("Not a snapshot file")
+        if self.version > VERSION:
+            raise SnapshotError(f"Unsupported snapshot version "
+                                f"{self.version}")
+
+    @staticmethod
+    def issnapshot(fileobj):
+        """
+        :param fileobj: binary file object, its position is kept.
+        :return: `True` if the file starts with the snapshot magic.
+        """
+        position = fileobj.tell()
+        magic = fileobj.read(len(MAGIC))
+        fileobj.seek(position)
+        return magic == MAGIC
+
+    def read(self):
+        """
+        :return: tuple with the `Kind` and payload of the next record, or
+            None at the end of the file, records of unknown kinds are
+            skipped.
+        :raises SnapshotError: if the record was cut short.
+        """
+        while True:
+            header = self.fileobj.read(self.RECORD.size)
+            if not header:
+                return None
+            if len(header) != self.RECORD.size:
+                raise SnapshotError("Snapshot record header is incomplete")
+            kind, size = self.RECORD.unpack(header)
+            payload = self.fileobj.read(size)
+            if len(payload) != size:
+                raise SnapshotError("Snapshot record is incomplete")
+            try:
+                kind = Kind(kind)
+            except ValueError:
+                continue
+            if kind != Kind.COMPLETION:
+                payload = json.loads(payload)
+            return kind, payload
+
+    def tell(self):
+        return self.fileobj.tell()
+
+    def seek(self, offset):
+        self.fileobj.seek(offset)
+
+    def close(self):
+        self.fileobj.close()
+
+
+def atomic_write(path, write):
+    """
+    Writes a file through a temporary file that replaces it once on disk,
+    a reader of the previous file keeps reading it.
+
+    :param path: path of the file.
+    :param write: function called with the binary file object to write.
+    """
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as tfile:
+        write(tfile)
+        tfile.flush()
+        os.fsync(tfile.fileno())
+    os.replace(tmp_path, path)
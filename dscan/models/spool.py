@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+"""
+spool.py
+reports of the agent waiting to be received by the server
+"""
+import json
+import os
+from dscan import log
+from dscan.models.snapshot import atomic_write
+from dscan.models.structures import Report
+
+
+class Spool:
+    """
+    Durable queue of the reports of tasks with an id that the server did
+    not receive yet, one json file per task in the spool directory of the
+    agent workspace, so they survive server outages and agent restarts.
+    The reports stay in the reports directory.
+    """
+    # transfers rejected by the server before a report is dropped.
+    MAX_ATTEMPTS = 5
+
+    def __init__(self, path):
+        """
+        :param path: path of the spool directory.
+        """
+        self.path = path
+        # tid -> `Report`
+        self.entries = {}
+        # tid -> number of transfers rejected by the server.
+        self.attempts = {}
+        self.load()
+
+    def load(self):
+        """
+        Reads the reports spooled before the agent restarted, invalid
+        entries are skipped.
+        """
+        try:
+            names = sorted(os.listdir(self.path))
+        except FileNotFoundError:
+            return
+        for name in names:
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.path, name), 'rt') as sfile:
+                    entry = json.load(sfile)
+                self.entries[entry["tid"]] = Report(
+                    entry["filesize"], entry["filename"], entry["filehash"])
+                self.attempts[entry["tid"]] = entry.get("attempts", 0)
+            except (OSError, ValueError, KeyError) as ex:
+                log.error(f"Invalid spool entry {name}: {ex}")
+        if self.entries:
+            log.info(f"{len(self.entries)} reports in the spool")
+
+    def _entry_path(self, tid):
+        return os.path.join(self.path, f"{tid:016x}.json")
+
+    def add(self, tid, report, attempts=0):
+        """
+        :param tid: `int` id of the task.
+        :param report: `Report` of the task.
+        :param attempts: `int` transfers rejected by the server.
+        """
+        entry = {"tid": tid, "filesize": report.filesize,
+                 "filename": report.filename.decode("utf-8"),
+                 "filehash": report.filehash.decode("utf-8"),
+                 "attempts": attempts}
+        os.makedirs(self.path, exist_ok=True)
+        atomic_write(self._entry_path(tid),
+                     lambda sfile: sfile.write(json.dumps(entry).encode()))
+        self.entries[tid] = report
+        self.attempts[tid] = attempts
+
+    def rejected(self, tid):
+        """
+        Counts a transfer of the report rejected by the server, the report
+        is dropped after `MAX_ATTEMPTS`, the server never takes the report
+        of an unknown task for example.
+
+        :param tid: `int` id of the task.
+        :return: `True` if the report was dropped.
+        """
+        if tid not in self.entries:
+            return False
+        attempts = self.attempts.get(tid, 0) + 1
+        if attempts >= self.MAX_ATTEMPTS:
+            log.error(f"Report of task {tid:#x} rejected {attempts} times, "
+                      f"dropped from the spool")
+            self.remove(tid)
+            return True
+        self.add(tid, self.entries[tid], attempts)
+        return False
+
+    def remove(self, tid):
+        """
+        :param tid: `int` id of a task the server received.
+        """
+        self.entries.pop(tid, None)
+        self.attempts.pop(tid, None)
+        try:
+            os.remove(self._entry_path(tid))
+        except FileNotFoundError:
+            pass
+
+    def __iter__(self):
+        """
+        :yield: tuples with the task id and `Report`, in task id order.
+        """
+        yield from sorted(self.entries.items())
+
+    def __len__(self):
+        return len(self.entries)
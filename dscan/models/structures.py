@@ -6,9 +6,14 @@ structures.py
 network elements of the scanner
 """
 import struct
-from enum import IntEnum
+import zlib
+from enum import IntEnum, IntFlag
 from dscan import log
 
+# version 2 added the options id to `CommandExt`, older peers are served
+# with the original messages.
+PROTOCOL_VERSION = 2
+
 
 class Status(IntEnum):
     """
@@ -30,6 +35,66 @@ class Operations(IntEnum):
     COMMAND = 0x03
     STATUS = 0x04
     REPORT = 0x05
+    HELLO = 0x06
+    COMMAND_EXT = 0x07
+    OPTIONS = 0x08
+    TASK_COMMAND = 0x09
+    TASK_REPORT = 0x0A
+    PARTIAL_REPORT = 0x0B
+    CANCEL = 0x0C
+
+
+class Features(IntFlag):
+    """
+    Protocol extensions negotiated with `Hello`, agents that never send a
+    `Hello` are served with the original messages.
+    """
+    NONE = 0x00
+    WIDE_COMMAND = 0x01
+    COMPRESSION = 0x02
+    OPTIONS_REGISTRY = 0x04
+    TASK_IDS = 0x08
+    AGENT_ID = 0x10
+    PARTIAL_REPORTS = 0x20
+    CANCEL = 0x40
+
+
+SUPPORTED_FEATURES = Features.WIDE_COMMAND | Features.COMPRESSION | \
+    Features.OPTIONS_REGISTRY | Features.TASK_IDS | Features.AGENT_ID | \
+    Features.PARTIAL_REPORTS | Features.CANCEL
+
+
+class CommandFlags(IntFlag):
+    """
+    Flags of the `CommandExt` payload.
+    """
+    NONE = 0x00
+    COMPRESSED = 0x01
+    TARGET_LIST = 0x02
+
+
+def recv_all(sock, size):
+    """
+    Receives exactly size bytes, large payloads may be split over several
+    records.
+
+    :param sock: socket to read from.
+    :param size: number of bytes to read.
+    :return: the bytes read, less than size if the peer disconnected.
+    :rtype: `bytes`
+    """
+    data = sock.recv(size)
+    if not data or len(data) == size:
+        return data
+    chunks = [data]
+    nbytes = len(data)
+    while nbytes < size:
+        data = sock.recv(size - nbytes)
+        if not data:
+            break
+        chunks.append(data)
+        nbytes += len(data)
+    return b"".join(chunks)
 
 
 class Structure:
@@ -67,17 +132,20 @@ class Structure:
             if isinstance(self._format, str):
                 struct_size = struct.calcsize(self._format)
                 data = struct.unpack(self._format,
-                                     sock.recv(struct_size))
+                                     recv_all(sock, struct_size))
                 return self.setData(*data)
             else:
                 size_fmt = self._format[0]
                 sz_nbytes = struct.calcsize(size_fmt)
-                sz_bytes = sock.recv(sz_nbytes)
+                sz_bytes = recv_all(sock, sz_nbytes)
                 sz = struct.unpack(size_fmt, sz_bytes)
 
                 data_fmt = self._format[1].format(*sz)
+                if size_fmt.startswith(('<', '>', '!', '@', '=')):
+                    # same byte order and no alignment padding.
+                    data_fmt = f"{size_fmt[0]}{data_fmt}"
                 dt_nbytes = struct.calcsize(data_fmt)
-                dt_bytes = sock.recv(dt_nbytes)
+                dt_bytes = recv_all(sock, dt_nbytes)
                 data = struct.unpack(data_fmt, dt_bytes)
                 return self.setData(*data)
 
@@ -97,7 +165,9 @@ class Structure:
                 fmt = f"{byte_order}B{fmt}"
                 return struct.pack(fmt, self.op_code.value, *values)
             else:
-                fmt = "{0}B{1}".format(*self._format)
+                size_fmt, data_fmt = self._format
+                # the op code goes right after the byte order.
+                fmt = f"{size_fmt[0]}B{size_fmt[1:]}{data_fmt}"
                 lengths = [len(getattr(self, name, '')) for name in
                            self.__slots__
                            if isinstance(getattr(self, name, ''), bytes)]
@@ -142,7 +212,8 @@ class Ready(Structure):
     """
     Ready to start Scan !
     Sent by an Agent to the server
-    With the client's current user id
+    With the client's current user id, and its alias, agents that
+    negotiated `Features.AGENT_ID` send their stable id.
     """
     __slots__ = ('uid', 'alias')
     _format = ('<B', 'I{0}s')
@@ -167,6 +238,123 @@ class Command(Structure):
                f"options={self.options})"
 
 
+class Hello(Structure):
+    """
+    Protocol negotiation !
+    Sent by the agent after the authentication with the features it
+    supports, the server replies with the features both support.
+    final format is  <BBI
+    """
+    __slots__ = ('version', 'features')
+    _format = '<BI'
+    op_code = Operations.HELLO
+
+    def __str__(self):
+        return f"Hello(op_code={self.op_code}, version={self.version}, " \
+               f"features={Features(self.features)!r})"
+
+
+class CommandExt(Structure):
+    """
+    Scan task information with wide payloads !
+    Send by the server to agents that negotiated `Features.WIDE_COMMAND`,
+    target lists can be compressed, and the options can be replaced by the
+    id of a set of options previously sent with `Options`.
+    final format is  <BIIBI?s?s
+    """
+    __slots__ = ('flags', 'oid', 'target', 'options')
+    _format = ('<II', 'BI{0}s{1}s')
+    op_code = Operations.COMMAND_EXT
+
+    @classmethod
+    def build(cls, target, options, compress=0, oid=0):
+        """
+        :param target: `str` target or list of targets separated by spaces.
+        :param options: `str` scan options, ignored if an oid is given.
+        :param compress: compress targets bigger than this size, 0 disables
+            the compression.
+        :param oid: id of the options sent with `Options`, 0 to send the
+            options inline.
+        :return: instance of `CommandExt`
+        """
+        flags = CommandFlags.NONE
+        if len(target.split()) > 1:
+            flags |= CommandFlags.TARGET_LIST
+        target = target.encode("ascii")
+        if compress and len(target) > compress:
+            flags |= CommandFlags.COMPRESSED
+            target = zlib.compress(target)
+        if oid:
+            options = ""
+        return cls(flags, oid, target, options)
+
+    @property
+    def targets(self):
+        """
+        :return: `str` the decompressed target.
+        """
+        target = self.target
+        if self.flags & CommandFlags.COMPRESSED:
+            target = zlib.decompress(target)
+        return target.decode("utf-8")
+
+    def __str__(self):
+        return f"CommandExt(op_code={self.op_code}, " \
+               f"flags={CommandFlags(self.flags)!r}, oid={self.oid}, " \
+               f"target={self.target[:64]}, options={self.options})"
+
+
+class TaskCommand(Structure):
+    """
+    Scan task information with the task id !
+    Send by the server instead of `CommandExt` to agents that negotiated
+    `Features.TASK_IDS`, the agent reports the task with the same id.
+    final format is  <BIIQBI?s?s
+    """
+    __slots__ = ('tid', 'flags', 'oid', 'target', 'options')
+    _format = ('<II', 'QBI{0}s{1}s')
+    op_code = Operations.TASK_COMMAND
+
+    targets = CommandExt.targets
+
+    @classmethod
+    def build(cls, tid, target, options, compress=0, oid=0):
+        """
+        :param tid: `int` id of the task.
+        :param target: `str` target or list of targets separated by spaces.
+        :param options: `str` scan options, ignored if an oid is given.
+        :param compress: compress targets bigger than this size, 0 disables
+            the compression.
+        :param oid: id of the options sent with `Options`, 0 to send the
+            options inline.
+        :return: instance of `TaskCommand`
+        """
+        cmd = CommandExt.build(target, options, compress, oid)
+        return cls(tid, cmd.flags, cmd.oid, cmd.target, cmd.options)
+
+    def __str__(self):
+        return f"TaskCommand(op_code={self.op_code}, tid={self.tid:#x}, " \
+               f"flags={CommandFlags(self.flags)!r}, oid={self.oid}, " \
+               f"target={self.target[:64]}, options={self.options})"
+
+
+class Options(Structure):
+    """
+    Scan options registry !
+    Send by the server once per connection for each distinct set of
+    options, the agent keeps it until disconnected and the following
+    `CommandExt` reference it by id.
+    final format is  <BII?s
+    """
+    __slots__ = ('oid', 'options')
+    _format = ('<I', 'I{0}s')
+    op_code = Operations.OPTIONS
+
+    def __str__(self):
+        return f"Options(op_code={self.op_code}, oid={self.oid}, " \
+               f"options={self.options})"
+
+
 class ExitStatus(Structure):
     """
       Scan Result Status !
@@ -194,3 +382,49 @@ class Report(Structure):
     def __str__(self):
         return f"Report(op_code={self.op_code}, filesize={self.filesize}," \
                f" filename={self.filename!s}, filehash={self.filehash})"
+
+
+class TaskReport(Structure):
+    """
+    Report transfer request of a task sent with `TaskCommand`, the server
+    completes each task id once, so a report sent again is not counted
+    twice.
+    """
+    __slots__ = ('tid', 'filesize', 'filename', 'filehash')
+    _format = ('<BB', 'QI{0}s{1}s')
+    op_code = Operations.TASK_REPORT
+
+    def __str__(self):
+        return f"TaskReport(op_code={self.op_code}, tid={self.tid:#x}, " \
+               f"filesize={self.filesize}, filename={self.filename!s}, " \
+               f"filehash={self.filehash})"
+
+
+class PartialReport(Structure):
+    """
+    Transfer request of the partial report of an interrupted task, sent by
+    agents that negotiated `Features.PARTIAL_REPORTS`, the server keeps the
+    hosts finished and queues the rest of the task again.
+    """
+    __slots__ = ('tid', 'filesize', 'filename', 'filehash')
+    _format = ('<BB', 'QI{0}s{1}s')
+    op_code = Operations.PARTIAL_REPORT
+
+    def __str__(self):
+        return f"PartialReport(op_code={self.op_code}, tid={self.tid:#x}, " \
+               f"filesize={self.filesize}, filename={self.filename!s}, " \
+               f"filehash={self.filehash})"
+
+
+class Cancel(Structure):
+    """
+    Sent by the server while an agent that negotiated `Features.CANCEL`
+    runs a task with an id, the agent stops the scan and reports the hosts
+    finished, or an `ExitStatus` if it has none.
+    """
+    __slots__ = ('tid', )
+    _format = '<Q'
+    op_code = Operations.CANCEL
+
+    def __str__(self):
+        return f"Cancel(op_code={self.op_code}, tid={self.tid:#x})"
@@ -9,17 +9,20 @@ import hashlib
 import hmac
 import ssl
 import os
+import select
 import socket
 import struct
 import threading
+import time
 from socketserver import TCPServer
 from socketserver import ThreadingMixIn
 from socketserver import BaseRequestHandler
 
 from dscan.models.scanner import Context
-from dscan.models.structures import Auth, Status, ExitStatus
-from dscan.models.structures import Command
-from dscan.models.structures import Structure
+from dscan.models.structures import Auth, Cancel, Status, ExitStatus
+from dscan.models.structures import Command, CommandExt, TaskCommand
+from dscan.models.structures import Features, Hello, Options, Structure
+from dscan.models.structures import PROTOCOL_VERSION, SUPPORTED_FEATURES
 from dscan import log
 
 
@@ -31,6 +34,10 @@ class DScanServer(ThreadingMixIn, TCPServer):
     """
     allow_reuse_address = True
     daemon_threads = True
+    # seconds between the checks of the drain.
+    POLL = 1.0
+    # seconds the cancelled tasks have to upload their hosts finished.
+    CANCEL_WAIT = 60
 
     def __init__(self, *args, options, **kwargs):
         self._terminate = threading.Event()
@@ -77,6 +84,62 @@ class DScanServer(ThreadingMixIn, TCPServer):
                                         self, terminate_event=self._terminate,
                                         context=self.ctx)
 
+    def watch_inbox(self):
+        """
+        Polls the inbox file for new targets until the server terminates,
+        meant to run in its own thread.
+        """
+        interval = self.options.inbox_interval
+        while interval > 0 and not self._terminate.wait(interval):
+            try:
+                self.options.ingest(self.ctx)
+            except (OSError, ValueError) as ex:
+                log.error(f"Unable to add the targets of the inbox: {ex}")
+
+    def watch_drain(self):
+        """
+        Polls the drain file until the server terminates, the server is
+        drained once the file is created, meant to run in its own thread.
+        """
+        while not self._terminate.wait(self.POLL):
+            if os.path.isfile(self.options.drain_path):
+                os.remove(self.options.drain_path)
+                self.drain(self.options.drain_timeout)
+                return
+
+    def drain(self, timeout):
+        """
+        Stops issuing tasks and waits for the running tasks to be reported,
+        the tasks still running after the timeout are cancelled for the
+        agents to upload the hosts finished, then the server shuts down and
+        saves the scan.
+
+        :param timeout: `int` seconds to wait for the running tasks.
+        """
+        running = self.ctx.drain()
+        log.info(f"Draining the server, waiting {timeout} seconds for "
+                 f"{running} running tasks")
+        if not self._wait_drained(timeout) and \
+                not self._terminate.is_set():
+            agents = self.ctx.cancel_all()
+            log.info(f"Drain timeout, cancelling {len(agents)} tasks")
+            self._wait_drained(self.CANCEL_WAIT)
+        if not self._terminate.is_set():
+            log.info("Server drained, shutting down")
+            self.shutdown()
+
+    def _wait_drained(self, timeout):
+        """
+        :param timeout: `int` seconds to wait.
+        :return: `True` if the running tasks were all reported in time.
+        """
+        deadline = time.monotonic() + timeout
+        while not self.ctx.isdrained:
+            if time.monotonic() >= deadline or \
+                    self._terminate.wait(self.POLL):
+                return False
+        return True
+
     def shutdown(self):
         """
          An override to allow a local terminate event to be set!
@@ -86,10 +149,18 @@ class DScanServer(ThreadingMixIn, TCPServer):
         self.server_close()
         if not self.ctx.is_finished:
             self.options.save_context(self.ctx)
+        elif self.ctx.journal:
+            self.ctx.journal.remove()
 
 
 class AgentHandler(BaseRequestHandler):
     HEADER = "<B"
+    # max length of the legacy `Command` fields.
+    COMMAND_MAX_LENGTH = 255
+    # targets bigger than this are compressed.
+    COMPRESS_THRESHOLD = 512
+    # seconds between the checks for a cancel of the running task.
+    POLL = 1.0
     """
     Created when an agent connects, holds all the agents available actions.
     Terminates when scan targets finishes or an agent disconnects.
@@ -101,17 +172,50 @@ class AgentHandler(BaseRequestHandler):
         self.msg = None
         self.authenticated = False
         self.connected = False
+        self.features = Features.NONE
+        # options already sent to the agent, options -> id
+        self.options_ids = {}
+        # stable id of agents that negotiated `Features.AGENT_ID`.
+        self.agent_id = None
+        # id of the task running on an agent that negotiated
+        # `Features.CANCEL`, and if it was cancelled.
+        self.tid = 0
+        self.cancelled = False
         super().__init__(*args, **kwargs)
 
     @property
     def agent(self):
         """
-        string representation of a connection ip:port.
+        string representation of a connection ip:port, or the id of the
+        agent if it has a stable one.
 
         :return: str format of agent name ip:port
         """
+        if self.agent_id:
+            return self.agent_id
         return "{}:{}".format(*self.client_address)
 
+    def release(self):
+        """
+        Called when the agent disconnects, its running task is interrupted
+        so that other agent can take it, agents with a stable id keep it
+        during the lease grace period to reconnect and report it.
+        """
+        if self.agent_id:
+            self.ctx.detached(self.agent, self.server.options.lease_grace)
+        else:
+            self.ctx.interrupted(self.agent)
+
+    def interrupt(self):
+        """
+        Interrupts the running task, agents with a stable id get it back
+        first to resume it, unless it was cancelled.
+        """
+        if self.agent_id and not self.cancelled:
+            self.ctx.interrupted(self.agent, hold=True)
+        else:
+            self.ctx.interrupted(self.agent)
+
     @property
     def is_connected(self):
         """
@@ -130,12 +234,13 @@ class AgentHandler(BaseRequestHandler):
         Command dispatcher all logic to decode and dispatch the call.
         """
         self.msg = Structure.create(self.request)
+        self.tid = 0
         if not self.msg:
             self.connected = False
             log.info("Disconnected!")
             # mark any running task as interrupted
             # so that other agent can take it later
-            self.ctx.interrupted(self.agent)
+            self.release()
             return
 
         command_name = f"do_{self.msg.op_code.name.lower()}"
@@ -153,6 +258,20 @@ class AgentHandler(BaseRequestHandler):
         # call the command !
         command()
 
+    def wait_message(self):
+        """
+        Waits for the next message of an agent running a task, the task is
+        cancelled meanwhile if requested with `Context.cancel`.
+        """
+        while self.tid and self.is_connected and not self.request.pending():
+            readable, _, _ = select.select([self.request], [], [], self.POLL)
+            if readable:
+                return
+            if not self.cancelled and self.ctx.iscancelled(self.agent):
+                log.info(f"Cancelling task {self.tid:#x}")
+                self.request.sendall(Cancel(self.tid).pack())
+                self.cancelled = True
+
     def handle(self):
         """
         First method to be called by `BaseRequestHandler`.
@@ -169,13 +288,14 @@ class AgentHandler(BaseRequestHandler):
                     if not self.authenticated:
                         self.do_auth()
 
+                    self.wait_message()
                     self.dispatcher()
                 except (socket.timeout, ConnectionError) as e:
                     log.info(f"{self.client_address} Timeout - {e}")
                     self.connected = False
                     # mark any running task as interrupted
                     # so that other agent can take it later
-                    self.ctx.interrupted(self.agent)
+                    self.release()
 
                 # wait a bit, in case a shutdown was requested!
                 self._terminate.wait(1.0)
@@ -211,6 +331,69 @@ class AgentHandler(BaseRequestHandler):
             self.send_status(Status.UNAUTHORIZED)
             self.request.close()
 
+    def do_hello(self):
+        """
+        Protocol negotiation, replies with the features supported by both
+        server and agent, agents of an older version get none.
+        """
+        self.features = Features(self.msg.features) & SUPPORTED_FEATURES
+        if self.msg.version < PROTOCOL_VERSION:
+            self.features = Features.NONE
+        log.info(f"Agent protocol version {self.msg.version} negotiated "
+                 f"{self.features!r}")
+        self.request.sendall(Hello(PROTOCOL_VERSION, self.features).pack())
+
+    def register_options(self, options):
+        """
+        Sends the options to the agent the first time they are used in this
+        connection.
+
+        :param options: `str` scan options.
+        :return: `int` id of the options.
+        """
+        oid = self.options_ids.get(options)
+        if not oid:
+            oid = len(self.options_ids) + 1
+            log.info(f"Registering options {oid}: {options}")
+            self.request.sendall(Options(oid, options).pack())
+            self.options_ids[options] = oid
+        return oid
+
+    def build_command(self, target, options, tid=0):
+        """
+        :param target: `str` target or list of targets.
+        :param options: `str` scan options.
+        :param tid: `int` id of the task, 0 if it has none.
+        :return: the command message supported by the agent, or None if
+            the task does not fit in the legacy `Command`.
+        """
+        if Features.WIDE_COMMAND in self.features:
+            compress = 0
+            oid = 0
+            if Features.COMPRESSION in self.features:
+                compress = self.COMPRESS_THRESHOLD
+            if Features.OPTIONS_REGISTRY in self.features:
+                oid = self.register_options(options)
+            if tid and Features.TASK_IDS in self.features:
+                return TaskCommand.build(tid, target, options, compress, oid)
+            return CommandExt.build(target, options, compress, oid)
+
+        if not self.fits_command(target, options):
+            return None
+        return Command(target, options)
+
+    def fits_command(self, target, options):
+        """
+        :param target: `str` target or list of targets.
+        :param options: `str` scan options.
+        :return: False if the task does not fit in the command supported by
+            the agent.
+        """
+        if Features.WIDE_COMMAND in self.features:
+            return True
+        return len(target) <= self.COMMAND_MAX_LENGTH and \
+            len(options) <= self.COMMAND_MAX_LENGTH
+
     def do_ready(self):
         """
         After the authentication the agent notifies the server, that is
@@ -224,7 +407,15 @@ class AgentHandler(BaseRequestHandler):
             log.info("Waning! agent is not running as root "
                      "syn scans might abort not enough privileges!")
 
-        target_data = self.ctx.pop(self.agent)
+        if Features.AGENT_ID in self.features:
+            # a reconnected agent takes back its running task.
+            self.agent_id = self.msg.alias.decode("utf-8")
+        self.cancelled = False
+        # legacy agents leave the tasks too big for them to the others.
+        fits = None
+        if Features.WIDE_COMMAND not in self.features:
+            fits = self.fits_command
+        target_data = self.ctx.pop(self.agent, fits)
         if not target_data:
             if self.ctx.is_finished:
                 log.info("Target is None and all stages are finished")
@@ -238,25 +429,34 @@ class AgentHandler(BaseRequestHandler):
                 self.request.sendall(cmd.pack())
             return
 
-        cmd = Command(*target_data)
+        tid = self.ctx.task_id(self.agent)
+        cmd = self.build_command(*target_data, tid)
+        if not cmd:
+            log.info(f"Task {target_data[0]} is too big for a legacy agent")
+            self.ctx.interrupted(self.agent)
+            self.request.sendall(ExitStatus(Status.UNFINISHED).pack())
+            return
+
         self.request.sendall(cmd.pack())
         status_bytes = self.request.recv(1)
 
         if len(status_bytes) == 0:
             self.connected = False
             log.info("Disconnected!")
-            self.ctx.interrupted(self.agent)
+            self.release()
             return
 
         status, = struct.unpack("<B", status_bytes)
         if status == Status.SUCCESS.value:
             log.info("Started scanning !")
             self.ctx.running(self.agent)
+            if Features.CANCEL in self.features:
+                self.tid = tid
         else:
             log.error("Scan command returned Error")
             log.info("Server is Terminating connection!")
             self.connected = False
-            self.ctx.interrupted(self.agent)
+            self.interrupt()
 
     def do_report(self):
         """
@@ -267,30 +467,87 @@ class AgentHandler(BaseRequestHandler):
         if the file hashes match.
         """
         log.info("Agent Reporting Complete Scan!")
+        report = self.ctx.get_report(self.agent,
+                                     self.msg.filename.decode("utf-8"))
+        if self.receive_report(report) and report:
+            self.ctx.completed(self.agent)
+            self.send_status(Status.SUCCESS)
+        else:
+            self.send_status(Status.FAILED)
+
+    def do_task_report(self):
+        """
+        Report transfer of a task sent with its id, the task is completed
+        by its id whatever agent runs it, a report of a task completed before
+        is received and discarded.
+        """
+        tid = self.msg.tid
+        log.info(f"Agent Reporting Complete Scan of task {tid:#x}")
+        report = self.ctx.get_report(self.agent,
+                                     self.msg.filename.decode("utf-8"), tid)
+        if self.receive_report(report) and \
+                (report or self.ctx.iscompleted(tid)):
+            self.ctx.completed(self.agent, tid)
+            self.send_status(Status.SUCCESS)
+        else:
+            self.send_status(Status.FAILED)
+
+    def do_partial_report(self):
+        """
+        Transfer of the partial report of an interrupted task, the hosts
+        finished are kept and the rest of the task is queued again, the
+        whole task is interrupted if the report has no hosts finished.
+        """
+        tid = self.msg.tid
+        log.info(f"Agent Reporting Partial Scan of task {tid:#x}")
+        report = self.ctx.get_partial_report(self.agent, tid)
+        hold = bool(self.agent_id) and not self.cancelled
+        if self.receive_report(report) and report and \
+                self.ctx.salvage(self.agent, tid, hold=hold):
+            self.send_status(Status.SUCCESS)
+        else:
+            self.interrupt()
+            self.send_status(Status.FAILED)
+
+    def do_status(self):
+        """
+        State of a cancelled task the agent stopped before any host
+        finished, the task is interrupted.
+        """
+        log.info(f"Agent stopped its task with status {self.msg.status}")
+        self.interrupt()
+
+    def receive_report(self, report):
+        """
+        Receives the report announced by the current message.
+
+        :param report: file object to save the report, None to discard it.
+        :return: `True` if the hash of the report matches.
+        """
         log.info(f"Filename {self.msg.filename} total file size "
                  f"{self.msg.filesize} file hash {self.msg.filehash}")
 
         file_size = self.msg.filesize
         nbytes = 0
-        report = self.ctx.get_report(self.agent,
-                                     self.msg.filename.decode("utf-8"))
         try:
             digest = hashlib.sha512()
             self.ctx.downloading(self.agent)
             while nbytes < file_size:
                 data = self.request.recv(1024)
-                report.write(data)
+                if not data:
+                    raise ConnectionError("Disconnected during the report "
+                                          "transfer")
+                if report:
+                    report.write(data)
                 digest.update(data)
                 nbytes = nbytes + len(data)
 
             if not hmac.compare_digest(digest.hexdigest().encode("utf-8"),
                                        self.msg.filehash):
                 log.error(f"Files are not equal! {digest.hexdigest()}")
-                self.send_status(Status.FAILED)
-            else:
-                log.info("files are equal!")
-                self.ctx.completed(self.agent)
-                self.send_status(Status.SUCCESS)
+                return False
+            log.info("files are equal!")
+            return True
         finally:
             if report:
                 report.flush()
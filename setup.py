@@ -23,6 +23,9 @@ setup(
     install_requires=[
         'python-libnmap'
     ],
+    extras_require={
+        'numpy': ['numpy'],
+    },
     scripts=['bin/dscan'],
     package_data={
           name: ['data/agent.conf', 'data/dscan.conf'],
@@ -2,6 +2,7 @@ import hashlib
 import hmac
 import os
 import struct
+import threading
 import unittest
 from argparse import Namespace
 from socket import timeout
@@ -10,8 +11,12 @@ from unittest.mock import MagicMock, call, mock_open, patch
 import tests
 from dscan.client import Agent
 from dscan.models.scanner import Config, ScanProcess
-from dscan.models.structures import (Auth, Command, ExitStatus, Ready, Report,
-                                     Status)
+from dscan.models.structures import (PROTOCOL_VERSION, SUPPORTED_FEATURES,
+                                     Auth, Cancel, Command, CommandExt,
+                                     ExitStatus,
+                                     Features, Hello, Options, PartialReport,
+                                     Ready, Report, Status, TaskCommand,
+                                     TaskReport)
 
 
 class TestAgentHandler(unittest.TestCase):
@@ -33,6 +38,11 @@ class TestAgentHandler(unittest.TestCase):
                          b'\xc6:SB\xeff\x15\r\xcb\xe9\xa4\xefO\x03i\xe9' \
                          b'\xefoMz\x8b'
         self.cfg = tests.create_config()
+        self.cfg.read_dict({"agent": {"retries": "3"}})
+        self.patcher_backoff = patch.object(Agent, 'BACKOFF', 0)
+        self.patcher_backoff.start()
+        self.addCleanup(self.patcher_backoff.stop)
+        self.hello = Hello(PROTOCOL_VERSION, SUPPORTED_FEATURES)
         self.patcher_makedirs = patch('os.makedirs')
         mos_isfile = patch('os.path.isfile')
         mos_isfile.return_value = True
@@ -63,7 +73,7 @@ class TestAgentHandler(unittest.TestCase):
             call.recv(128),
             call.sendall(Auth(self.digest_auth).pack()),
             call.recv(1),
-            call.sendall(Ready(os.getuid(), "AAAAAA").pack()),
+            call.sendall(self.hello.pack()),
             call.recv(1),
             call.close(),
             call.close(),
@@ -73,7 +83,7 @@ class TestAgentHandler(unittest.TestCase):
             call.recv(128),
             call.sendall(Auth(self.digest_auth).pack()),
             call.recv(1),
-            call.sendall(Ready(os.getuid(), "AAAAAA").pack()),
+            call.sendall(self.hello.pack()),
             call.recv(1),
             call.close(),
             call.close(),
@@ -103,7 +113,8 @@ class TestAgentHandler(unittest.TestCase):
         self.patcher_urandom.stop()
 
     def check_mock_calls_connect_disconnect(self):
-        self.mock_context.wrap_socket.assert_called_once()
+        # a new socket is wrapped for each connection.
+        self.mock_context.wrap_socket.assert_called()
         self.mock_context.load_verify_locations.assert_called_once()
         self.mock_socket.connect.assert_called()
         self.mock_socket.close.assert_called()
@@ -139,7 +150,7 @@ class TestAgentHandler(unittest.TestCase):
             call.recv(128),
             call.sendall(Auth(self.digest_auth).pack()),
             call.recv(1),
-            call.sendall(Ready(os.getuid(), "AAAAAA").pack()),
+            call.sendall(self.hello.pack()),
             call.recv(1),
             call.close(),
             call.close(),
@@ -153,11 +164,9 @@ class TestAgentHandler(unittest.TestCase):
             call.close(),
         ]
         self.mock_socket.recv = mock_ex
-        with patch('random.choice') as mock_choice:
-            mock_choice.return_value = "A"
-            agent = Agent(self.settings)
-            agent.start()
-            self.mock_socket.assert_has_calls(expected)
+        agent = Agent(self.settings)
+        agent.start()
+        self.mock_socket.assert_has_calls(expected)
 
     def test_reset_retry_count_timeout(self):
         mock_ex = MagicMock()
@@ -173,11 +182,9 @@ class TestAgentHandler(unittest.TestCase):
                                timeout(),
                                ]
         self.mock_socket.recv = mock_ex
-        with patch('random.choice') as mock_choice:
-            mock_choice.return_value = "A"
-            agent = Agent(self.settings)
-            agent.start()
-            self.mock_socket.assert_has_calls(self.expected_calls_timeout)
+        agent = Agent(self.settings)
+        agent.start()
+        self.mock_socket.assert_has_calls(self.expected_calls_timeout)
 
     @patch('os.getuid')
     def test_full(self, mgetuid):
@@ -190,31 +197,31 @@ class TestAgentHandler(unittest.TestCase):
         expected_calls = [
             call.connect(('127.0.0.1', 2040)),
             call.sendall(Auth(self.digest_auth).pack()),
-            call.sendall(Ready(0, "AAAAAA").pack()),
+            call.sendall(self.hello.pack()),
+            call.sendall(Ready(0, self.settings.agent_id).pack()),
             call.sendall(expected.pack()),
             call.sendall(data),
             call.sendall(data),
-            call.sendall(Ready(0, "AAAAAA").pack()),
+            call.sendall(Ready(0, self.settings.agent_id).pack()),
             call.close()
         ]
 
         self.mock_server_responses(Auth(self.challenge), struct.pack("<B", 0),
+                                   self.hello,
                                    Command("127.0.0.1", "-sV -Pn -p1-1000"),
                                    struct.pack("<B", 1), struct.pack("<B", 0))
 
         report_mock = mock_open(read_data=data)
-        with patch('random.choice') as mock_choice:
-            mock_choice.return_value = "A"
-            with patch('builtins.open', report_mock):
-                patcher = patch.object(ScanProcess, 'run',
-                                       return_value=expected)
-                patcher.start()
-                agent = Agent(self.settings)
-                agent.start()
-                self.check_mock_calls_connect_disconnect()
-                self.mock_socket.assert_has_calls(expected_calls,
-                                                  any_order=True)
-                patcher.stop()
+        with patch('builtins.open', report_mock):
+            patcher = patch.object(ScanProcess, 'run',
+                                   return_value=expected)
+            patcher.start()
+            agent = Agent(self.settings)
+            agent.start()
+            self.check_mock_calls_connect_disconnect()
+            self.mock_socket.assert_has_calls(expected_calls,
+                                              any_order=True)
+            patcher.stop()
 
     @patch('os.getuid')
     def test_wait(self, mgetuid):
@@ -227,33 +234,253 @@ class TestAgentHandler(unittest.TestCase):
         expected_calls = [
             call.connect(('127.0.0.1', 2040)),
             call.sendall(Auth(self.digest_auth).pack()),
-            call.sendall(Ready(0, "AAAAAA").pack()),
+            call.sendall(self.hello.pack()),
+            call.sendall(Ready(0, self.settings.agent_id).pack()),
             call.sendall(expected.pack()),
             call.sendall(data),
             call.sendall(data),
-            call.sendall(Ready(0, "AAAAAA").pack()),
+            call.sendall(Ready(0, self.settings.agent_id).pack()),
             call.close()
         ]
 
         self.mock_server_responses(Auth(self.challenge),
                                    struct.pack("<B", 0),
+                                   self.hello,
                                    ExitStatus(Status.UNFINISHED),
                                    Command("127.0.0.1", "-sV -Pn -p1-1000"),
                                    struct.pack("<B", 1), struct.pack("<B", 0))
 
         report_mock = mock_open(read_data=data)
-        with patch('random.choice') as mock_choice:
-            mock_choice.return_value = "A"
-            with patch('builtins.open', report_mock):
-                patcher = patch.object(ScanProcess, 'run',
-                                       return_value=expected)
-                patcher.start()
+        with patch('builtins.open', report_mock):
+            patcher = patch.object(ScanProcess, 'run',
+                                   return_value=expected)
+            patcher.start()
+            agent = Agent(self.settings)
+            agent.start()
+            self.check_mock_calls_connect_disconnect()
+            self.mock_socket.assert_has_calls(expected_calls,
+                                              any_order=True)
+            patcher.stop()
+
+    @patch('os.getuid')
+    def test_legacy_server(self, mgetuid):
+        mgetuid.return_value = 0
+        # servers without Hello close the connection.
+        hello = [struct.pack("<B", 1), struct.pack("<128s", self.challenge),
+                 struct.pack("<B", 0), b""]
+        buffer = tests.BufMock(Auth(self.challenge), struct.pack("<B", 0),
+                               Command("", ""))
+        self.mock_socket.recv = MagicMock(
+            side_effect=lambda size: hello.pop(0) if hello
+            else buffer.read(size))
+        agent = Agent(self.settings)
+        agent.start()
+        self.assertTrue(agent.legacy)
+        self.assertEqual(Features.NONE, agent.features)
+        self.assertEqual(2, self.mock_socket.connect.call_count)
+        sent = [args[0] for args, _ in
+                self.mock_socket.sendall.call_args_list]
+        self.assertEqual(1, sent.count(self.hello.pack()))
+        self.mock_socket.sendall.assert_any_call(
+            Ready(0, self.settings.agent_id).pack())
+
+    @patch('os.getuid')
+    def test_hello_dropped_restart(self, mgetuid):
+        mgetuid.return_value = 0
+        auth = [struct.pack("<B", 1), struct.pack("<128s", self.challenge),
+                struct.pack("<B", 0)]
+        # the server restarts, the Hello and the next connection are lost.
+        reads = auth + [b""] + auth + [b""]
+        buffer = tests.BufMock(Auth(self.challenge), struct.pack("<B", 0),
+                               self.hello, Command("", ""))
+        self.mock_socket.recv = MagicMock(
+            side_effect=lambda size: reads.pop(0) if reads
+            else buffer.read(size))
+        agent = Agent(self.settings)
+        agent.start()
+        self.assertFalse(agent.legacy)
+        self.assertEqual(SUPPORTED_FEATURES, agent.features)
+        sent = [args[0] for args, _ in
+                self.mock_socket.sendall.call_args_list]
+        self.assertEqual(2, sent.count(self.hello.pack()))
+
+    @patch('os.getuid')
+    def test_old_version_server(self, mgetuid):
+        mgetuid.return_value = 0
+        self.mock_server_responses(Auth(self.challenge), struct.pack("<B", 0),
+                                   Hello(1, SUPPORTED_FEATURES),
+                                   Command("", ""))
+        agent = Agent(self.settings)
+        agent.start()
+        # the first version sent CommandExt without the options id.
+        self.assertEqual(Features.NONE, agent.features)
+
+    @patch('os.getuid')
+    def test_command_ext(self, mgetuid):
+        mgetuid.return_value = 0
+        targets = " ".join(f"10.0.{n}.1" for n in range(100))
+        self.mock_server_responses(Auth(self.challenge), struct.pack("<B", 0),
+                                   self.hello,
+                                   CommandExt.build(targets, "-sS", 512),
+                                   struct.pack("<B", 1))
+        with patch.object(ScanProcess, 'run', return_value=None) as mrun:
+            agent = Agent(self.settings)
+            agent.start()
+            self.assertEqual(SUPPORTED_FEATURES, agent.features)
+            mrun.assert_called_once_with(targets, "-sS", agent.send_status, 0)
+
+    @patch('os.getuid')
+    def test_command_options_registry(self, mgetuid):
+        mgetuid.return_value = 0
+        self.mock_server_responses(Auth(self.challenge), struct.pack("<B", 0),
+                                   self.hello, Options(1, "-sS -p 22"),
+                                   CommandExt.build("10.0.0.1", "", oid=1),
+                                   CommandExt.build("10.0.0.2", "", oid=1))
+        with patch.object(ScanProcess, 'run', return_value=None) as mrun:
+            agent = Agent(self.settings)
+            agent.start()
+            mrun.assert_has_calls([
+                call("10.0.0.1", "-sS -p 22", agent.send_status, 0),
+                call("10.0.0.2", "-sS -p 22", agent.send_status, 0)])
+
+    @patch('os.replace')
+    @patch('os.fsync')
+    @patch('os.getuid')
+    def test_task_report(self, mgetuid, mfsync, mreplace):
+        mgetuid.return_value = 0
+        tid = 1 << 56 | 42
+        digest = hashlib.sha512(b"pickabu").hexdigest()
+        data = "hello hello report mock\n"
+        report = Report(len(data), "fu.xml", digest)
+        self.mock_server_responses(Auth(self.challenge), struct.pack("<B", 0),
+                                   self.hello,
+                                   TaskCommand.build(tid, "10.0.0.1", "-sS"),
+                                   struct.pack("<B", 0))
+        with patch('builtins.open', mock_open(read_data=data)):
+            with patch.object(ScanProcess, 'run', return_value=report):
                 agent = Agent(self.settings)
                 agent.start()
-                self.check_mock_calls_connect_disconnect()
-                self.mock_socket.assert_has_calls(expected_calls,
-                                                  any_order=True)
-                patcher.stop()
+        self.mock_socket.sendall.assert_any_call(
+            TaskReport(tid, len(data), "fu.xml", digest).pack())
+        self.assertNotIn(call(report.pack()),
+                         self.mock_socket.sendall.call_args_list)
+
+    @patch('os.replace')
+    @patch('os.fsync')
+    @patch('os.getuid')
+    def test_resume_report(self, mgetuid, mfsync, mreplace):
+        mgetuid.return_value = 0
+        tid = 1 << 56 | 42
+        digest = hashlib.sha512(b"pickabu").hexdigest()
+        data = "hello hello report mock\n"
+        report = Report(len(data), "fu.xml", digest)
+        lost = MagicMock(spec=["read"])
+        lost.read.side_effect = [ConnectionResetError(), b""]
+        # the connection is lost before the report status.
+        self.mock_server_responses(Auth(self.challenge), struct.pack("<B", 0),
+                                   self.hello,
+                                   TaskCommand.build(tid, "10.0.0.1", "-sS"),
+                                   lost, Auth(self.challenge),
+                                   struct.pack("<B", 0), self.hello,
+                                   struct.pack("<B", 0))
+        with patch('builtins.open', mock_open(read_data=data)):
+            with patch.object(ScanProcess, 'run', return_value=report) as m:
+                agent = Agent(self.settings)
+                agent.start()
+        m.assert_called_once()
+        sent = [args[0] for args, _ in
+                self.mock_socket.sendall.call_args_list]
+        self.assertEqual(2, sent.count(
+            TaskReport(tid, len(data), "fu.xml", digest).pack()))
+        self.assertEqual(0, len(agent.spool))
+
+    @patch('os.replace')
+    @patch('os.fsync')
+    @patch('os.getuid')
+    def test_report_failed_spooled(self, mgetuid, mfsync, mreplace):
+        mgetuid.return_value = 0
+        tid = 1 << 56 | 42
+        digest = hashlib.sha512(b"pickabu").hexdigest()
+        data = "hello hello report mock\n"
+        report = Report(len(data), "fu.xml", digest)
+        failed = struct.pack("<B", Status.FAILED)
+        self.mock_server_responses(Auth(self.challenge), struct.pack("<B", 0),
+                                   self.hello,
+                                   TaskCommand.build(tid, "10.0.0.1", "-sS"),
+                                   failed, failed, failed, failed)
+        with patch('builtins.open', mock_open(read_data=data)):
+            with patch.object(ScanProcess, 'run', return_value=report):
+                agent = Agent(self.settings)
+                agent.start()
+        # the report is kept to be sent again.
+        self.assertEqual([tid], [entry for entry, _ in agent.spool])
+        self.assertEqual(1, agent.spool.attempts[tid])
+
+    @patch('os.getuid')
+    def test_partial_report(self, mgetuid):
+        mgetuid.return_value = 0
+        tid = 1 << 56 | 42
+        digest = hashlib.sha512(b"pickabu").hexdigest()
+        data = "<nmaprun><host></host>"
+        partial = Report(len(data), "fu-42.part", digest)
+        self.mock_server_responses(Auth(self.challenge), struct.pack("<B", 0),
+                                   self.hello,
+                                   TaskCommand.build(tid, "10.0.0.0/24",
+                                                     "-sS"),
+                                   struct.pack("<B", 0))
+        with patch('builtins.open', mock_open(read_data=data)):
+            with patch.object(ScanProcess, 'run', return_value=None):
+                with patch.object(ScanProcess, 'partial_report',
+                                  return_value=partial), \
+                        patch.object(ScanProcess, 'salvaged') as msalvaged:
+                    agent = Agent(self.settings)
+                    agent.start()
+        self.mock_socket.sendall.assert_any_call(
+            PartialReport(tid, len(data), "fu-42.part", digest).pack())
+        self.assertNotIn(call(struct.pack("<B", Status.FAILED)),
+                         self.mock_socket.sendall.call_args_list)
+        # the normal output is kept to resume the hosts left.
+        msalvaged.assert_called_once()
+
+    @patch('os.getuid')
+    def test_cancel(self, mgetuid):
+        mgetuid.return_value = 0
+        tid = 1 << 56 | 42
+        stopped = threading.Event()
+
+        def scan(target, options, callback, task_id):
+            callback(Status.SUCCESS)
+            self.assertTrue(stopped.wait(5))
+            return None
+        self.mock_server_responses(Auth(self.challenge), struct.pack("<B", 0),
+                                   self.hello,
+                                   TaskCommand.build(tid, "10.0.0.1", "-sS"),
+                                   Cancel(tid))
+        self.mock_socket.pending.return_value = 1
+        with patch.object(ScanProcess, 'run', side_effect=scan), \
+                patch.object(ScanProcess, 'cancel',
+                             side_effect=stopped.set) as mcancel, \
+                patch.object(ScanProcess, 'partial_report',
+                             return_value=None):
+            agent = Agent(self.settings)
+            agent.start()
+        mcancel.assert_called_once()
+        # the server is told the task stopped without hosts finished.
+        self.mock_socket.sendall.assert_any_call(
+            ExitStatus(Status.FAILED).pack())
+
+    def test_backoff(self):
+        agent = Agent(self.settings)
+        with patch.object(agent, '_terminate') as mterminate:
+            mterminate.is_set.return_value = False
+            with patch.object(Agent, 'BACKOFF', 1):
+                for retries in (1, 2, 3):
+                    agent.con_retries = retries
+                    agent.backoff()
+        delays = [args[0] for args, _ in mterminate.wait.call_args_list]
+        self.assertEqual(2, len(delays))
+        self.assertTrue(0.5 <= delays[0] <= 1)
+        self.assertTrue(1 <= delays[1] <= 2)
 
     @patch('os.getuid')
     def test_full_unsuccessful_report(self, mgetuid):
@@ -269,7 +496,8 @@ class TestAgentHandler(unittest.TestCase):
         expected_calls = [
             call.connect(('127.0.0.1', 2040)),
             call.sendall(Auth(digest_auth).pack()),
-            call.sendall(Ready(0, "AAAAAA").pack()),
+            call.sendall(self.hello.pack()),
+            call.sendall(Ready(0, self.settings.agent_id).pack()),
             call.sendall(expected.pack()),
             call.sendall(data),
             call.sendall(data),
@@ -278,23 +506,22 @@ class TestAgentHandler(unittest.TestCase):
         ]
 
         self.mock_server_responses(Auth(self.challenge), struct.pack("<B", 0),
+                                   self.hello,
                                    Command("127.0.0.1", "-sV -Pn -p1-1000"),
                                    struct.pack("<B", 1), struct.pack("<B", 1),
                                    struct.pack("<B", 1))
 
         report_mock = mock_open(read_data=data)
-        with patch('random.choice') as mock_choice:
-            mock_choice.return_value = "A"
-            with patch('builtins.open', report_mock):
-                patcher = patch.object(ScanProcess, 'run',
-                                       return_value=expected)
-                patcher.start()
-                agent = Agent(self.settings)
-                agent.start()
-                self.check_mock_calls_connect_disconnect()
-                self.mock_socket.assert_has_calls(expected_calls,
-                                                  any_order=True)
-                patcher.stop()
+        with patch('builtins.open', report_mock):
+            patcher = patch.object(ScanProcess, 'run',
+                                   return_value=expected)
+            patcher.start()
+            agent = Agent(self.settings)
+            agent.start()
+            self.check_mock_calls_connect_disconnect()
+            self.mock_socket.assert_has_calls(expected_calls,
+                                              any_order=True)
+            patcher.stop()
 
 
 if __name__ == '__main__':
@@ -6,9 +6,11 @@ import pickle
 import unittest
 from argparse import Namespace
 from configparser import ConfigParser, ExtendedInterpolation
+from io import BytesIO
 from unittest.mock import mock_open, patch
 
 from dscan.models.scanner import Config, Context
+from dscan.models.snapshot import SnapshotError
 
 
 class TestSettings(unittest.TestCase):
@@ -203,19 +205,36 @@ class TestSettings(unittest.TestCase):
                 misfile.return_value = False
                 self.config.target_optimization(self.targets)
                 mopen.assert_any_call('data/run/targets.work', "wt")
-                self.assertEqual(handle.write.call_count, 2)
-                handle.writelines.assert_called_once()
+                self.assertEqual(handle.write.call_count, 3)
+                handle.writelines.assert_not_called()
                 handle.write.assert_any_call('192.168.10.0/28\n')
                 handle.write.assert_any_call('192.168.12.0/24\n')
+                handle.write.assert_any_call('10.16.0.0/16\n')
 
-    def test_save_context(self):
+    @patch('os.replace')
+    @patch('os.fsync')
+    def test_save_context(self, mock_fsync, mock_replace):
+        snapshot = BytesIO()
         with patch('builtins.open', mock_open()) as mopen:
-            handle = mopen.return_value
+            mopen.return_value.write = snapshot.write
             ctx = Context(self.config)
             self.config.save_context(ctx)
-            mopen.assert_any_call('data/run/current.trace', "wb")
-            self.assertEqual(1, handle.write.call_count)
-            handle.write.assert_any_call(pickle.dumps(ctx))
+            mopen.assert_any_call('data/run/current.trace.tmp', "wb")
+            mock_replace.assert_called_once_with('data/run/current.trace.tmp',
+                                                 'data/run/current.trace')
+        self.assertTrue(snapshot.getvalue().startswith(b"DSCTX"))
+        snapshot.seek(0)
+        restored = Context.load(snapshot)
+        self.assertEqual(ctx.nstages, restored.nstages)
+        self.assertEqual([stage.options for stage in ctx.stage_list],
+                         [stage.options for stage in restored.stage_list])
+        self.assertEqual(0, len(restored.pending))
+
+    def test_load_invalid_context(self):
+        with self.assertRaises(SnapshotError):
+            Context.load(BytesIO(b"DSCTX\x63\x00"))
+        with self.assertRaises(SnapshotError):
+            Context.load(BytesIO(pickle.dumps([])))
 
     def test_agent(self):
         with patch('os.makedirs') as mock_makedirs:
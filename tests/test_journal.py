@@ -0,0 +1,50 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from dscan.models.journal import Journal, Op
+
+
+class TestJournal(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, "current.journal")
+        self.snapshot_path = os.path.join(self.tmpdir, "current.trace")
+        self.journal = Journal(self.path, self.snapshot_path, size=3)
+        self.addCleanup(self.journal.close)
+
+    def test_replay(self):
+        self.assertFalse(self.journal.exists())
+        self.journal.append(Op.STAGE, "discovery", value="-sn -n")
+        self.journal.append(Op.ISSUED, "discovery", 0, "10.0.0.0/24")
+        self.journal.append(Op.COMPLETED, "discovery", 0)
+        self.assertTrue(self.journal.isfull)
+        # a record cut by a crash.
+        with open(self.path, 'at') as jfile:
+            jfile.write("C\tdiscovery\t1")
+        journal = Journal(self.path, self.snapshot_path)
+        self.assertEqual([(Op.STAGE, "discovery", None, "-sn -n"),
+                          (Op.ISSUED, "discovery", 0, "10.0.0.0/24"),
+                          (Op.COMPLETED, "discovery", 0, "")],
+                         list(journal.replay()))
+        self.assertEqual(3, journal.nrecords)
+
+    def test_compact(self):
+        self.journal.append(Op.COMPLETED, "discovery", 0)
+        self.journal.compact(lambda sfile: sfile.write(b"snapshot"))
+        self.assertFalse(self.journal.exists())
+        self.assertFalse(self.journal.isfull)
+        with open(self.snapshot_path, 'rb') as sfile:
+            self.assertEqual(b"snapshot", sfile.read())
+        self.journal.append(Op.COMPLETED, "discovery", 1)
+        self.assertEqual([(Op.COMPLETED, "discovery", 1, "")],
+                         list(Journal(self.path, "").replay()))
+        self.journal.remove()
+        self.assertFalse(os.path.exists(self.path))
+
+
+if __name__ == '__main__':
+    unittest.main()
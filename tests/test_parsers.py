@@ -1,8 +1,22 @@
 import os
+import random
+import shutil
+import socket
+import tempfile
 import unittest
+from itertools import product
 from unittest.mock import call, mock_open, patch
 
-from dscan.models.parsers import ReportsParser, TargetOptimization
+from dscan.models.parsers import (ReportsParser, Resolver,
+                                   TargetOptimization, format_ports,
+                                   parse_ports, remaining_targets,
+                                   salvage_report, target_addresses)
+from tests import log
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 class TestReportsParsers(unittest.TestCase):
@@ -21,6 +35,268 @@ class TestReportsParsers(unittest.TestCase):
         values = results_parser.hosts_up()
         self.assertEqual(values, ["172.16.71.132", "172.16.71.133"])
 
+    def test_report_open_ports(self):
+        reports_path = os.path.join(os.path.dirname(__file__), 'data')
+        results_parser = ReportsParser(reports_path,
+                                       'discovery-nonstandar.xml')
+        self.assertEqual([("172.16.71.132", 9080)],
+                         list(results_parser.open_ports()))
+
+    def test_report_hosts_status_user_set(self):
+        report = '<?xml version="1.0"?><nmaprun>' \
+                 '<host><status state="up" reason="user-set"/>' \
+                 '<address addr="10.0.0.1" addrtype="ipv4"/>' \
+                 '<ports><port protocol="tcp" portid="22">' \
+                 '<state state="filtered"/></port></ports></host>' \
+                 '<host><status state="up" reason="user-set"/>' \
+                 '<address addr="10.0.0.2" addrtype="ipv4"/>' \
+                 '<ports><port protocol="tcp" portid="22">' \
+                 '<state state="closed"/></port></ports></host></nmaprun>'
+        reports_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, reports_path)
+        with open(os.path.join(reports_path, "stage1-0.xml"), "wt") as rfile:
+            rfile.write(report)
+        # hosts set up by -Pn are alive only if a port replied.
+        self.assertEqual([("10.0.0.1", False), ("10.0.0.2", True)],
+                         list(ReportsParser(reports_path,
+                                            "stage1-*.xml").hosts_status()))
+
+    def test_report_hosts_status(self):
+        reports_path = os.path.join(os.path.dirname(__file__), 'data')
+        results_parser = ReportsParser(reports_path,
+                                       'discovery-nonstandar.xml')
+        self.assertEqual([("172.16.71.132", True)],
+                         list(results_parser.hosts_status()))
+
+    def test_target_addresses(self):
+        self.assertEqual(["10.0.0.254", "10.0.0.255"],
+                         list(target_addresses("10.0.0.254/31")))
+        self.assertEqual(["10.0.0.1", "10.0.0.2", "10.0.0.3"],
+                         list(target_addresses("10.0.0.1-3")))
+        self.assertEqual(["10.0.1.1", "10.0.1.5", "10.0.2.1", "10.0.2.5"],
+                         list(target_addresses("10.0.1-2.1,5")))
+
+    def test_salvage_report(self):
+        partial = b'<?xml version="1.0"?><nmaprun args="nmap -sn">' \
+                  b'<host><address addr="10.0.0.1" addrtype="ipv4"/>' \
+                  b'<address addr="00:11:22:33:44:55" addrtype="mac"/>' \
+                  b'</host><hosthint><address addr="10.0.0.2"/></hosthint>' \
+                  b'<taskpro'
+        report, done = salvage_report(partial)
+        self.assertEqual({"10.0.0.1"}, done)
+        self.assertTrue(report.endswith(b"</host>\n</nmaprun>\n"))
+        self.assertEqual((None, set()), salvage_report(partial[:60]))
+        self.assertRaises(ValueError, salvage_report, b"<host></host>")
+
+    def test_remaining_targets(self):
+        self.assertEqual("10.0.0.0/32 10.0.0.3/32 10.0.0.4/31",
+                         remaining_targets("10.0.0.0/30 10.0.0.4/31",
+                                           {"10.0.0.1", "10.0.0.2"}))
+        self.assertEqual("10.0.1.5/32 10.0.2.1/32",
+                         remaining_targets("10.0.1-2.1,5", {"10.0.1.1",
+                                                           "10.0.2.5"}))
+        self.assertEqual("", remaining_targets("10.0.0.1", {"10.0.0.1"}))
+        self.assertEqual("2001:db8::1/128",
+                         remaining_targets("2001:db8::/127",
+                                           {"2001:db8:0:0::0"}))
+
+    def test_ports_spec(self):
+        ports = parse_ports("443,80,20-22,80")
+        self.assertEqual([443, 80, 20, 21, 22], ports)
+        self.assertEqual("20-22,80,443", format_ports(ports))
+        self.assertEqual("443,80,20-22",
+                         format_ports([443, 80, 20, 21, 22], ordered=True))
+
+    def test_pack_sparse_hosts(self):
+        targets = ["10.0.0.1", "10.0.5.7", "10.0.9.3", "10.0.9.4",
+                   "10.1.0.1", "2001:db8::1"]
+        expected_write = [
+            call().write('10.0.0.1/32 10.0.5.7/32 10.0.9.3-4\n'),
+            call().write('10.1.0.1/32\n'),
+            call().write('2001:db8::1/128\n'),
+        ]
+        mock_obj = mock_open()
+        with patch('builtins.open', mock_obj) as mopen:
+            target_optimize = TargetOptimization("fake/live.work", pack=4)
+            target_optimize.save(targets)
+            mopen.assert_has_calls(expected_write)
+            self.assertEqual(3, mock_obj().write.call_count)
+
+    def test_pack_max_length(self):
+        targets = [f"10.0.{n}.1" for n in range(0, 20, 2)]
+        mock_obj = mock_open()
+        with patch('builtins.open', mock_obj):
+            target_optimize = TargetOptimization("fake/live.work", pack=10,
+                                                 max_length=40)
+            target_optimize.save(targets)
+            for line in mock_obj().write.call_args_list:
+                self.assertLessEqual(len(line.args[0].strip()), 40)
+            self.assertEqual(4, mock_obj().write.call_count)
+
+    def test_external_sort(self):
+        wdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, wdir)
+        targets = [f"10.{n // 256}.{n % 256}.1" for n in range(0, 2000, 3)]
+        targets += ["192.168.0.1", "192.168.0.2", "2001:db8::1"]
+        targets += targets[:40]
+        random.Random(7).shuffle(targets)
+        expected = []
+        for chunk_size, engine in product((1000000, 16), (numpy, None)):
+            work_path = os.path.join(wdir, f"targets-{chunk_size}.work")
+            with patch('dscan.models.parsers.numpy', engine):
+                target_optimize = TargetOptimization(work_path,
+                                                     chunk_size=chunk_size)
+                target_optimize.save(iter(targets))
+            with open(work_path) as qfile:
+                expected.append(qfile.read().splitlines())
+        for result in expected[1:]:
+            self.assertEqual(expected[0], result)
+        self.assertEqual(669, len(expected[0]))
+        self.assertEqual("10.0.0.1/32", expected[0][0])
+        self.assertEqual("192.168.0.1-2", expected[0][-2])
+        self.assertEqual("2001:db8::1/128", expected[0][-1])
+        # the spilled chunks are removed.
+        self.assertEqual(2, len(os.listdir(wdir)))
+
+    def test_covered_hosts(self):
+        targets = ["10.0.0.7", "10.0.0.0/29", "10.0.0.8", "10.0.0.9",
+                   "10.0.0.9", "172.16.3.4", "172.16.0.0/16",
+                   "2001:db8::5", "2001:db8::/120", "2001:db8::1:1"]
+        for engine in (numpy, None):
+            mock_obj = mock_open()
+            with patch('builtins.open', mock_obj), \
+                    patch('dscan.models.parsers.numpy', engine):
+                TargetOptimization("fake/targets.work").save(targets)
+            writes = [line.args[0] for line in
+                      mock_obj().write.call_args_list]
+            self.assertEqual(["10.0.0.0/29\n", "172.16.0.0/16\n",
+                              "2001:db8::/120\n", "10.0.0.8/31\n",
+                              "2001:db8::1:1/128\n"], writes)
+
+    def test_exclude(self):
+        targets = ["10.0.0.0/16", "10.1.0.5", "10.1.0.6", "10.1.0.7",
+                   "192.168.1.0/24", "192.168.2.0/24"]
+        excluded = ["10.0.1.0/24", "10.0.2.7", "10.1.0.6",
+                    "192.168.1.128/25", "192.168.2.0-9", "# comment"]
+        mock_obj = mock_open()
+        with patch('builtins.open', mock_obj):
+            target_optimize = TargetOptimization("fake/targets.work")
+            target_optimize.exclude(excluded)
+            target_optimize.save(targets)
+        writes = [line.args[0] for line in mock_obj().write.call_args_list]
+        self.assertEqual(["10.0.0.0/24\n", "10.0.2.0-6\n", "10.0.2.8-255\n",
+                          "10.0.3.0/24\n", "10.0.4.0/22\n", "10.0.8.0/21\n",
+                          "10.0.16.0/20\n", "10.0.32.0/19\n",
+                          "10.0.64.0/18\n", "10.0.128.0/17\n",
+                          "192.168.1.0/25\n", "192.168.2.10-255\n",
+                          "10.1.0.5/32\n", "10.1.0.7/32\n"], writes)
+
+    def test_ipv6_network_too_big(self):
+        mock_obj = mock_open()
+        with patch('builtins.open', mock_obj):
+            target_optimize = TargetOptimization("fake/targets.work")
+            with self.assertLogs(log, level="ERROR"):
+                target_optimize.save(["2001:db8::/64", "2001:db8:1::/104"])
+        writes = [line.args[0] for line in mock_obj().write.call_args_list]
+        self.assertEqual(["2001:db8:1::/104\n"], writes)
+
+    def test_exclude_hosts_only(self):
+        # the exclusions apply when no network was listed.
+        mock_obj = mock_open()
+        with patch('builtins.open', mock_obj):
+            target_optimize = TargetOptimization("fake/targets.work")
+            target_optimize.exclude(["10.0.0.2"])
+            target_optimize.save(["10.0.0.1", "10.0.0.2", "10.0.0.3"])
+        writes = [line.args[0] for line in mock_obj().write.call_args_list]
+        self.assertEqual(["10.0.0.1/32\n", "10.0.0.3/32\n"], writes)
+
+    def test_exclude_work_lines(self):
+        targets = ["10.0.0.1", "10.0.1.1", "10.0.1.5", "10.0.2.9",
+                   "10.0.3.3", "2001:db8::1", "2001:db8::2"]
+        # lines of a work file, octet ranges and lists of targets.
+        excluded = ["10.0.0-1.1\n", "10.0.2.8,9\n",
+                    "10.0.3.3/32 2001:db8::1/128\n"]
+        mock_obj = mock_open()
+        with patch('builtins.open', mock_obj):
+            target_optimize = TargetOptimization("fake/targets.work")
+            target_optimize.exclude(excluded)
+            target_optimize.save(targets)
+        writes = [line.args[0] for line in mock_obj().write.call_args_list]
+        self.assertEqual(["10.0.1.5/32\n", "2001:db8::2/128\n"], writes)
+
+    @patch('socket.getaddrinfo')
+    def test_hostnames(self, mock_getaddrinfo):
+        addresses = {"a.example.com": ["10.0.0.1"],
+                     "b.example.com": ["10.0.0.1", "10.0.0.2"]}
+
+        def getaddrinfo(name, *args, **kwargs):
+            if name not in addresses:
+                raise socket.gaierror("Name or service not known")
+            return [(2, 1, 6, '', (address, 0))
+                    for address in addresses[name]]
+
+        mock_getaddrinfo.side_effect = getaddrinfo
+        wdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, wdir)
+        work_path = os.path.join(wdir, "targets.work")
+        hosts_path = os.path.join(wdir, "hostnames.map")
+        resolver = Resolver(os.path.join(wdir, "resolve.cache"), workers=2)
+        targets = ["a.example.com", "B.example.com.", "10.0.0.3",
+                   "missing.example.com"]
+        for _ in range(2):
+            TargetOptimization(work_path, resolver=resolver,
+                               hosts_path=hosts_path).save(targets)
+            with open(work_path) as qfile:
+                self.assertEqual("10.0.0.1-3\n", qfile.read())
+            with open(hosts_path) as hfile:
+                self.assertEqual("10.0.0.1 a.example.com b.example.com\n"
+                                 "10.0.0.2 b.example.com\n", hfile.read())
+        # the second run resolves only the name not cached.
+        self.assertEqual(4, mock_getaddrinfo.call_count)
+
+    def test_hostnames_rejected(self):
+        mock_obj = mock_open()
+        with patch('builtins.open', mock_obj):
+            TargetOptimization("fake/targets.work").save(["a.example.com",
+                                                          "10.0.0.1"])
+        mock_obj().write.assert_called_once_with("10.0.0.1/32\n")
+
+    def test_ipv6(self):
+        targets = ["2001:db8::1", "2001:db8::5", "2001:db8::6",
+                   "2001:db8::9", "2001:db8:1::/64", "2001:db8:2::/112",
+                   "10.0.0.1", "10.0.0.9", "2001:db8::a:1"]
+        mock_obj = mock_open()
+        with patch('builtins.open', mock_obj):
+            TargetOptimization("fake/targets.work", pack6=4).save(targets)
+        writes = [line.args[0] for line in mock_obj().write.call_args_list]
+        # the /64 is too big, and sparse hosts are packed in lists.
+        self.assertEqual(["2001:db8:2::/112\n", "10.0.0.1/32\n",
+                          "10.0.0.9/32\n",
+                          "2001:db8::1/128 2001:db8::5/128 "
+                          "2001:db8::6/128 2001:db8::9/128\n",
+                          "2001:db8::a:1/128\n"],
+                         writes)
+
+    def test_octet_ranges(self):
+        targets = [f"10.0.{third}.{last}" for third in range(4)
+                   for last in (1, 5, 6, 7, 9)]
+        targets += ["10.0.7.250", "10.0.7.251", "10.0.8.0", "10.0.8.1",
+                    "10.1.9.1", "10.2.9.1", "10.3.9.1"]
+        targets += [str(address) for address in range(0, 512)
+                    for address in [f"172.16.{address >> 8}.{address & 0xff}"]]
+        mock_obj = mock_open()
+        with patch('builtins.open', mock_obj):
+            TargetOptimization("fake/targets.work", compact=True).save(
+                targets)
+        writes = [line.args[0] for line in mock_obj().write.call_args_list]
+        # runs across a /24 boundary are never written as a glob.
+        self.assertEqual(["172.16.0.0/23\n", "10.0.0-3.1,5-7,9\n",
+                          "10.0.7.250/31\n", "10.0.8.0/31\n",
+                          "10.1-3.9.1\n"], writes)
+        expanded = [address for line in writes
+                    for address in target_addresses(line)]
+        self.assertEqual(sorted(set(targets)), sorted(expanded))
+
     def test_ipaddress_sort(self):
         ip_list = [
             "255.1.1.1",
@@ -37,7 +313,6 @@ class TestReportsParsers(unittest.TestCase):
             "1.1.1.1",
         ]
         expected = [
-            call().write("1.1.1.1/32\n"),
             call().write("1.1.1.1/32\n"),
             call().write("10.9.0.11/32\n"),
             call().write("10.9.1.10/32\n"),
@@ -56,6 +331,8 @@ class TestReportsParsers(unittest.TestCase):
             target_optimize = TargetOptimization(reports_path)
             target_optimize.save(ip_list)
             mopen.assert_has_calls(expected, any_order=True)
+            # the duplicated host is written once.
+            self.assertEqual(11, mock_obj().write.call_count)
 
     def test_ip_glob_format(self):
         targets = [
@@ -593,14 +870,15 @@ class TestReportsParsers(unittest.TestCase):
             call().write('10.16.0.0/24\n'),
             call().write('192.168.10.0/30\n'),
             call().write('192.168.10.6-12\n'),
-            call().write('192.168.10.14/31\n')
+            call().write('192.168.10.14/31\n'),
+            call().write('172.16.0.0/16\n')
         ]
 
         mock_obj = mock_open()
         with patch('builtins.open', mock_obj) as mopen:
             target_optimize = TargetOptimization(reports_path)
             target_optimize.save(targets)
-            mock_obj().writelines.assert_called_once()
+            mock_obj().writelines.assert_not_called()
             mopen.assert_has_calls(expected_write, any_order=True)
 
 
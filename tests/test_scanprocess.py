@@ -56,6 +56,34 @@ class TestScanProcess(unittest.TestCase):
         mock_isfile.assert_has_calls(expected_call)
         self.callback.assert_called_once_with(Status.SUCCESS)
 
+    @patch('os.path.isfile')
+    def test_report_name_packed_targets(self, mock_isfile):
+        mock_isfile.return_value = False
+        sprocess = ScanProcess("fake/path")
+        report = sprocess.run("10.0.0.1/32 10.0.5.7/32 10.0.9.3/31", "-p1-20",
+                              self.callback)
+        self.assertEqual(b"10.0.0.1-32+2.xml", report.filename)
+        self.mock_nmap_proc.assert_called_with(
+            targets=[],
+            options="-p1-20 -oN fake/path/10.0.0.1-32+2.nmap "
+                    "-iL fake/path/10.0.0.1-32+2.targets",
+            safe_mode=False, event_callback=sprocess.show_status)
+        handle = self.file_mock.return_value.__enter__.return_value
+        handle.write.assert_any_call("10.0.0.1/32\n10.0.5.7/32\n10.0.9.3/31")
+
+    @patch('os.path.isfile')
+    def test_octet_range_target(self, mock_isfile):
+        mock_isfile.return_value = False
+        sprocess = ScanProcess("fake/path")
+        sprocess.run("10.0.1-3.1,5", "-p1-20", self.callback)
+        self.mock_nmap_proc.assert_called_with(
+            targets=[],
+            options="-p1-20 -oN fake/path/10.0.1-3.1,5.nmap "
+                    "-iL fake/path/10.0.1-3.1,5.targets",
+            safe_mode=False, event_callback=sprocess.show_status)
+        handle = self.file_mock.return_value.__enter__.return_value
+        handle.write.assert_any_call("10.0.1-3.1,5")
+
     @patch('os.path.isfile')
     def test_report_name_network_existing(self, mock_isfile):
         mock_isfile.side_effect = [True, False, False, False]
@@ -71,6 +99,141 @@ class TestScanProcess(unittest.TestCase):
         mock_isfile.assert_has_calls(expected_calls)
         self.callback.assert_called_once_with(Status.SUCCESS)
 
+    @patch('os.path.isfile')
+    def test_partial_output(self, mock_isfile):
+        mock_isfile.return_value = False
+        self.mock_nmap_proc().run = MagicMock(return_value=1)
+        sprocess = ScanProcess("fake/path")
+        self.assertIsNone(sprocess.run("127.0.0.1", "-p1-20", self.callback,
+                                       0x5))
+        self.mock_nmap_proc.assert_called_with(
+            targets=["127.0.0.1"],
+            options="-p1-20 -oN fake/path/task-5.nmap",
+            safe_mode=False, event_callback=sprocess.show_status)
+        self.file_mock.assert_called_with("fake/path/task-5.part", "wt")
+        handle = self.file_mock.return_value.__enter__.return_value
+        handle.write.assert_called_with("Hello Mock output")
+        # the agent uploads the partial output instead of the failure.
+        self.callback.assert_called_once_with(Status.SUCCESS)
+        handle.read.return_value = b"Hello Mock output"
+        report = sprocess.partial_report()
+        self.assertEqual(b"task-5.part", report.filename)
+        self.assertEqual(17, report.filesize)
+
+    @patch('dscan.models.scanner.threading.Timer')
+    @patch('os.path.isfile')
+    def test_timeout(self, mock_isfile, mock_timer):
+        mock_isfile.return_value = False
+        sprocess = ScanProcess("fake/path", timeout=60)
+        # the timer expires while nmap runs.
+        self.mock_nmap_proc().run.side_effect = lambda: sprocess.cancel()
+        self.assertIsNone(sprocess.run("127.0.0.1", "-p1-20", self.callback,
+                                       0x5))
+        mock_timer.assert_called_with(60, sprocess.cancel)
+        self.assertTrue(sprocess.stopped)
+        mock_timer.return_value.cancel.assert_called_once()
+        self.file_mock.assert_called_with("fake/path/task-5.part", "wt")
+
+    @patch('os.remove')
+    @patch('dscan.models.scanner.subprocess.Popen')
+    @patch('os.path.isfile')
+    def test_resume(self, mock_isfile, mock_popen, mock_remove):
+        mock_isfile.return_value = True
+        handle = self.file_mock.return_value.__enter__.return_value
+        handle.__iter__.return_value = iter(["# Nmap 7.80 scan initiated\n"])
+        handle.read.return_value = self.PARTIAL
+        mock_popen.return_value.returncode = 0
+        mock_popen.return_value.communicate.return_value = (self.RESUMED, "")
+        sprocess = ScanProcess("fake/path")
+        report = sprocess.run("10.0.0.0/30", "-sn", self.callback, 0x5)
+        self.assertEqual(b"task-5.xml", report.filename)
+        mock_popen.assert_called_once()
+        self.assertEqual(["nmap", "--resume", "fake/path/task-5.nmap"],
+                         mock_popen.call_args[0][0])
+        self.mock_nmap_proc().run.assert_not_called()
+        mock_remove.assert_called_with("fake/path/task-5.part")
+        self.callback.assert_called_once_with(Status.SUCCESS)
+
+    @patch('os.remove')
+    @patch('dscan.models.scanner.subprocess.Popen')
+    @patch('os.path.isfile')
+    def test_resume_cancel(self, mock_isfile, mock_popen, mock_remove):
+        mock_isfile.return_value = True
+        handle = self.file_mock.return_value.__enter__.return_value
+        handle.__iter__.return_value = iter(["# Nmap 7.80 scan initiated\n"])
+        handle.read.return_value = self.PARTIAL
+        sprocess = ScanProcess("fake/path")
+        proc = mock_popen.return_value
+        proc.returncode = -15
+
+        def communicate():
+            # the task is cancelled while the scan is resumed.
+            sprocess.cancel()
+            return self.RESUMED[:-len("<runstats><finished/></runstats>"
+                                      "</nmaprun>")], ""
+        proc.communicate.side_effect = communicate
+        self.assertIsNone(sprocess.run("10.0.0.0/30", "-sn", self.callback,
+                                       0x5))
+        proc.terminate.assert_called_once()
+        self.assertIsNone(sprocess.resume_proc)
+        # the scan is not started again, the hosts finished are kept.
+        self.mock_nmap_proc().run.assert_not_called()
+        mock_remove.assert_not_called()
+        self.file_mock.assert_called_with("fake/path/task-5.part",
+                                          "wt")
+        partial = handle.write.call_args[0][0]
+        self.assertEqual(2, partial.count("<host>"))
+        self.callback.assert_called_once_with(Status.SUCCESS)
+
+    @patch('os.path.isfile')
+    def test_salvaged(self, mock_isfile):
+        handle = self.file_mock.return_value.__enter__.return_value
+        handle.read.return_value = self.PARTIAL
+        sprocess = ScanProcess("fake/path")
+        sprocess.ctarget = ("10.0.0.0/30", "-sn")
+        sprocess.tid = 0x5
+        sprocess.salvaged()
+        # the hosts kept by the server are not reported again.
+        self.file_mock.assert_called_with("fake/path/task-5.part", "wt")
+        handle.write.assert_called_once_with(
+            '<?xml version="1.0"?><nmaprun args="nmap -sn">')
+
+    @patch('os.remove')
+    @patch('dscan.models.scanner.subprocess.Popen')
+    @patch('os.path.isfile')
+    def test_resume_remainder(self, mock_isfile, mock_popen, mock_remove):
+        mock_isfile.return_value = True
+        handle = self.file_mock.return_value.__enter__.return_value
+        handle.__iter__.return_value = iter(["# Nmap 7.80 scan initiated\n"])
+        handle.read.return_value = '<?xml version="1.0"?>' \
+                                   '<nmaprun args="nmap -sn">'
+        mock_popen.return_value.returncode = 0
+        mock_popen.return_value.communicate.return_value = (self.RESUMED, "")
+        sprocess = ScanProcess("fake/path")
+        # the hosts left of the task, queued with the same id.
+        report = sprocess.run("10.0.0.2/31", "-sn", self.callback, 0x5)
+        self.assertEqual(b"task-5.xml", report.filename)
+        self.assertEqual(["nmap", "--resume", "fake/path/task-5.nmap"],
+                         mock_popen.call_args[0][0])
+        self.mock_nmap_proc().run.assert_not_called()
+        output = handle.write.call_args[0][0]
+        self.assertEqual(1, output.count(b"<host>"))
+
+    PARTIAL = '<?xml version="1.0"?><nmaprun args="nmap -sn">' \
+              '<host><address addr="10.0.0.1"/></host>' \
+              '<hosthint><address addr="10.0.0.2"/></hosthint><taskpro'
+    RESUMED = '<?xml version="1.0"?><nmaprun args="nmap -sn">' \
+              '<hosthint><address addr="10.0.0.2"/></hosthint>' \
+              '<host><address addr="10.0.0.2"/></host>' \
+              '<runstats><finished/></runstats></nmaprun>'
+
+    def test_merge(self):
+        merged = ScanProcess.merge(self.PARTIAL, self.RESUMED)
+        self.assertEqual(2, merged.count("<host>"))
+        self.assertNotIn("<hosthint>", merged)
+        self.assertTrue(merged.endswith("</runstats></nmaprun>"))
+        self.assertIsNone(ScanProcess.merge(self.PARTIAL, "Failed"))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,3 +1,4 @@
+import hashlib
 import hmac
 import os
 import ssl
@@ -9,8 +10,11 @@ from socket import AF_INET, SOCK_STREAM, socket
 from unittest.mock import MagicMock, mock_open, patch
 
 from dscan.models.scanner import Config, Context
-from dscan.models.structures import (Auth, ExitStatus, Ready, Report, Status,
-                                     Structure)
+from dscan.models.structures import (PROTOCOL_VERSION, SUPPORTED_FEATURES,
+                                     Auth, Cancel, CommandExt,
+                                     ExitStatus, Features, Hello, Options,
+                                     PartialReport, Ready, Report, Status,
+                                     Structure, TaskCommand, TaskReport)
 from dscan.server import AgentHandler, DScanServer
 from tests import BufMock, create_config, data_path, log
 
@@ -45,6 +49,7 @@ class TestAgentHandler(unittest.TestCase):
         # ctx = Context(self.settings)
         self.ctx = MagicMock(spect=Context)
         self.ctx.pop.return_value = ("127.0.0.1", "-sV -Pn -p1-1000")
+        self.ctx.task_id.return_value = 0
         self.ctx.secret_key = self.settings.secret_key
         self.ctx.is_finished = False
         self.mock_server = MagicMock(spect=DScanServer)
@@ -107,6 +112,82 @@ class TestAgentHandler(unittest.TestCase):
         self.ctx.running.assert_called_once()
         self.ctx.running.assert_called_with("127.0.0.1:1234")
 
+    @patch('socket.socket')
+    def test_hello_command_ext(self, mock_socket):
+        buffer = BufMock(Auth(self.challenge),
+                         Hello(PROTOCOL_VERSION, SUPPORTED_FEATURES | 0x80),
+                         Ready(0, "bub"), struct.pack("<B", 0))
+        mock_socket.recv = buffer.read
+
+        handler = AgentHandler(mock_socket, ('127.0.0.1', '1234'),
+                               self.mock_server,
+                               terminate_event=self.mock_terminate,
+                               context=self.ctx)
+        self.assertEqual(SUPPORTED_FEATURES, handler.features)
+        mock_socket.sendall.assert_any_call(
+            Hello(PROTOCOL_VERSION, SUPPORTED_FEATURES).pack())
+        mock_socket.sendall.assert_any_call(
+            Options(1, "-sV -Pn -p1-1000").pack())
+        mock_socket.sendall.assert_called_with(
+            CommandExt(0, 1, "127.0.0.1", "").pack())
+        # the agent is known by its id.
+        self.ctx.running.assert_called_with("bub")
+
+    @patch('socket.socket')
+    def test_hello_old_version(self, mock_socket):
+        # the first version read CommandExt without the options id.
+        buffer = BufMock(Auth(self.challenge),
+                         Hello(1, Features.WIDE_COMMAND), Ready(0, "bub"),
+                         struct.pack("<B", 0))
+        mock_socket.recv = buffer.read
+
+        handler = AgentHandler(mock_socket, ('127.0.0.1', '1234'),
+                               self.mock_server,
+                               terminate_event=self.mock_terminate,
+                               context=self.ctx)
+        self.assertEqual(Features.NONE, handler.features)
+        mock_socket.sendall.assert_any_call(
+            Hello(PROTOCOL_VERSION, Features.NONE).pack())
+        mock_socket.sendall.assert_called_with(
+            b'\x03\t\x10127.0.0.1-sV -Pn -p1-1000')
+
+    @patch('socket.socket')
+    def test_options_sent_once(self, mock_socket):
+        buffer = BufMock(Auth(self.challenge),
+                         Hello(PROTOCOL_VERSION, SUPPORTED_FEATURES),
+                         Ready(0, "bub"), struct.pack("<B", 0),
+                         Ready(0, "bub"), struct.pack("<B", 0))
+        mock_socket.recv = buffer.read
+
+        AgentHandler(mock_socket, ('127.0.0.1', '1234'), self.mock_server,
+                     terminate_event=self.mock_terminate, context=self.ctx)
+        options = Options(1, "-sV -Pn -p1-1000").pack()
+        sent = [args[0] for args, _ in mock_socket.sendall.call_args_list]
+        self.assertEqual(1, sent.count(options))
+        self.assertEqual(2, sent.count(
+            CommandExt(0, 1, "127.0.0.1", "").pack()))
+        self.assertEqual(2, self.ctx.running.call_count)
+
+    @patch('socket.socket')
+    def test_legacy_agent_big_task(self, mock_socket):
+        buffer = BufMock(Auth(self.challenge), Ready(0, "bub"))
+        mock_socket.recv = buffer.read
+        targets = " ".join(f"10.0.{n}.1" for n in range(100))
+        self.ctx.pop.return_value = (targets, "-sV -Pn -p1-1000")
+
+        handler = AgentHandler(mock_socket, ('127.0.0.1', '1234'),
+                               self.mock_server,
+                               terminate_event=self.mock_terminate,
+                               context=self.ctx)
+        # only the tasks that fit a legacy command are taken.
+        self.ctx.pop.assert_called_with("127.0.0.1:1234",
+                                        handler.fits_command)
+        self.assertFalse(handler.fits_command(targets, "-sS"))
+        self.assertTrue(handler.fits_command("10.0.0.1", "-sS"))
+        mock_socket.sendall.assert_any_call(
+            ExitStatus(Status.UNFINISHED).pack())
+        self.ctx.running.assert_not_called()
+
     @patch('socket.socket')
     def test_wait(self, mock_socket):
         buffer = BufMock(Auth(self.challenge), Ready(0, "bub"),
@@ -174,8 +255,147 @@ class TestAgentHandler(unittest.TestCase):
             self.ctx.completed.assert_called_with("127.0.0.1:1234")
         file.close()
 
+    @patch('socket.socket')
+    def test_task_ids(self, mock_socket):
+        tid = 1 << 56 | 7
+        self.ctx.task_id.return_value = tid
+        buffer = BufMock(Auth(self.challenge),
+                         Hello(PROTOCOL_VERSION, SUPPORTED_FEATURES),
+                         Ready(0, "bub"), struct.pack("<B", 0))
+        mock_socket.recv = buffer.read
+
+        AgentHandler(mock_socket, ('127.0.0.1', '1234'), self.mock_server,
+                     terminate_event=self.mock_terminate, context=self.ctx)
+        mock_socket.sendall.assert_called_with(
+            TaskCommand(tid, 0, 1, "127.0.0.1", "").pack())
+
+    @patch('dscan.server.select.select')
+    @patch('socket.socket')
+    def test_cancel(self, mock_socket, mock_select):
+        tid = 1 << 56 | 7
+        self.ctx.task_id.return_value = tid
+        self.ctx.iscancelled.return_value = True
+        buffer = BufMock(Auth(self.challenge),
+                         Hello(PROTOCOL_VERSION, SUPPORTED_FEATURES),
+                         Ready(0, "bub"), struct.pack("<B", 0),
+                         ExitStatus(Status.FAILED))
+        mock_socket.recv = buffer.read
+        mock_socket.pending.return_value = 0
+        mock_select.side_effect = [([], [], []), ([mock_socket], [], [])]
+
+        AgentHandler(mock_socket, ('127.0.0.1', '1234'), self.mock_server,
+                     terminate_event=self.mock_terminate, context=self.ctx)
+        self.ctx.iscancelled.assert_called_once_with("bub")
+        mock_socket.sendall.assert_called_with(Cancel(tid).pack())
+        # the cancelled task is not held for the agent.
+        self.ctx.interrupted.assert_called_once_with("bub")
+
+    @patch('socket.socket')
+    def test_agent_id(self, mock_socket):
+        self.mock_server.options.lease_grace = 60
+        buffer = BufMock(Auth(self.challenge),
+                         Hello(PROTOCOL_VERSION, SUPPORTED_FEATURES),
+                         Ready(0, "host-1f2e"), struct.pack("<B", 0))
+        mock_socket.recv = buffer.read
+
+        AgentHandler(mock_socket, ('127.0.0.1', '1234'), self.mock_server,
+                     terminate_event=self.mock_terminate, context=self.ctx)
+        self.ctx.pop.assert_called_with("host-1f2e", None)
+        self.ctx.running.assert_called_with("host-1f2e")
+        # the task is kept for the agent to reconnect.
+        self.ctx.detached.assert_called_once_with("host-1f2e", 60)
+        self.ctx.interrupted.assert_not_called()
+
+    @patch('socket.socket')
+    def test_task_report_again(self, mock_socket):
+        tid = 1 << 56 | 7
+        data = b"<nmaprun></nmaprun>"
+        digest = hashlib.sha512(data).hexdigest()
+        buffer = BufMock(Auth(self.challenge),
+                         TaskReport(tid, len(data), "fu.xml", digest), data)
+        mock_socket.recv = buffer.read
+        # the task was completed by a previous upload.
+        self.ctx.get_report.return_value = None
+        self.ctx.iscompleted.return_value = True
+
+        AgentHandler(mock_socket, ('127.0.0.1', '1234'), self.mock_server,
+                     terminate_event=self.mock_terminate, context=self.ctx)
+        self.ctx.get_report.assert_called_with("127.0.0.1:1234", "fu.xml",
+                                               tid)
+        self.ctx.completed.assert_called_with("127.0.0.1:1234", tid)
+        mock_socket.sendall.assert_called_with(
+            struct.pack("<B", Status.SUCCESS))
+
+    @patch('socket.socket')
+    def test_partial_report(self, mock_socket):
+        tid = 1 << 56 | 7
+        data = b"<nmaprun><host></host>"
+        digest = hashlib.sha512(data).hexdigest()
+        buffer = BufMock(Auth(self.challenge),
+                         PartialReport(tid, len(data), "fu-7.part", digest),
+                         data)
+        mock_socket.recv = buffer.read
+        partial = MagicMock()
+        self.ctx.get_partial_report.return_value = partial
+        self.ctx.salvage.return_value = True
+
+        AgentHandler(mock_socket, ('127.0.0.1', '1234'), self.mock_server,
+                     terminate_event=self.mock_terminate, context=self.ctx)
+        self.ctx.get_partial_report.assert_called_with("127.0.0.1:1234", tid)
+        partial.write.assert_called_with(data)
+        self.ctx.salvage.assert_called_with("127.0.0.1:1234", tid, hold=False)
+        mock_socket.sendall.assert_called_with(
+            struct.pack("<B", Status.SUCCESS))
+
+    @patch('socket.socket')
+    def test_partial_report_failed(self, mock_socket):
+        tid = 1 << 56 | 7
+        data = b"<nmaprun>"
+        digest = hashlib.sha512(data).hexdigest()
+        buffer = BufMock(Auth(self.challenge),
+                         PartialReport(tid, len(data), "fu-7.part", digest),
+                         data)
+        mock_socket.recv = buffer.read
+        self.ctx.salvage.return_value = False
+
+        AgentHandler(mock_socket, ('127.0.0.1', '1234'), self.mock_server,
+                     terminate_event=self.mock_terminate, context=self.ctx)
+        # no hosts finished, the whole task is scanned again.
+        mock_socket.sendall.assert_called_with(
+            struct.pack("<B", Status.FAILED))
+        self.ctx.interrupted.assert_called_with("127.0.0.1:1234")
+
+    @patch('os.remove')
+    def test_drain(self, mock_remove):
+        with patch('os.path.isfile') as misfile, \
+                patch.object(Context, 'create', return_value=self.ctx):
+            misfile.return_value = False
+            server = DScanServer(("127.0.0.1", 0), AgentHandler,
+                                 options=self.settings,
+                                 bind_and_activate=False)
+        self.addCleanup(server.server_close)
+        self.ctx.isdrained = False
+
+        def cancel_all():
+            self.ctx.isdrained = True
+            return ["agent1"]
+        self.ctx.cancel_all.side_effect = cancel_all
+        with patch.object(DScanServer, 'POLL', 0), \
+                patch.object(DScanServer, 'CANCEL_WAIT', 0), \
+                patch.object(server, 'shutdown') as mshutdown, \
+                patch('os.path.isfile', return_value=True):
+            self.settings.drain_timeout = 0
+            server.watch_drain()
+        mock_remove.assert_called_once_with(self.settings.drain_path)
+        self.ctx.drain.assert_called_once()
+        # the tasks still running at the deadline were cancelled.
+        self.ctx.cancel_all.assert_called_once()
+        mshutdown.assert_called_once()
+
+    @patch("os.replace")
+    @patch("os.fsync")
     @patch("builtins.open")
-    def test_server(self, mock_open):
+    def test_server(self, mock_open, mock_fsync, mock_replace):
         with patch('os.path.isfile') as misfile:
             misfile.return_value = False
             server = DScanServer((self.settings.host, self.settings.port),
@@ -201,6 +421,9 @@ class TestAgentHandler(unittest.TestCase):
             s.sendall(Auth(digest).pack())
             s.close()
             server.shutdown()
+            # the context is saved as a snapshot of the journal.
+            mock_replace.assert_called_once_with(
+                f"{self.settings.resume_path}.tmp", self.settings.resume_path)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,53 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+from dscan.models.spool import Spool
+from dscan.models.structures import Report
+
+
+class TestSpool(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, "spool")
+        self.digest = hashlib.sha512(b"pickabu").hexdigest()
+
+    def test_restart(self):
+        spool = Spool(self.path)
+        self.assertEqual(0, len(spool))
+        spool.add(2 << 56 | 7, Report(10, "10.0.0.1.xml", self.digest))
+        spool.add(1 << 56 | 3, Report(20, "10.0.0.2.xml", self.digest))
+        with open(os.path.join(self.path, "partial.json.tmp"), 'wt') as tmp:
+            tmp.write("{")
+        # the agent restarted.
+        spool = Spool(self.path)
+        tids = [tid for tid, _ in spool]
+        self.assertEqual([1 << 56 | 3, 2 << 56 | 7], tids)
+        report = spool.entries[1 << 56 | 3]
+        self.assertEqual(20, report.filesize)
+        self.assertEqual(b"10.0.0.2.xml", report.filename)
+        self.assertEqual(self.digest.encode("ascii"), report.filehash)
+
+        spool.remove(1 << 56 | 3)
+        spool.remove(5)
+        self.assertEqual([2 << 56 | 7], [tid for tid, _ in Spool(self.path)])
+
+    def test_rejected(self):
+        tid = 1 << 56 | 3
+        spool = Spool(self.path)
+        spool.add(tid, Report(20, "10.0.0.2.xml", self.digest))
+        for _ in range(Spool.MAX_ATTEMPTS - 1):
+            self.assertFalse(spool.rejected(tid))
+            # the attempts survive a restart of the agent.
+            spool = Spool(self.path)
+        self.assertEqual(Spool.MAX_ATTEMPTS - 1, spool.attempts[tid])
+        self.assertTrue(spool.rejected(tid))
+        self.assertEqual(0, len(Spool(self.path)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,8 +5,12 @@ import unittest
 from socket import socket
 from unittest.mock import MagicMock, patch
 
-from dscan.models.structures import (Auth, Command, ExitStatus, Operations,
-                                     Ready, Report, Status, Structure)
+from dscan.models.structures import (Auth, Cancel, Command, CommandExt,
+                                     CommandFlags, ExitStatus, Features,
+                                     Hello, Operations,
+                                     Options, PartialReport, Ready, Report,
+                                     Status, Structure, TaskCommand,
+                                     TaskReport)
 
 
 class TestStructure(unittest.TestCase):
@@ -60,6 +64,53 @@ class TestStructure(unittest.TestCase):
             result = Structure.create(sock=mock_socket)
             self.assertEqual(expected.target, result.target)
 
+    def test_command_ext_pack_unpack(self):
+        targets = " ".join(f"10.0.{n}.1" for n in range(200))
+        expected = CommandExt.build(targets, "-sS -p-", compress=512)
+        self.assertEqual(CommandFlags.COMPRESSED | CommandFlags.TARGET_LIST,
+                         expected.flags)
+        mock_sock = self.build_mock(expected)
+        with patch('socket.socket', new=mock_sock) as mock_socket:
+            result = Structure.create(sock=mock_socket)
+            self.assertEqual(Operations.COMMAND_EXT, result.op_code)
+            self.assertEqual(targets, result.targets)
+            self.assertEqual(b"-sS -p-", result.options)
+
+    def test_command_ext_chunked(self):
+        targets = " ".join(f"10.0.{n}.1" for n in range(200))
+        data = io.BytesIO(CommandExt.build(targets, "-sS").pack())
+        handle = MagicMock(spect=socket)
+        # emulate records of 100 bytes.
+        handle.recv = lambda size: data.read1(min(size, 100))
+        result = Structure.create(sock=handle)
+        self.assertEqual(CommandFlags.TARGET_LIST, result.flags)
+        self.assertEqual(targets, result.targets)
+
+    def test_options_pack_unpack(self):
+        expected = Options(3, "-sS -n -p 22")
+        mock_sock = self.build_mock(expected)
+        with patch('socket.socket', new=mock_sock) as mock_socket:
+            result = Structure.create(sock=mock_socket)
+            self.assertEqual(3, result.oid)
+            self.assertEqual(b"-sS -n -p 22", result.options)
+
+    def test_command_ext_options_ref(self):
+        expected = CommandExt.build("10.0.0.0/24", "-sS -n -p 22", oid=3)
+        mock_sock = self.build_mock(expected)
+        with patch('socket.socket', new=mock_sock) as mock_socket:
+            result = Structure.create(sock=mock_socket)
+            self.assertEqual(3, result.oid)
+            self.assertEqual(b"", result.options)
+            self.assertEqual("10.0.0.0/24", result.targets)
+
+    def test_hello_pack_unpack(self):
+        expected = Hello(1, Features.WIDE_COMMAND)
+        mock_sock = self.build_mock(expected)
+        with patch('socket.socket', new=mock_sock) as mock_socket:
+            result = Structure.create(sock=mock_socket)
+            self.assertEqual(1, result.version)
+            self.assertEqual(Features.WIDE_COMMAND, result.features)
+
     def test_report_pack_unpack(self):
         digest = hashlib.sha512(b"pickabu").hexdigest()
         expected = Report(self.getSize(), "fu.xml", digest)
@@ -70,6 +121,40 @@ class TestStructure(unittest.TestCase):
             self.assertEqual(expected.filename, result.filename)
             self.assertEqual(expected.filehash, result.filehash)
 
+    def test_task_pack_unpack(self):
+        tid = 2 << 56 | 300
+        expected = TaskCommand.build(tid, "10.0.0.1 10.0.0.2", "", oid=1)
+        mock_sock = self.build_mock(expected)
+        with patch('socket.socket', new=mock_sock) as mock_socket:
+            result = Structure.create(sock=mock_socket)
+            self.assertEqual(Operations.TASK_COMMAND, result.op_code)
+            self.assertEqual(tid, result.tid)
+            self.assertEqual(CommandFlags.TARGET_LIST, result.flags)
+            self.assertEqual("10.0.0.1 10.0.0.2", result.targets)
+
+        digest = hashlib.sha512(b"pickabu").hexdigest()
+        expected = TaskReport(tid, 2048, "fu.xml", digest)
+        mock_sock = self.build_mock(expected)
+        with patch('socket.socket', new=mock_sock) as mock_socket:
+            result = Structure.create(sock=mock_socket)
+            self.assertEqual(tid, result.tid)
+            self.assertEqual(2048, result.filesize)
+            self.assertEqual(b"fu.xml", result.filename)
+
+        expected = PartialReport(tid, 1024, "fu-12c.part", digest)
+        mock_sock = self.build_mock(expected)
+        with patch('socket.socket', new=mock_sock) as mock_socket:
+            result = Structure.create(sock=mock_socket)
+            self.assertEqual(Operations.PARTIAL_REPORT, result.op_code)
+            self.assertEqual(tid, result.tid)
+            self.assertEqual(b"fu-12c.part", result.filename)
+
+        mock_sock = self.build_mock(Cancel(tid))
+        with patch('socket.socket', new=mock_sock) as mock_socket:
+            result = Structure.create(sock=mock_socket)
+            self.assertEqual(Operations.CANCEL, result.op_code)
+            self.assertEqual(tid, result.tid)
+
     def test_status(self):
         self.assertTrue((0 == Status.SUCCESS.value))
 
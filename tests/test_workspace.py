@@ -1,13 +1,48 @@
 
+import copyreg
 import os
 import pickle
+import shutil
+import tempfile
 import unittest
+from argparse import Namespace
+from configparser import ConfigParser, ExtendedInterpolation
 from io import BytesIO, StringIO
 from os import DirEntry
 from unittest.mock import MagicMock, Mock, patch
 
+from dscan import dataPath
 from dscan.models.scanner import (STATUS, Context, DiscoveryStage, File,
-                                  ServerConfig, Stage, Task)
+                                  LineIndex, LiveSet, PortStatistics,
+                                  ServerConfig, Stage, Task, TaskTable,
+                                  WorkQueue)
+
+
+class MemoryLineIndex(LineIndex):
+    """
+    `LineIndex` built in memory, for the tests with a mocked file system.
+    """
+
+    def load(self):
+        return False
+
+    def build(self):
+        offset = 0
+        self.records = []
+        with open(self.path) as dfile:
+            for line in dfile:
+                self.records.extend((offset, self.ntasks))
+                offset += len(line)
+                self.ntasks += self.weight(line.strip()) if self.weight \
+                    else 1
+            dfile.seek(0)
+        self.nlines = len(self.records) // 2
+
+    def line(self, n):
+        with open(self.path) as dfile:
+            lines = [line.strip() for line in dfile]
+            dfile.seek(0)
+        return lines[n] if 0 <= n < len(lines) else None
 
 
 class FileSystemMockTestCase(unittest.TestCase):
@@ -15,13 +50,7 @@ class FileSystemMockTestCase(unittest.TestCase):
     @staticmethod
     def build_mock(data):
         def read(size=-1):
-            if size:
-                if isinstance(data, BytesIO):
-                    return data.getvalue()
-                else:
-                    return data.read(size)
-            else:
-                return data.read()
+            return data.read(size)
 
         handle = MagicMock(spect=open)
         handle.__enter__.return_value = handle
@@ -44,8 +73,10 @@ class FileSystemMockTestCase(unittest.TestCase):
         mos_isfile.return_value = True
         mos_isfile.start()
         mos_access.start()
-        mos_stat = mos_stat.start()
-        mos_stat.return_value = Mock(st_size=35)
+        mos_stat.start().return_value = Mock(st_size=35)
+        mindex = patch('dscan.models.scanner.LineIndex', MemoryLineIndex)
+        mindex.start()
+        self.addCleanup(mindex.stop)
         self.addCleanup(mos_isfile.stop)
         self.addCleanup(mos_access.stop)
         self.addCleanup(mos_stat.stop)
@@ -84,6 +115,634 @@ class TestStateFullFile(FileSystemMockTestCase):
         self.assertEqual(2, nobj_file.lineno)
 
 
+class TestWorkQueue(FileSystemMockTestCase):
+
+    def setUp(self) -> None:
+        super(TestWorkQueue, self).setUp()
+        mopen = patch('builtins.open', spec=open)
+        self.file_mock = mopen.start()
+        self.file_mock.return_value = self.build_mock(
+            StringIO("10.16.0.0/16\n192.168.12.0/24\n10.100.1.1\n"))
+        self.queue = WorkQueue('fake/run/targets.work')
+        self.queue.open()
+        self.addCleanup(mopen.stop)
+
+    def test_split(self):
+        # the /16 is split in 256 tasks.
+        self.assertEqual(258, len(self.queue))
+        self.assertEqual('10.16.0.0/24', self.queue.readline())
+        self.assertEqual('10.16.1.0/24', self.queue.readline())
+        self.assertEqual(1, self.queue.lineno)
+        self.assertEqual('10.16.255.0/24', self.queue.subnet('10.16.0.0/16',
+                                                              255))
+        targets = [self.queue.readline() for _ in range(257)]
+        self.assertEqual('10.16.255.0/24', targets[253])
+        self.assertEqual(['192.168.12.0/24', '10.100.1.1', None],
+                         targets[254:])
+
+    def test_serialize(self):
+        self.queue.readline()
+        nobj_queue = pickle.loads(pickle.dumps(self.queue))
+        self.assertEqual('10.16.1.0/24', nobj_queue.readline())
+        self.assertEqual(258, nobj_queue.nlines)
+
+
+class TestLineIndex(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, "targets.work")
+        with open(self.path, 'wt') as targets:
+            targets.write("10.16.0.0/16\n192.168.12.0/24\n10.100.1.1\n")
+
+    def test_random_access(self):
+        queue = WorkQueue(self.path)
+        queue.open()
+        self.addCleanup(queue.close)
+        self.assertEqual(258, len(queue))
+        self.assertEqual('10.16.0.0/24', queue.task(0))
+        self.assertEqual('10.16.255.0/24', queue.task(255))
+        self.assertEqual('192.168.12.0/24', queue.task(256))
+        self.assertEqual('10.100.1.1', queue.task(257))
+        self.assertIsNone(queue.task(258))
+        self.assertEqual('192.168.12.0/24', queue.line(1))
+        # random access doesn't move the queue.
+        self.assertEqual('10.16.0.0/24', queue.readline())
+        self.assertTrue(os.path.isfile(f"{self.path}.idx"))
+
+    def test_reload(self):
+        File(self.path).open()
+        with patch.object(LineIndex, 'build') as mock_build:
+            targets = File(self.path)
+            targets.open()
+            self.addCleanup(targets.close)
+            mock_build.assert_not_called()
+            self.assertEqual(3, len(targets))
+            self.assertEqual('10.100.1.1', targets.line(2))
+        # the queue counts tasks, the index is rebuilt.
+        queue = WorkQueue(self.path)
+        queue.open()
+        self.addCleanup(queue.close)
+        self.assertEqual(258, len(queue))
+
+    def test_changed_file(self):
+        index = LineIndex(self.path)
+        index.build()
+        with open(self.path, 'at') as targets:
+            targets.write("10.100.1.2\n")
+        self.assertFalse(LineIndex(self.path).load())
+
+
+class TestStageCompletion(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, "targets.work")
+        with open(self.path, 'wt') as targets:
+            targets.write("10.16.0.0/23\n192.168.12.0/24\n10.100.1.1\n")
+
+    def test_complete(self):
+        stage = Stage("stage1", self.path, "-sS -p22", self.tmpdir)
+        tasks = [stage.next_task() for _ in range(4)]
+        self.addCleanup(stage.close)
+        self.assertEqual([0, 1, 2, 3], [task.index for task in tasks])
+        self.assertTrue(stage.complete(tasks[2].index))
+        # duplicated executions are counted once.
+        self.assertFalse(stage.complete(tasks[2].index))
+        self.assertTrue(stage.complete(tasks[0].index))
+        self.assertEqual(2, stage.ftargets)
+        self.assertTrue(stage.iscompleted(2))
+        self.assertFalse(stage.iscompleted(1))
+        self.assertFalse(stage.isfinished)
+
+    def test_restart(self):
+        stage = Stage("stage1", self.path, "-sS -p22", self.tmpdir)
+        stage.complete(0)
+        stage.complete(2)
+        stage = pickle.loads(pickle.dumps(stage))
+        # the work queue starts over and skips the completed targets.
+        stage.targets = WorkQueue(self.path)
+        self.addCleanup(stage.close)
+        self.assertEqual(2, stage.ftargets)
+        task = stage.next_task()
+        self.assertEqual(("10.16.1.0/24", 1), (task.target, task.index))
+        task = stage.next_task()
+        self.assertEqual(("10.100.1.1", 3), (task.target, task.index))
+        self.assertIsNone(stage.next_task())
+
+
+class TestIPv6(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, "targets.work")
+        with open(self.path, 'wt') as targets:
+            targets.write("2001:db8::/112\n10.0.0.0/23\n2001:db8:1::1\n")
+
+    def test_split(self):
+        stage = Stage("stage1", self.path, "-sS -p22", self.tmpdir)
+        self.addCleanup(stage.close)
+        self.assertEqual(259, len(stage.targets))
+        task = stage.next_task()
+        self.assertEqual("2001:db8::/120", task.target)
+        self.assertEqual("-sS -p22 -6", task.options)
+        self.assertEqual("2001:db8::100/120", stage.targets.task(1))
+        self.assertEqual("10.0.1.0/24", stage.targets.task(257))
+        self.assertEqual("2001:db8:1::1", stage.targets.task(258))
+
+    def test_options(self):
+        stage = Stage("stage1", self.path, "-6 -sS -p22", self.tmpdir)
+        self.assertEqual("-6 -sS -p22", stage.task_options("2001:db8::1"))
+        stage = Stage("stage1", self.path, "-sS -p22", self.tmpdir)
+        self.assertEqual("-sS -p22", stage.task_options("10.0.0.1"))
+
+
+class ProjectTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.settings = self.server_config()
+        self.settings.target_optimization(["10.0.0.0/24", "10.0.1.5"],
+                                          ["10.0.2.7"])
+
+    def server_config(self):
+        cfg = ConfigParser(interpolation=ExtendedInterpolation())
+        cfg.read(os.path.join(dataPath, 'dscan.conf'))
+        options = Namespace(name=self.tmpdir, b='127.0.0.1')
+        return ServerConfig(cfg, options, self.tmpdir)
+
+
+class TestInbox(ProjectTestCase):
+
+    def write_inbox(self, *targets):
+        with open(self.settings.inbox_path, 'wt') as inbox:
+            inbox.write("\n".join(targets))
+
+    def test_ingest(self):
+        ctx = Context(self.settings)
+        self.addCleanup(ctx.stage_list[0].close)
+        self.assertEqual([], self.settings.ingest(ctx))
+        # known and excluded targets are dropped.
+        self.write_inbox("10.0.0.7", "10.0.1.5", "10.0.2.7", "10.0.3.0/30")
+        self.assertEqual(["10.0.3.0/30"], self.settings.ingest(ctx))
+        self.assertFalse(os.path.exists(self.settings.inbox_path))
+        targets = [ctx.pop("agent1")[0], ctx.pop("agent2")[0],
+                   ctx.pop("agent3")[0]]
+        self.assertEqual(["10.0.0.0/24", "10.0.1.5/32", "10.0.3.0/30"],
+                         targets)
+        self.assertIsNone(ctx.pop("agent4"))
+        # the running discovery stage gets the targets added after.
+        self.write_inbox("10.0.4.1", "10.0.3.1")
+        self.assertEqual(["10.0.4.1/32"], self.settings.ingest(ctx))
+        discovery = ctx.active_stages["discovery"]
+        self.assertEqual(("10.0.4.1/32", discovery.options),
+                         ctx.pop("agent4"))
+        self.assertEqual(4, discovery.targets.nlines)
+
+    def test_add_targets(self):
+        path = os.path.join(self.tmpdir, "live-targets.work")
+        with open(path, 'wt') as targets:
+            targets.write("10.0.0.1/32\n")
+        options = MagicMock(spect=ServerConfig)
+        options.port_ranking = False
+        options.dead_threshold = 0
+        options.stage_list = [Stage("stage1", path, "-sS -p22", self.tmpdir),
+                              Stage("stage2", path, "-sS -p25", self.tmpdir)]
+        ctx = Context(options)
+        self.addCleanup(options.stage_list[0].close)
+        self.assertEqual("10.0.0.1/32", ctx.pop("agent1")[0])
+        self.assertEqual(["stage1", "stage2"],
+                         ctx.add_targets(["10.0.9.9/32"]))
+        with open(path) as targets:
+            self.assertEqual(["10.0.0.1/32\n", "10.0.9.9/32\n"],
+                             targets.readlines())
+        self.assertEqual("10.0.9.9/32", ctx.pop("agent2")[0])
+        self.assertEqual(2, ctx.active_stages["stage1"].targets.nlines)
+
+
+class TestJournal(ProjectTestCase):
+
+    def test_recovery(self):
+        ctx = Context.create(self.settings)
+        tasks = [ctx.pop(agent)[0] for agent in ("agent1", "agent2")]
+        ctx.running("agent2")
+        ctx.completed("agent1")
+        # snapshots leave the running context untouched.
+        ctx.save(BytesIO())
+        self.assertEqual(["agent2"], list(ctx.active))
+        self.assertEqual(0, len(ctx.pending))
+        ctx.active_stages["discovery"].close()
+
+        # the server crashed, the task running on agent2 is lost.
+        restored = Context.create(self.server_config())
+        self.addCleanup(restored.active_stages["discovery"].close)
+        discovery = restored.active_stages["discovery"]
+        self.assertEqual("discovery", restored.cstage_name)
+        self.assertEqual(1, discovery.ftargets)
+        self.assertTrue(os.path.isfile(self.settings.resume_path))
+        self.assertFalse(restored.journal.exists())
+        self.assertEqual(tasks[1], restored.pop("agent2")[0])
+        self.assertIsNone(restored.pop("agent4"))
+
+    def test_recovery_no_snapshot(self):
+        ctx = Context.create(self.settings)
+        for agent in ("agent1", "agent2"):
+            ctx.pop(agent)
+            ctx.completed(agent)
+        ctx.active_stages["discovery"].close()
+
+        # the server crashed before the first checkpoint.
+        restored = Context.create(self.server_config())
+        discovery = restored.active_stages["discovery"]
+        self.addCleanup(discovery.close)
+        self.assertEqual(2, discovery.targets.nlines)
+        self.assertTrue(discovery.isfinished)
+        self.assertEqual([(6, 0, "16.67%")], restored.ctx_status())
+        self.assertEqual([("discovery", 2, 2, "100.00%")],
+                         restored.active_stages_status())
+
+    def test_finished_project(self):
+        journal = os.path.join(self.settings.rundir, "current.journal")
+        with open(journal, 'wt') as jfile:
+            jfile.write("S\tdiscovery\t\t-sn\n")
+        # the targets of a crashed scan are not optimized again.
+        self.settings.target_optimization(["10.9.0.0/24"])
+        with open(self.settings.queue_path) as qfile:
+            self.assertNotIn("10.9.0.0/24\n", qfile.readlines())
+
+
+class TestTaskIds(ProjectTestCase):
+
+    def test_idempotent_completion(self):
+        ctx = Context(self.settings)
+        self.addCleanup(ctx.stage_list[0].close)
+        self.assertEqual(0, ctx.task_id("agent1"))
+        target = ctx.pop("agent1")[0]
+        tid = ctx.task_id("agent1")
+        self.assertEqual(1 << Context.TASK_ID_BITS, tid)
+        # the agent reconnects before its report is uploaded.
+        ctx.interrupted("agent1")
+        report = ctx.get_report("agent1b", "fu.xml", tid)
+        report.close()
+        self.assertTrue(os.path.isfile(os.path.join(self.tmpdir,
+                                                    "discovery-0.xml")))
+        ctx.completed("agent1b", tid)
+        discovery = ctx.active_stages["discovery"]
+        self.assertEqual(1, discovery.ftargets)
+        self.assertTrue(ctx.iscompleted(tid))
+        # an upload retried is discarded and counted once.
+        self.assertIsNone(ctx.get_report("agent1b", "fu.xml", tid))
+        ctx.completed("agent1b", tid)
+        self.assertEqual(1, discovery.ftargets)
+        # the interrupted task is not scanned again.
+        self.assertNotEqual(target, ctx.pop("agent2")[0])
+        self.assertEqual(1 << Context.TASK_ID_BITS | 1,
+                         ctx.task_id("agent2"))
+        self.assertIsNone(ctx.pop("agent3"))
+
+
+class TestLeases(ProjectTestCase):
+
+    def test_reconnect(self):
+        ctx = Context(self.settings)
+        self.addCleanup(ctx.stage_list[0].close)
+        target = ctx.pop("agent1")[0]
+        ctx.running("agent1")
+        ctx.detached("agent1", 60)
+        # the task is kept while the agent reconnects.
+        self.assertNotEqual(target, ctx.pop("agent2")[0])
+        self.assertIsNone(ctx.pop("agent3"))
+        self.assertEqual(target, ctx.pop("agent1")[0])
+        self.assertEqual({}, ctx.leases)
+
+        ctx.detached("agent1", 60)
+        ctx.leases["agent1"] = 0
+        # the agent did not come back in time.
+        self.assertEqual(target, ctx.pop("agent3")[0])
+        self.assertNotIn("agent1", ctx.active)
+        ctx.detached("agent2", 0)
+        self.assertEqual(1, len(ctx.pending))
+
+    def test_held_task(self):
+        ctx = Context(self.settings)
+        self.addCleanup(ctx.stage_list[0].close)
+        target = ctx.pop("agent1")[0]
+        ctx.interrupted("agent1", hold=True)
+        # the agent resumes its task, it's not scanned twice.
+        self.assertEqual(target, ctx.pop("agent1")[0])
+        self.assertNotEqual(target, ctx.pop("agent2")[0])
+        self.assertEqual(0, len(ctx.pending))
+        self.assertIsNone(ctx.pop("agent3"))
+
+    def test_held_task_lease(self):
+        ctx = Context(self.settings)
+        self.addCleanup(ctx.stage_list[0].close)
+        target = ctx.pop("agent1")[0]
+        ctx.interrupted("agent1", hold=True)
+        ctx.detached("agent1", 60)
+        # no other agent scans the held task while the lease lasts.
+        other = ctx.pop("agent2")[0]
+        self.assertNotEqual(target, other)
+        self.assertEqual(0, len(ctx.pending))
+        self.assertIsNone(ctx.pop("agent3"))
+        ctx.leases["agent1"] = 0
+        self.assertEqual(target, ctx.pop("agent3")[0])
+        self.assertEqual({}, ctx.held)
+
+
+class TestLegacyAgent(ProjectTestCase):
+
+    def test_ipv6_pack_length(self):
+        os.remove(self.settings.queue_path)
+        hosts = [f"2001:db8:aaaa:bbbb:cccc:{n:x}:eeee:1" for n in range(16)]
+        self.settings.target_optimization(hosts)
+        with open(self.settings.queue_path) as qfile:
+            lines = qfile.read().splitlines()
+        # the packed hosts fit in a legacy command.
+        self.assertEqual(16, sum(len(line.split()) for line in lines))
+        self.assertTrue(all(len(line) <= 255 for line in lines))
+        self.assertGreater(len(lines), 1)
+
+    def test_task_too_big(self):
+        ctx = Context(self.settings)
+        self.addCleanup(ctx.stage_list[0].close)
+
+        def fits(target, options):
+            return target != "10.0.0.0/24"
+
+        # the task is left for the other agents, the next one fits.
+        self.assertIsNone(ctx.pop("legacy", fits))
+        self.assertEqual("10.0.1.5/32", ctx.pop("legacy", fits)[0])
+        ctx.completed("legacy")
+        self.assertIsNone(ctx.pop("legacy", fits))
+        self.assertEqual(1, len(ctx.pending))
+        self.assertEqual("10.0.0.0/24", ctx.pop("agent1")[0])
+
+
+class TestSalvage(ProjectTestCase):
+    PARTIAL = b'<?xml version="1.0"?><nmaprun args="nmap -sn">' \
+              b'<host><address addr="10.0.0.1" addrtype="ipv4"/></host>' \
+              b'<host><address addr="10.0.0.2" addrtype="ipv4"/></host>' \
+              b'<host><address addr="10.0.0.3" add'
+
+    def partial_report(self, ctx, agent, data):
+        tid = ctx.task_id(agent)
+        with ctx.get_partial_report(agent, tid) as pfile:
+            pfile.write(data)
+        return tid
+
+    def test_remainder(self):
+        ctx = Context(self.settings)
+        self.addCleanup(ctx.stage_list[0].close)
+        ctx.pop("agent1")
+        tid = self.partial_report(ctx, "agent1", self.PARTIAL)
+        self.assertTrue(ctx.salvage("agent1", tid))
+        self.assertTrue(os.path.isfile(os.path.join(self.tmpdir,
+                                                    "discovery-0.1.xml")))
+        self.assertFalse(os.path.isfile(os.path.join(self.tmpdir,
+                                                     "discovery-0.part")))
+        self.assertNotIn("agent1", ctx.active)
+        self.assertFalse(ctx.iscompleted(tid))
+        # only the hosts left are scanned again, under the same id.
+        self.assertEqual("10.0.0.0/32 10.0.0.3/32 10.0.0.4/30 10.0.0.8/29 "
+                         "10.0.0.16/28 10.0.0.32/27 10.0.0.64/26 "
+                         "10.0.0.128/25", ctx.pop("agent2")[0])
+        self.assertEqual(tid, ctx.task_id("agent2"))
+        tid = self.partial_report(ctx, "agent2", self.PARTIAL)
+        self.assertTrue(ctx.salvage("agent2", tid))
+        # the partial reports of the task are all kept.
+        self.assertTrue(os.path.isfile(os.path.join(self.tmpdir,
+                                                    "discovery-0.2.xml")))
+
+    def test_remainder_held(self):
+        ctx = Context(self.settings)
+        self.addCleanup(ctx.stage_list[0].close)
+        ctx.pop("agent1")
+        tid = self.partial_report(ctx, "agent1", self.PARTIAL)
+        self.assertTrue(ctx.salvage("agent1", tid, hold=True))
+        # the agent resumes the hosts left from its own normal output.
+        self.assertEqual("10.0.1.5/32", ctx.pop("agent2")[0])
+        self.assertTrue(ctx.pop("agent1")[0].startswith("10.0.0.0/32 "))
+        self.assertEqual(tid, ctx.task_id("agent1"))
+
+    def test_finished(self):
+        ctx = Context(self.settings)
+        self.addCleanup(ctx.stage_list[0].close)
+        ctx.pop("agent1")
+        ctx.pop("agent2")
+        tid = self.partial_report(ctx, "agent2", self.PARTIAL.replace(
+            b"10.0.0.1", b"10.0.1.5"))
+        # the only host of the task finished before the interruption.
+        self.assertTrue(ctx.salvage("agent2", tid))
+        self.assertTrue(ctx.iscompleted(tid))
+        self.assertEqual(0, len(ctx.pending))
+        tid = self.partial_report(ctx, "agent1", self.PARTIAL[:60])
+        self.assertFalse(ctx.salvage("agent1", tid))
+        self.assertIn("agent1", ctx.active)
+
+
+class TestCancel(ProjectTestCase):
+
+    def test_cancel(self):
+        ctx = Context(self.settings)
+        self.addCleanup(ctx.stage_list[0].close)
+        self.assertFalse(ctx.cancel("agent1"))
+        target = ctx.pop("agent1")[0]
+        self.assertTrue(ctx.cancel("agent1"))
+        self.assertTrue(ctx.iscancelled("agent1"))
+        self.assertFalse(ctx.iscancelled("agent1"))
+        # the cancel of a task that ended meanwhile is dropped.
+        ctx.cancel("agent1")
+        ctx.interrupted("agent1")
+        self.assertFalse(ctx.iscancelled("agent1"))
+        self.assertEqual(target, ctx.pop("agent2")[0])
+
+
+class TestDrain(ProjectTestCase):
+
+    def test_drain(self):
+        ctx = Context(self.settings)
+        self.addCleanup(ctx.stage_list[0].close)
+        target = ctx.pop("agent1")[0]
+        self.assertEqual(1, ctx.drain())
+        # no new tasks, the running task is sent again to its agent.
+        self.assertIsNone(ctx.pop("agent2"))
+        self.assertEqual(target, ctx.pop("agent1")[0])
+        self.assertFalse(ctx.isdrained)
+        self.assertEqual(["agent1"], ctx.cancel_all())
+        ctx.completed("agent1")
+        self.assertTrue(ctx.isdrained)
+        self.assertFalse(ctx.is_finished)
+
+
+class LegacyPickler(pickle.Pickler):
+    """
+    Pickles the objects with the state given in `states`, like the resume
+    files of the versions before the snapshots.
+    """
+
+    def __init__(self, file, states):
+        super().__init__(file)
+        self.states = states
+
+    def reducer_override(self, obj):
+        state = self.states.get(id(obj))
+        if state is None:
+            return NotImplemented
+        return copyreg.__newobj__, (type(obj),), state
+
+
+class TestSnapshot(ProjectTestCase):
+
+    def legacy_stage(self, stage, states, nlines=0, lineno=0, loc=0):
+        targets = File(stage.targets_path)
+        states[id(targets)] = {"_path": stage.targets_path, "nlines": nlines,
+                               "lineno": lineno, "loc": loc, "mode": "r"}
+        state = {"targets_path": stage.targets_path, "name": stage.name,
+                 "targets": targets, "options": stage.options,
+                 "reports_path": stage.reports_path, "ftargets": 0}
+        if isinstance(stage, DiscoveryStage):
+            state["ltargets_path"] = stage.ltargets_path
+        states[id(stage)] = state
+        return stage
+
+    def test_legacy_pickle(self):
+        states = {}
+        stages = list(self.settings.stage_list)
+        with open(self.settings.queue_path) as qfile:
+            first = qfile.readline()
+        # the first target was running when the server stopped.
+        discovery = self.legacy_stage(stages.pop(0), states, 2, 1,
+                                      len(first))
+        for stage in stages:
+            self.legacy_stage(stage, states)
+        task = Task("discovery", discovery.options, first.strip())
+        states[id(task)] = {"stage_name": "discovery",
+                            "options": discovery.options,
+                            "target": first.strip(),
+                            "status": STATUS.INTERRUPTED}
+        ctx = Context(self.settings)
+        states[id(ctx)] = {"stage_list": stages, "nstages": ctx.nstages,
+                           "cstage_name": "discovery",
+                           "active_stages": {"discovery": discovery},
+                           "reports_path": ctx.reports_path, "active": {},
+                           "pending": [task]}
+        with open(self.settings.resume_path, 'wb') as rfile:
+            LegacyPickler(rfile, states).dump(ctx)
+
+        restored = Context.create(self.server_config())
+        discovery = restored.active_stages["discovery"]
+        self.addCleanup(discovery.close)
+        self.assertEqual("10.0.0.0/24", restored.pop("agent1")[0])
+        self.assertEqual(0, restored.task_id("agent1"))
+        self.assertEqual("10.0.1.5/32", restored.pop("agent2")[0])
+        self.assertEqual(1 << Context.TASK_ID_BITS | 1,
+                         restored.task_id("agent2"))
+        restored.completed("agent1")
+        restored.completed("agent2")
+        self.assertTrue(discovery.isfinished)
+        self.assertEqual(len(stages), len(restored.stage_list))
+        self.assertIsInstance(restored.stage_list[0].targets, WorkQueue)
+
+    def test_pending_pages(self):
+        with open(self.settings.queue_path, 'wt') as qfile:
+            qfile.write("10.64.0.0/12\n")
+        ctx = Context(self.settings)
+        ctx.pop("agent1")
+        discovery = ctx.active_stages["discovery"]
+        self.addCleanup(discovery.close)
+        for n in range(1, 2500):
+            ctx.pending.append(Task("discovery", discovery.options,
+                                    discovery.targets.task(n), n))
+        ctx.port_stats = PortStatistics()
+        ctx.port_stats.update([("10.0.0.1", 80)])
+        self.settings.save_context(ctx)
+
+        restored = Context.create(self.server_config())
+        self.addCleanup(restored.pending._close)
+        self.addCleanup(restored.active_stages["discovery"].close)
+        # the pending tasks are read from the snapshot when needed.
+        self.assertEqual(2500, len(restored.pending))
+        self.assertEqual(0, len(restored.pending.loaded))
+        task = restored.pending.pop(0)
+        self.assertEqual(("10.64.1.0/24", 1, STATUS.SCHEDULED),
+                         (task.target, task.index, task.status))
+        self.assertEqual(1023, len(restored.pending.loaded))
+        restored.pending.append(Task("discovery", "-sn", "10.2.0.1"))
+        self.assertEqual({80: 1}, restored.port_stats.hits)
+        self.assertEqual(len(ctx.stage_list), len(restored.stage_list))
+
+        # the unread tasks are copied from the previous snapshot.
+        self.settings.save_context(restored)
+        resumed = Context.create(self.server_config())
+        self.addCleanup(resumed.pending._close)
+        self.addCleanup(resumed.active_stages["discovery"].close)
+        targets = [task.target for task in resumed.pending]
+        self.assertEqual(2500, len(targets))
+        # the task running on agent1 was saved as interrupted.
+        self.assertEqual(["10.64.2.0/24", "10.64.0.0/24", "10.2.0.1"],
+                         targets[:1] + targets[-2:])
+
+
+class TestTaskTable(unittest.TestCase):
+
+    def test_queue(self):
+        targets = {("stage1", 7): "10.0.0.7/32", ("stage1", 9): "10.0.0.9/32"}
+        table = TaskTable()
+        table.add(Task("stage1", "-sS -p22", "10.0.0.7/32", 7))
+        task = Task("stage1", "-sS -p22", "10.0.0.9/32", 9)
+        task.update(STATUS.INTERRUPTED)
+        task.attempts = 2
+        table.add(task)
+        # tasks without a position keep their target.
+        table.add(Task("stage2", "-sS -p25", "10.0.0.1 10.0.0.5"))
+        self.assertEqual(3, len(table))
+        self.assertEqual(2, len(table.option_sets))
+        self.assertEqual(8, table.positions.itemsize)
+
+        def lookup(name, position):
+            return targets[name, position]
+
+        task = table.popleft(lookup)
+        self.assertEqual(("stage1", "10.0.0.7/32", 7, 0),
+                         (task.stage_name, task.target, task.index,
+                          task.attempts))
+        task = table.popleft(lookup)
+        self.assertEqual((STATUS.INTERRUPTED, 2), (task.status, task.attempts))
+        self.assertEqual(["10.0.0.1 10.0.0.5"],
+                         [task.target for task in table.tasks(lookup)])
+        task = table.popleft(lookup)
+        self.assertEqual(("stage2", "-sS -p25", None),
+                         (task.stage_name, task.options, task.index))
+        self.assertEqual(0, len(table))
+        self.assertRaises(IndexError, table.popleft, lookup)
+        # the remainder of a task keeps its target and position.
+        task = Task("stage1", "-sS -p22", "10.0.0.6/32", 7)
+        task.remainder = True
+        table.add(Task.from_record(task.as_record()))
+        task = table.popleft(lookup)
+        self.assertEqual(("10.0.0.6/32", 7, True),
+                         (task.target, task.index, task.remainder))
+
+    def test_discard(self):
+        def lookup(name, position):
+            return f"10.0.{position >> 8}.{position & 0xff}/32"
+
+        table = TaskTable()
+        for n in range(TaskTable.DISCARD + 10):
+            table.add(Task("stage1", "-sS", lookup("stage1", n), n))
+        for _ in range(TaskTable.DISCARD):
+            table.popleft(lookup)
+        # the rows taken are dropped.
+        self.assertEqual(10, len(table.stages))
+        self.assertEqual(10, len(table))
+        self.assertEqual("10.0.16.0/32", table.popleft(lookup).target)
+
+
 class TestTasks(unittest.TestCase):
 
     def test_curd(self):
@@ -108,6 +767,87 @@ class TestTasks(unittest.TestCase):
             task.update("FU")
 
 
+class TestPortStatistics(unittest.TestCase):
+
+    def test_rebalance(self):
+        stats = PortStatistics()
+        stats.update([("10.0.0.1", 22), ("10.0.1.1", 22), ("10.0.0.2", 8080),
+                      ("10.0.0.3", 8080), ("10.0.0.4", 8080)])
+        stage1 = Stage("stage1", "live.work", "-sS -n -p 80,443,8080", "out")
+        stage2 = Stage("stage2", "live.work", "-sS -n -p21-23,25", "out")
+        stats.rebalance([stage1, stage2])
+        # 22 is open in two networks, 8080 in one, in order of yield.
+        self.assertEqual([22, 8080, 80], stage1.ports)
+        self.assertEqual("-sS -n -p 22,8080,80", stage1.options)
+        self.assertEqual("-sS -n -p443,21,23,25", stage2.options)
+
+    def test_rebalance_max_options(self):
+        stats = PortStatistics()
+        stats.update([("10.0.0.1", port) for port in range(1, 4000, 2)])
+        stage1 = Stage("stage1", "live.work", "-sS -p1-2000", "out")
+        stage2 = Stage("stage2", "live.work", "-sS -p2001-4000", "out")
+        stats.rebalance([stage1, stage2])
+        # the odd ports don't fit in a legacy command.
+        self.assertEqual("-sS -p1-2000", stage1.options)
+        self.assertEqual("-sS -p2001-4000", stage2.options)
+
+    def test_rebalance_no_hits(self):
+        stage = Stage("stage1", "live.work", "-sS -n -p22", "out")
+        PortStatistics().rebalance([stage])
+        self.assertEqual("-sS -n -p22", stage.options)
+
+
+class TestLiveSet(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.ltargets = os.path.join(self.tmpdir, "live-targets.work")
+        with open(self.ltargets, 'wt') as ltargets:
+            ltargets.write("10.0.0.1-3\n")
+        self.stage = Stage("stage1", self.ltargets, "-sS -p22", self.tmpdir)
+
+    @patch('dscan.models.scanner.ReportsParser')
+    def test_refine(self, mock_parser):
+        mock_parser().hosts_status.return_value = [
+            ("10.0.0.1", True), ("10.0.0.2", False), ("10.0.0.3", True)]
+        live_set = LiveSet(self.ltargets, 1)
+        path = live_set.refine(self.stage)
+        self.assertEqual(os.path.join(self.tmpdir, "live-targets-stage1.work"),
+                         path)
+        with open(path) as refined:
+            self.assertEqual("10.0.0.1/32\n10.0.0.3/32\n", refined.read())
+
+    @patch('dscan.models.scanner.ReportsParser')
+    def test_refine_threshold(self, mock_parser):
+        mock_parser().hosts_status.return_value = [("10.0.0.2", False)]
+        live_set = LiveSet(self.ltargets, 2)
+        self.assertIsNone(live_set.refine(self.stage))
+        self.assertIsNotNone(live_set.refine(self.stage))
+        self.assertEqual({"10.0.0.2"}, live_set.dead)
+
+    @patch('dscan.models.scanner.ReportsParser')
+    def test_refine_next_stage(self, mock_parser):
+        mock_parser().hosts_status.return_value = [("10.0.0.2", False)]
+        options = MagicMock(spect=ServerConfig)
+        options.port_ranking = False
+        options.dead_threshold = 1
+        options.ltargets_path = self.ltargets
+        options.live_pack = 0
+        options.ipv6_pack = 0
+        options.pack_length = 0
+        options.stage_list = [self.stage,
+                              Stage("stage2", self.ltargets, "-sS -p25",
+                                    self.tmpdir)]
+        ctx = Context(options)
+        self.addCleanup(options.stage_list[1].close)
+        self.assertEqual("10.0.0.1-3", ctx.pop("agent1")[0])
+        # the next stage waits for the refined live targets.
+        self.assertIsNone(ctx.pop("agent2"))
+        ctx.completed("agent1")
+        self.assertEqual(("10.0.0.1/32", "-sS -p25"), ctx.pop("agent2"))
+
+
 class TestRuntimeContext(FileSystemMockTestCase):
 
     def setUp(self) -> None:
@@ -144,6 +884,10 @@ class TestRuntimeContext(FileSystemMockTestCase):
         self.mock_server_config.queue_path = targets_path
         self.mock_server_config.ltargets_path = ltargets_path
         self.mock_server_config.resume_path = resume_path
+        self.mock_server_config.port_ranking = False
+        self.mock_server_config.dead_threshold = 0
+        self.mock_server_config.ipv6_pack = 0
+        self.mock_server_config.journal_path = None
         self.mock_server_config.stage_list = [
             DiscoveryStage(targets_path, options, outdir, ltargets_path),
             Stage("stage1", ltargets_path, options, outdir),
@@ -160,7 +904,8 @@ class TestRuntimeContext(FileSystemMockTestCase):
             "fake/reports/discovery-nonstandar.xml": self.report1,
             "fake/reports/discovery-nonstandard.xml": self.report2,
             "fake/run/live_hosts.work": self.live_targets,
-            "fake/run/current.trace": self.resume
+            "fake/run/current.trace": self.resume,
+            "fake/run/current.trace.tmp": self.resume
         }
 
     def side_effect(self, *args):
@@ -168,6 +913,7 @@ class TestRuntimeContext(FileSystemMockTestCase):
         if name == "fake/run/live_hosts.work" or name \
                 == 'fake/run/current.trace':
             self.live_targets.seek(0)
+            self.resume.seek(0)
         return self.build_mock(self.mocks[name])
 
     def check_tasks(self, task_data, task, stage_name, nactive,
@@ -294,8 +1040,10 @@ class TestRuntimeContext(FileSystemMockTestCase):
                 task = context.pending.pop(0)
             self.assertEqual(expected, task.status)
 
+    @patch('os.replace')
+    @patch('os.fsync')
     @patch('builtins.open', spec=open)
-    def test_context_resume(self, mock_file):
+    def test_context_resume(self, mock_file, mock_fsync, mock_replace):
         mock_file.side_effect = self.side_effect
         agent1 = "127.0.0.1:1010"
         agent2 = "127.0.0.2:1010"
@@ -305,7 +1053,9 @@ class TestRuntimeContext(FileSystemMockTestCase):
         context.running(agent1)
         self.mock_server_config.save_context(self.mock_server_config,
                                              context)
-        mock_file.assert_any_call('fake/run/current.trace', "wb")
+        mock_file.assert_any_call('fake/run/current.trace.tmp', "wb")
+        mock_replace.assert_called_once_with('fake/run/current.trace.tmp',
+                                             'fake/run/current.trace')
 
         restored_ctx = Context.create(self.mock_server_config)
         self.assertEqual(context.cstage_name, restored_ctx.cstage_name)